@@ -1,31 +1,47 @@
 #!/usr/bin/env python3
 # app.py — studio333.art (Flask + psycopg3 pool; Jinja templates in app/templates)
 
-import os, sys, time, json, atexit, re, inspect, logging
-from datetime import datetime, timedelta
+import os, sys, time, json, atexit, re, logging, mimetypes, hashlib, threading, queue, gzip, base64
+from contextlib import contextmanager
+import struct, subprocess, html, secrets, random, hmac, shutil
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
 from functools import wraps
-from urllib.parse import urlparse
+from urllib.parse import urlparse, quote
 
 from flask import (
-    Flask, Blueprint, request, session, jsonify, redirect, url_for, render_template,
-    render_template_string, abort, make_response, send_from_directory, flash
+    Flask, Blueprint, request, session, g, jsonify, redirect, url_for, render_template,
+    render_template_string, abort, make_response, send_from_directory, send_file, flash,
+    has_request_context
 )
 from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.exceptions import HTTPException
+from flask.sessions import SessionInterface, SecureCookieSession
+from flask.json.tag import TaggedJSONSerializer
+from itsdangerous import Signer, BadSignature
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 import uuid
-from PIL import Image
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
 import psycopg
-from psycopg_pool import ConnectionPool
+from psycopg_pool import ConnectionPool, PoolTimeout
 from psycopg.errors import UniqueViolation
 from psycopg.rows import dict_row
 from psycopg.types.json import Json as PgJson
-from psycopg import sql  # used by dev_db_tables
+from psycopg import sql  # used by dev_db_tables and activity log partitions
+
+# Set PROMETHEUS_MULTIPROC_DIR before this import to aggregate metrics across gunicorn workers.
+from prometheus_client import (
+    Counter, Gauge, Histogram, CollectorRegistry, REGISTRY, CONTENT_TYPE_LATEST, generate_latest,
+)
+from prometheus_client import multiprocess as prom_multiprocess
 
 # ----------------------------
 # Config (env vars)
 # ----------------------------
 SECRET_KEY   = os.getenv("SECRET_KEY", "CHANGE_ME")
+LOG_LEVEL    = os.getenv("LOG_LEVEL", "INFO").upper()
 DB_NAME      = os.getenv("DB_NAME", "studio333")
 DB_USER      = os.getenv("DB_USER", "studio333")
 DB_PASSWORD  = os.getenv("DB_PASSWORD", "studio333")
@@ -34,17 +50,143 @@ DB_PORT      = int(os.getenv("DB_PORT", 5432))
 DB_MIN_CONN  = int(os.getenv("DB_MIN_CONN", 1))
 DB_MAX_CONN  = int(os.getenv("DB_MAX_CONN", 10))
 
+# Pool tuning (per gunicorn worker; size DB_MAX_CONN ~ threads, workers x DB_MAX_CONN < max_connections).
+# DB_PREPARE_THRESHOLD: executions before psycopg prepares a statement server-side; "none" disables
+# (needed behind pgbouncer in transaction mode).
+DB_POOL_TIMEOUT      = float(os.getenv("DB_POOL_TIMEOUT", 10))        # max wait for a checkout (s)
+DB_POOL_MAX_WAITING  = int(os.getenv("DB_POOL_MAX_WAITING", 0))       # 0 = unbounded queue
+DB_POOL_MAX_IDLE     = float(os.getenv("DB_POOL_MAX_IDLE", 600))      # close idle conns above min_size
+DB_POOL_MAX_LIFETIME = float(os.getenv("DB_POOL_MAX_LIFETIME", 3600)) # recycle connections
+DB_POOL_CHECK        = os.getenv("DB_POOL_CHECK", "1") == "1"         # ping on checkout (survives DB restarts)
+DB_CONNECT_TIMEOUT   = int(os.getenv("DB_CONNECT_TIMEOUT", 5))
+DB_POOL_WARM_TIMEOUT = float(os.getenv("DB_POOL_WARM_TIMEOUT", 10))   # post_worker_init waits this long for min_size
+DB_PREPARE_THRESHOLD = None if os.getenv("DB_PREPARE_THRESHOLD", "5").lower() == "none" else int(os.getenv("DB_PREPARE_THRESHOLD", "5"))
+
 SESSION_TIMEOUT_DEFAULT_MIN   = int(os.getenv("SESSION_TIMEOUT_DEFAULT_MIN", 60))
 SESSION_TIMEOUT_MAX_MIN       = int(os.getenv("SESSION_TIMEOUT_MAX_MIN", 720))
 SESSION_ABSOLUTE_LIFETIME_HRS = int(os.getenv("SESSION_ABSOLUTE_LIFETIME_HRS", 24))
 SESSION_UPDATE_GRACE_SEC      = 30
 
+# Login throttling (sliding window, checked before any password hashing). Per-IP counts every
+# attempt, per-email counts failures; counters are in-process and, with LOGIN_THROTTLE_SHARED=1,
+# also in an UNLOGGED Postgres table so all workers see them (falls back to in-process on DB errors).
+LOGIN_WINDOW_SEC          = int(os.getenv("LOGIN_WINDOW_SEC", 300))
+LOGIN_MAX_PER_IP          = int(os.getenv("LOGIN_MAX_PER_IP", 30))
+LOGIN_MAX_FAILS_PER_EMAIL = int(os.getenv("LOGIN_MAX_FAILS_PER_EMAIL", 8))
+LOGIN_THROTTLE_SHARED     = os.getenv("LOGIN_THROTTLE_SHARED", "1") == "1"
+# Request threads per worker (gunicorn.conf.py exports its `threads`). At most LOGIN_HASH_SLOTS of
+# them may be hashing a password at once, so at least one stays free for album/media requests;
+# further logins get 503 auth_busy.
+WEB_THREADS               = int(os.getenv("WEB_THREADS", 2))
+LOGIN_HASH_SLOTS          = int(os.getenv("LOGIN_HASH_SLOTS", max(1, WEB_THREADS - 1)))
+
+# Session storage: "cookie" (signed cookie, default), "postgres" (UNLOGGED http_sessions table;
+# a DB crash logs everyone out) or "shm" (SQLite file on tmpfs shared by the workers of one host).
+# Server-side stores keep only a signed id in the cookie, which is set once per login.
+SESSION_STORE    = os.getenv("SESSION_STORE", "cookie").strip().lower()
+SESSION_SHM_PATH = os.getenv("SESSION_SHM_PATH", "/dev/shm/studio333-sessions.sqlite3")
+
+ALBUMS_PAGE_MAX = int(os.getenv("ALBUMS_PAGE_MAX", 200))
+
+# /me/search: ranked full-text (tsvector) + trigram name matching over albums and media_items
+SEARCH_PAGE_MAX       = int(os.getenv("SEARCH_PAGE_MAX", 50))
+SEARCH_MAX_OFFSET     = 500
+SEARCH_TRGM_THRESHOLD = float(os.getenv("SEARCH_TRGM_THRESHOLD", 0.5))
+
+# Image uploads (album covers, avatars): originals are stored as-is, renditions built off-request
+IMAGE_UPLOAD_MAX_BYTES = int(os.getenv("IMAGE_UPLOAD_MAX_BYTES", 15 * 1024 * 1024))
+IMAGE_RENDITION_WIDTHS = (128, 512, 1024)
+IMAGE_WORKERS          = int(os.getenv("IMAGE_WORKERS", 1))
+IMAGE_MAIN_WIDTH       = 512   # width behind the owner's stored /img URL
+IMAGE_PLACEHOLDERS     = {"album": "icons/image.svg", "avatar": "icons/user.svg"}   # under static/
+
+# Identity cache (per worker process). Other workers see profile/role writes after at most the TTL.
+IDENTITY_CACHE_TTL_SEC = int(os.getenv("IDENTITY_CACHE_TTL_SEC", 30))
+IDENTITY_CACHE_MAX     = int(os.getenv("IDENTITY_CACHE_MAX", 1024))
+
+# Activity log writer (background thread per worker; rows are dropped when the queue is full)
+ACTIVITY_QUEUE_MAX  = int(os.getenv("ACTIVITY_QUEUE_MAX", 10000))
+ACTIVITY_BATCH_SIZE = int(os.getenv("ACTIVITY_BATCH_SIZE", 200))
+ACTIVITY_FLUSH_SEC  = float(os.getenv("ACTIVITY_FLUSH_SEC", 2.0))
+
+# Activity log partitions/retention (see `app.py activitylog`); 0 keeps partitions forever
+ACTIVITY_PARTITIONS_AHEAD = int(os.getenv("ACTIVITY_PARTITIONS_AHEAD", 3))
+ACTIVITY_RETAIN_MONTHS    = int(os.getenv("ACTIVITY_RETAIN_MONTHS", 12))
+ACTIVITY_ARCHIVE_DIR      = os.getenv("ACTIVITY_ARCHIVE_DIR", "")
+
+# Media delivery: archive files never change in place, so they are cached "forever".
+# MEDIA_OFFLOAD = "accel" (nginx X-Accel-Redirect) | "sendfile" (X-Sendfile) | "" (serve from Flask)
+MEDIA_ARCHIVE_PREFIX  = "archives/"
+MEDIA_ARCHIVE_MAX_AGE = int(os.getenv("MEDIA_ARCHIVE_MAX_AGE", 31536000))
+MEDIA_DEFAULT_MAX_AGE = int(os.getenv("MEDIA_DEFAULT_MAX_AGE", 3600))
+MEDIA_OFFLOAD         = os.getenv("MEDIA_OFFLOAD", "").strip().lower()
+MEDIA_ACCEL_PREFIX    = os.getenv("MEDIA_ACCEL_PREFIX", "/_media_internal/")
+
+# /metrics (Prometheus). With METRICS_TOKEN set, scrapers send "Authorization: Bearer <token>";
+# without it only admins can read it.
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Cache policy: fingerprinted static URLs (?v=...) are immutable; private pages/JSON revalidate
+# via ETag. PRIVATE_MAX_AGE stays 0 by default because the player re-reads lists right after writes.
+STATIC_MAX_AGE    = int(os.getenv("STATIC_MAX_AGE", 3600))
+IMMUTABLE_MAX_AGE = 31536000
+PRIVATE_MAX_AGE   = int(os.getenv("PRIVATE_MAX_AGE", 0))
+
 # ----------------------------
 # Flask
 # ----------------------------
+_log_level = int(LOG_LEVEL) if LOG_LEVEL.isdigit() else logging.getLevelName(LOG_LEVEL)
+if isinstance(_log_level, int):
+    logging.basicConfig(level=_log_level)
+else:   # getLevelName() returns "Level X" for unknown names; don't take every worker down for it
+    logging.basicConfig(level=logging.INFO)
+    logging.warning("LOG_LEVEL=%r is not a logging level; using INFO", LOG_LEVEL)
 app = Flask(__name__, template_folder="templates", static_folder="static")
 app.secret_key = SECRET_KEY
 app.config["PREFERRED_URL_SCHEME"] = "https"
+# Only send Set-Cookie when the session actually changed (last_active moves every
+# SESSION_UPDATE_GRACE_SEC at most), not on every request of a permanent session.
+app.config["SESSION_REFRESH_EACH_REQUEST"] = False
+
+# ----------------------------
+# Cache policy
+# ----------------------------
+CACHE_POLICIES = {
+    "no-store":   "no-store, no-cache, must-revalidate, max-age=0",
+    "private":    f"private, max-age={PRIVATE_MAX_AGE}, must-revalidate",
+    "revalidate": "public, no-cache",
+    "static":     f"public, max-age={STATIC_MAX_AGE}",
+    "immutable":  f"public, max-age={IMMUTABLE_MAX_AGE}, immutable",
+    "manual":     None,   # the view sets its own headers (e.g. media())
+}
+ETAG_POLICIES = {"private", "revalidate"}
+BLUEPRINT_CACHE_POLICY = {"api_auth": "private"}
+DEFAULT_CACHE_POLICY = "private"
+# static/ subfolders whose files are rewritten in place under the same name
+STATIC_REVALIDATE_PREFIXES = ("album_covers/", "avatars/", "presets/")
+# static/ subfolders with content-hashed file names
+STATIC_IMMUTABLE_PREFIXES = ("renditions/",)
+
+def cache_policy(name):
+    if name not in CACHE_POLICIES:
+        raise ValueError(f"unknown cache policy: {name}")
+    def _decorate(fn):
+        fn._cache_policy = name
+        return fn
+    return _decorate
+
+_static_fingerprints: dict[str, str] = {}
+
+def static_fingerprint(filename: str) -> str | None:
+    fp = _static_fingerprints.get(filename)
+    if fp is None or app.debug:
+        try:
+            st = os.stat(os.path.join(app.static_folder, filename))
+        except OSError:
+            return None
+        fp = hashlib.md5(f"{filename}:{st.st_mtime_ns}:{st.st_size}".encode()).hexdigest()[:10]
+        _static_fingerprints[filename] = fp
+    return fp
 
 # ----------------------------
 # Static media
@@ -52,24 +194,698 @@ app.config["PREFERRED_URL_SCHEME"] = "https"
 APP_DIR = os.path.dirname(os.path.abspath(__file__))
 MEDIA_ROOT = os.path.join(APP_DIR, 'media')
 
+# Waveform peaks: ffmpeg decodes to mono PCM, NumPy reduces it to min/max pairs per block.
+# Files use the audiowaveform .dat v1 layout (8-bit), one per samples-per-pixel level.
+FFMPEG_BIN        = os.getenv("FFMPEG_BIN", "ffmpeg")
+PEAKS_ROOT        = os.getenv("PEAKS_ROOT", os.path.join(APP_DIR, "cache", "peaks"))
+PEAKS_SAMPLE_RATE = 8000
+PEAKS_LEVELS      = (256, 1024, 4096)   # each level must divide the next
+PEAKS_DEFAULT_SPP = 1024
+PEAKS_ON_DEMAND   = os.getenv("PEAKS_ON_DEMAND", "0") == "1"
+
+# Audio renditions (see `app.py renditions`): lower-bitrate MP3s plus HLS (AAC) variants, stored
+# by source sha256 under RENDITIONS_ROOT/<h[:2]>/<h>/. Bitrates at or above the source are skipped.
+RENDITIONS_ROOT          = os.getenv("RENDITIONS_ROOT", os.path.join(APP_DIR, "cache", "renditions"))
+AUDIO_RENDITION_KBPS     = tuple(int(x) for x in os.getenv("AUDIO_RENDITION_KBPS", "64,128").split(","))
+HLS_SEGMENT_SEC          = int(os.getenv("HLS_SEGMENT_SEC", 6))
+RENDITIONS_ACCEL_PREFIX  = os.getenv("RENDITIONS_ACCEL_PREFIX", "/_renditions_internal/")
+RENDITION_MANIFEST_CACHE = 4096
+
+# nginx (MEDIA_OFFLOAD=accel):
+#   location /_media_internal/ { internal; alias /var/www/studio333.art/flask/media/; }
+#   location /_renditions_internal/ { internal; alias /var/www/studio333.art/flask/cache/renditions/; }
+def _media_etag(st) -> str:
+    return f"{st.st_mtime_ns:x}-{st.st_size:x}"
+
+def _media_cache_headers(resp, filename: str):
+    immutable = filename.startswith(MEDIA_ARCHIVE_PREFIX)
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = MEDIA_ARCHIVE_MAX_AGE if immutable else MEDIA_DEFAULT_MAX_AGE
+    resp.cache_control.immutable = immutable
+    return resp
+
 @app.route('/media/<path:filename>', methods=['GET'])
+@cache_policy("manual")
 def media(filename):
-    return send_from_directory(MEDIA_ROOT, filename, conditional=True, max_age=0)
+    path_fs = safe_join(MEDIA_ROOT, filename)
+    if path_fs is None or not os.path.isfile(path_fs):
+        abort(404)
+    st = os.stat(path_fs)
+    resp = _send_media_file(path_fs, MEDIA_ACCEL_PREFIX, filename, _media_etag(st), st.st_mtime)
+    return _media_cache_headers(resp, filename)
+
+def _send_media_file(path_fs: str, accel_prefix: str, accel_rel: str, etag: str, mtime: float):
+    if MEDIA_OFFLOAD in ("accel", "sendfile"):
+        resp = make_response("")
+        if MEDIA_OFFLOAD == "accel":
+            resp.headers["X-Accel-Redirect"] = accel_prefix.rstrip("/") + "/" + quote(accel_rel)
+        else:
+            resp.headers["X-Sendfile"] = path_fs
+        resp.mimetype = mimetypes.guess_type(path_fs)[0] or "application/octet-stream"
+        resp.set_etag(etag)
+        resp.last_modified = mtime
+        # Ranges are answered by the front server after the internal redirect.
+        resp.make_conditional(request)
+        return resp
+    return send_file(path_fs, conditional=True, etag=etag, last_modified=mtime)
+
+def media_file_key(rel_path: str, st) -> str:
+    """Cache key for derived files (peaks, rendition index): path + size + mtime."""
+    return hashlib.sha1(f"{rel_path}:{st.st_size}:{st.st_mtime_ns}".encode()).hexdigest()[:20]
+
+def peaks_path(key: str, spp: int) -> str:
+    return os.path.join(PEAKS_ROOT, key[:2], f"{key}-{spp}.dat")
+
+def decode_pcm(path_fs: str):
+    import numpy as np
+    proc = subprocess.run(
+        [FFMPEG_BIN, "-v", "error", "-nostdin", "-i", path_fs,
+         "-ac", "1", "-ar", str(PEAKS_SAMPLE_RATE), "-f", "s16le", "-"],
+        capture_output=True, check=True,
+    )
+    return np.frombuffer(proc.stdout, dtype="<i2")
+
+def compute_peaks(samples, levels=PEAKS_LEVELS) -> dict:
+    """{samples_per_pixel: (mins, maxs)} as int8 arrays, each level reduced from the previous one."""
+    import numpy as np
+    out = {}
+    base = levels[0]
+    pad = (-len(samples)) % base
+    blocks = np.pad(samples, (0, pad)).reshape(-1, base) if len(samples) else np.zeros((0, base), "<i2")
+    mins, maxs = blocks.min(axis=1), blocks.max(axis=1)
+    prev = base
+    for spp in levels:
+        if spp != base:
+            factor = spp // prev
+            pad = (-len(mins)) % factor
+            mins = np.pad(mins, (0, pad), mode="edge").reshape(-1, factor).min(axis=1) if len(mins) else mins
+            maxs = np.pad(maxs, (0, pad), mode="edge").reshape(-1, factor).max(axis=1) if len(maxs) else maxs
+            prev = spp
+        out[spp] = ((mins >> 8).astype(np.int8), (maxs >> 8).astype(np.int8))
+    return out
+
+def write_peaks_dat(path: str, spp: int, mins, maxs) -> None:
+    import numpy as np
+    pairs = np.empty(len(mins) * 2, dtype=np.int8)
+    pairs[0::2], pairs[1::2] = mins, maxs
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(struct.pack("<iIiiI", 1, 1, PEAKS_SAMPLE_RATE, spp, len(mins)))
+        fh.write(pairs.tobytes())
+    os.replace(tmp, path)
+
+def generate_peaks(rel_path: str, force: bool = False) -> str:
+    path_fs = os.path.join(MEDIA_ROOT, rel_path)
+    key = media_file_key(rel_path, os.stat(path_fs))
+    if not force and all(os.path.exists(peaks_path(key, spp)) for spp in PEAKS_LEVELS):
+        return key
+    for spp, (mins, maxs) in compute_peaks(decode_pcm(path_fs)).items():
+        write_peaks_dat(peaks_path(key, spp), spp, mins, maxs)
+    return key
+
+@app.route('/media/<path:filename>/peaks', methods=['GET'])
+@cache_policy("manual")
+def media_peaks(filename):
+    """Waveform min/max peaks (audiowaveform .dat v1, 8-bit) for a media file; ``?spp=`` picks the level."""
+    path_fs = safe_join(MEDIA_ROOT, filename)
+    if path_fs is None or not os.path.isfile(path_fs):
+        abort(404)
+    want = request.args.get("spp", PEAKS_DEFAULT_SPP, type=int)
+    spp = next((lvl for lvl in PEAKS_LEVELS if lvl >= want), PEAKS_LEVELS[-1])
+    st = os.stat(path_fs)
+    key = media_file_key(filename, st)
+    dat = peaks_path(key, spp)
+    if not os.path.exists(dat):
+        if not PEAKS_ON_DEMAND:
+            abort(404)
+        try:
+            generate_peaks(filename)
+        except (OSError, subprocess.CalledProcessError):
+            abort(404)
+    resp = send_file(dat, mimetype="application/octet-stream", conditional=True,
+                     etag=f"{key}-{spp}", last_modified=st.st_mtime)
+    return _media_cache_headers(resp, filename)
+
+# Audio renditions
+# ----------------
+# RENDITIONS_ROOT/<h[:2]>/<h>/ holds {kbps}k.mp3, hls/{kbps}k/index.m3u8 + segments, hls/master.m3u8
+# and manifest.json; RENDITIONS_ROOT/by-path/<media_file_key> maps a media file to its sha256.
+_RENDITION_HASH_RE = re.compile(r"^[0-9a-f]{64}$")
+_rendition_manifests: "OrderedDict[str, dict | None]" = OrderedDict()
+_rendition_lock = threading.Lock()
+
+def rendition_dir(sha256: str) -> str:
+    return os.path.join(RENDITIONS_ROOT, sha256[:2], sha256)
+
+def _rendition_index_path(file_key: str) -> str:
+    return os.path.join(RENDITIONS_ROOT, "by-path", file_key[:2], file_key)
+
+def _sha256_file(path_fs: str) -> str:
+    h = hashlib.sha256()
+    with open(path_fs, "rb") as fh:
+        while chunk := fh.read(1 << 20):
+            h.update(chunk)
+    return h.hexdigest()
+
+def _write_atomic(path: str, data: bytes) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as fh:
+        fh.write(data)
+    os.replace(tmp, path)
+
+def build_audio_renditions(rel_path: str, force: bool = False) -> dict:
+    """Transcode one catalogued audio file into every rendition in a single ffmpeg pass."""
+    path_fs = os.path.join(MEDIA_ROOT, rel_path)
+    index = _rendition_index_path(media_file_key(rel_path, os.stat(path_fs)))
+    if not force and os.path.exists(index):
+        with open(index) as fh:
+            manifest_path = os.path.join(rendition_dir(fh.read().strip()), "manifest.json")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as fh:
+                return json.load(fh)
+
+    digest = _sha256_file(path_fs)
+    out_dir = rendition_dir(digest)
+    manifest_path = os.path.join(out_dir, "manifest.json")
+    if not force and os.path.exists(manifest_path):
+        _write_atomic(index, digest.encode())
+        with open(manifest_path) as fh:
+            return json.load(fh)
+
+    source_kbps, duration = None, None
+    try:
+        import mutagen
+        info = getattr(mutagen.File(path_fs), "info", None)
+        source_kbps = int(info.bitrate // 1000) if getattr(info, "bitrate", None) else None
+        duration = float(info.length) if getattr(info, "length", None) else None
+    except Exception:
+        pass
+    kbps_list = [k for k in AUDIO_RENDITION_KBPS if source_kbps is None or k < source_kbps]
+    kbps_list = kbps_list or [min(AUDIO_RENDITION_KBPS)]
+
+    work = f"{out_dir}.{os.getpid()}.work"
+    os.makedirs(work, exist_ok=True)
+    try:
+        cmd = [FFMPEG_BIN, "-v", "error", "-nostdin", "-y", "-i", path_fs]
+        for kbps in kbps_list:
+            os.makedirs(os.path.join(work, "hls", f"{kbps}k"), exist_ok=True)
+            cmd += ["-map", "0:a:0", "-map_metadata", "-1", "-c:a", "libmp3lame", "-b:a", f"{kbps}k",
+                    os.path.join(work, f"{kbps}k.mp3")]
+            cmd += ["-map", "0:a:0", "-map_metadata", "-1", "-c:a", "aac", "-b:a", f"{kbps}k",
+                    "-f", "hls", "-hls_time", str(HLS_SEGMENT_SEC), "-hls_playlist_type", "vod",
+                    "-hls_segment_filename", os.path.join(work, "hls", f"{kbps}k", "seg_%04d.ts"),
+                    os.path.join(work, "hls", f"{kbps}k", "index.m3u8")]
+        subprocess.run(cmd, capture_output=True, check=True)
+
+        variants = {}
+        for kbps in kbps_list:
+            variants[str(kbps)] = {
+                "mp3": f"{kbps}k.mp3",
+                "hls": f"hls/{kbps}k/index.m3u8",
+                "bytes": os.path.getsize(os.path.join(work, f"{kbps}k.mp3")),
+            }
+        manifest = {
+            "sha256": digest, "source_kbps": source_kbps, "duration_sec": duration,
+            "variants": variants, "hls_master": "hls/master.m3u8",
+        }
+        _write_atomic(os.path.join(work, "hls", "master.m3u8"), hls_master_playlist(manifest).encode())
+        _write_atomic(os.path.join(work, "manifest.json"), json.dumps(manifest).encode())
+        if os.path.isdir(out_dir):
+            shutil.rmtree(out_dir)
+        os.replace(work, out_dir)
+    except BaseException:
+        shutil.rmtree(work, ignore_errors=True)   # failed ffmpeg run: don't leave partial output behind
+        raise
+    _write_atomic(index, digest.encode())
+    return manifest
+
+def hls_master_playlist(manifest: dict, prefix: str = "") -> str:
+    """Master playlist; variant URIs are relative to hls/ unless ``prefix`` is given."""
+    lines = ["#EXTM3U", "#EXT-X-VERSION:3"]
+    for kbps in sorted(manifest["variants"], key=int):
+        lines.append(f'#EXT-X-STREAM-INF:BANDWIDTH={int(kbps) * 1000 + 8000},CODECS="mp4a.40.2"')
+        lines.append(f"{prefix}{kbps}k/index.m3u8")
+    return "\n".join(lines) + "\n"
+
+def _load_rendition_manifest(rel_path: str, st) -> dict | None:
+    key = media_file_key(rel_path, st)
+    with _rendition_lock:
+        if key in _rendition_manifests:
+            _rendition_manifests.move_to_end(key)
+            return _rendition_manifests[key]
+    manifest = None
+    try:
+        with open(_rendition_index_path(key)) as fh:
+            digest = fh.read().strip()
+        with open(os.path.join(rendition_dir(digest), "manifest.json")) as fh:
+            manifest = json.load(fh)
+    except (OSError, ValueError):
+        pass
+    if manifest is None:
+        return None   # not built yet; a miss is one failed open(), don't pin it in the LRU
+    with _rendition_lock:
+        _rendition_manifests[key] = manifest
+        while len(_rendition_manifests) > RENDITION_MANIFEST_CACHE:
+            _rendition_manifests.popitem(last=False)
+    return manifest
+
+def _pick_audio_variant(manifest: dict) -> str | None:
+    """``?q=<kbps>`` picks a rendition, ``?q=orig`` the original; without ``?q=`` the original is
+    kept unless Save-Data / ECT / Downlink hints ask for less, which gets the lowest rendition."""
+    q = request.args.get("q", "auto")
+    if q in manifest["variants"]:
+        return q
+    if q != "auto":
+        return None
+    slow = (
+        request.headers.get("Save-Data", "").lower() == "on"
+        or request.headers.get("ECT", "").lower() in ("slow-2g", "2g", "3g")
+        or (request.headers.get("Downlink", type=float) or 99.0) < 1.0
+    )
+    return min(manifest["variants"], key=int) if slow and manifest["variants"] else None
+
+@app.route('/media/<path:filename>/stream', methods=['GET'])
+@cache_policy("manual")
+def media_stream(filename):
+    """Negotiated audio: the original file, or a 302 to the HLS master (``?format=hls`` or Accept)
+    or to a lower-bitrate MP3 rendition when one is asked for.
+
+    The original is served in place, with the /media/ caching and validators. Only the
+    content-addressed /renditions/ targets are immutable; a redirect depends on hints and on
+    renditions built later, so it is never cached (3xx are no-store, see _resolve_cache_policy).
+    """
+    path_fs = safe_join(MEDIA_ROOT, filename)
+    if path_fs is None or not os.path.isfile(path_fs):
+        abort(404)
+    st = os.stat(path_fs)
+    manifest = _load_rendition_manifest(filename, st)
+    want_hls = request.args.get("format") == "hls" or "mpegurl" in request.headers.get("Accept", "")
+    if want_hls and not (manifest and manifest["variants"]):
+        abort(404)
+
+    kbps = None if want_hls or manifest is None else _pick_audio_variant(manifest)
+    if want_hls:
+        resp = redirect(url_for("rendition_file", digest=manifest["sha256"], name=manifest["hls_master"]), code=302)
+    elif kbps:
+        resp = redirect(url_for("rendition_file", digest=manifest["sha256"],
+                                name=manifest["variants"][kbps]["mp3"]), code=302)
+        resp.headers["X-Rendition"] = f"{kbps}k"
+    else:
+        resp = _send_media_file(path_fs, MEDIA_ACCEL_PREFIX, filename, _media_etag(st), st.st_mtime)
+        resp = _media_cache_headers(resp, filename)
+    resp.vary.update(("Accept", "Save-Data", "ECT", "Downlink"))
+    return resp
+
+@app.route('/renditions/<digest>/<path:name>', methods=['GET'])
+@cache_policy("manual")
+def rendition_file(digest, name):
+    """Content-addressed rendition files (HLS playlists/segments, MP3s); never change once written."""
+    if not _RENDITION_HASH_RE.match(digest):
+        abort(404)
+    path_fs = safe_join(rendition_dir(digest), name)
+    if path_fs is None or not os.path.isfile(path_fs) or name == "manifest.json":
+        abort(404)
+    st = os.stat(path_fs)
+    resp = _send_media_file(path_fs, RENDITIONS_ACCEL_PREFIX, f"{digest[:2]}/{digest}/{name}",
+                            f"{digest[:20]}-{_media_etag(st)}", st.st_mtime)
+    if name.endswith(".m3u8"):
+        resp.mimetype = "application/vnd.apple.mpegurl"
+    elif name.endswith(".ts"):
+        resp.mimetype = "video/mp2t"
+    resp.cache_control.no_cache = None
+    resp.cache_control.public = True
+    resp.cache_control.max_age = IMMUTABLE_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
 
 # ----------------------------
 # DB pool (psycopg3)
 # ----------------------------
 _pool: ConnectionPool | None = None
+_pool_pid: int | None = None
+
+# Checkout wait per process (the pool's own counters only cover requests that had to queue).
+# Bucket upper bounds in ms; the last bucket is open-ended.
+POOL_WAIT_BUCKETS_MS = (1, 5, 10, 25, 50, 100, 250, 1000)
+_pool_wait = {"checkouts": 0, "total_ms": 0.0, "max_ms": 0.0, "timeouts": 0,
+              "buckets": [0] * (len(POOL_WAIT_BUCKETS_MS) + 1)}
+_pool_wait_lock = threading.Lock()
+
+def _bucket_index(bounds, value) -> int:
+    return next((i for i, b in enumerate(bounds) if value <= b), len(bounds))
+
+def _histogram_dict(bounds, counts) -> dict:
+    return {f"le_{b}": n for b, n in zip(bounds, counts)} | {"inf": counts[-1]}
+
+class _TimedCursor(psycopg.Cursor):
+    """Adds each statement's time to the current request (g.db_ms / g.db_queries)."""
+    def execute(self, query, params=None, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            _note_db_time(time.perf_counter() - t0)
+
+    def executemany(self, query, params_seq, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            _note_db_time(time.perf_counter() - t0)
+
+def _note_db_time(seconds: float) -> None:
+    if has_request_context():
+        g.db_ms = g.get("db_ms", 0.0) + seconds * 1000
+        g.db_queries = g.get("db_queries", 0) + 1
+
+def _pool_reconnect_failed(pool):
+    app.logger.error("DB pool %s: reconnection attempts exhausted", pool.name)
 
 def init_pool():
-    global _pool
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid != os.getpid():
+        # inherited across fork: the sockets belong to the parent, never close them from here
+        _pool = None
     if _pool is None:
-        conninfo = f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST} port={DB_PORT}"
-        _pool = ConnectionPool(conninfo=conninfo, min_size=DB_MIN_CONN, max_size=DB_MAX_CONN, kwargs={"autocommit": False})
+        _pool_pid = os.getpid()
+        conninfo = (f"dbname={DB_NAME} user={DB_USER} password={DB_PASSWORD} host={DB_HOST} port={DB_PORT} "
+                    f"connect_timeout={DB_CONNECT_TIMEOUT} application_name=studio333")
+        _pool = ConnectionPool(
+            conninfo=conninfo, min_size=DB_MIN_CONN, max_size=DB_MAX_CONN, name=f"studio333-{os.getpid()}",
+            kwargs={"autocommit": False, "prepare_threshold": DB_PREPARE_THRESHOLD, "cursor_factory": _TimedCursor},
+            timeout=DB_POOL_TIMEOUT, max_waiting=DB_POOL_MAX_WAITING,
+            max_idle=DB_POOL_MAX_IDLE, max_lifetime=DB_POOL_MAX_LIFETIME,
+            check=ConnectionPool.check_connection if DB_POOL_CHECK else None,
+            reconnect_failed=_pool_reconnect_failed, open=True,
+        )
 
+def _record_checkout(wait_ms: float, timed_out: bool = False) -> None:
+    with _pool_wait_lock:
+        if timed_out:
+            _pool_wait["timeouts"] += 1
+        else:
+            _pool_wait["checkouts"] += 1
+            _pool_wait["total_ms"] += wait_ms
+            _pool_wait["max_ms"] = max(_pool_wait["max_ms"], wait_ms)
+            _pool_wait["buckets"][_bucket_index(POOL_WAIT_BUCKETS_MS, wait_ms)] += 1
+    if has_request_context():
+        g.db_wait_ms = g.get("db_wait_ms", 0.0) + wait_ms
+        g.db_checkouts = g.get("db_checkouts", 0) + 1
+
+@contextmanager
 def get_conn():
     init_pool()
-    return _pool.connection()
+    t0 = time.perf_counter()
+    checked_out = False
+    try:
+        with _pool.connection() as conn:
+            checked_out = True
+            _record_checkout((time.perf_counter() - t0) * 1000)
+            yield conn
+    except PoolTimeout:
+        if not checked_out:
+            _record_checkout((time.perf_counter() - t0) * 1000, timed_out=True)
+            METRIC_POOL_TIMEOUTS.inc()
+        raise
+
+def pool_stats() -> dict:
+    """psycopg_pool counters (cumulative since the pool opened) plus this process's checkout waits."""
+    with _pool_wait_lock:
+        wait = dict(_pool_wait, buckets=list(_pool_wait["buckets"]))
+    wait["avg_ms"] = round(wait["total_ms"] / wait["checkouts"], 3) if wait["checkouts"] else 0.0
+    wait["total_ms"] = round(wait["total_ms"], 1)
+    wait["max_ms"] = round(wait["max_ms"], 3)
+    wait["buckets"] = _histogram_dict(POOL_WAIT_BUCKETS_MS, wait["buckets"])
+    return {
+        "pid": os.getpid(),
+        "opened": _pool is not None,
+        "config": {
+            "min_size": DB_MIN_CONN, "max_size": DB_MAX_CONN, "timeout": DB_POOL_TIMEOUT,
+            "max_waiting": DB_POOL_MAX_WAITING, "max_idle": DB_POOL_MAX_IDLE,
+            "max_lifetime": DB_POOL_MAX_LIFETIME, "check": DB_POOL_CHECK,
+            "prepare_threshold": DB_PREPARE_THRESHOLD,
+        },
+        "pool": _pool.get_stats() if _pool is not None else {},
+        "checkout_wait": wait,
+    }
+
+# ----------------------------
+# Query registry
+# ----------------------------
+# Hot-path statements are declared once by name and executed with run_query(cur, name, params).
+# prepare=True makes psycopg PREPARE them on first use per pooled connection, so repeat calls skip
+# parse/plan (DB_PREPARE_THRESHOLD=none still turns this off for pgbouncer). Each call is timed.
+QUERY_LATENCY_BUCKETS_MS = (0.5, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+QUERIES: dict[str, str] = {}
+_query_stats: dict[str, dict] = {}
+_query_stats_lock = threading.Lock()
+
+def register_query(name: str, sql_txt: str) -> str:
+    if name in QUERIES and QUERIES[name] != sql_txt:
+        raise ValueError(f"query {name!r} registered twice with different SQL")
+    QUERIES[name] = sql_txt
+    return name
+
+def run_query(cur, name: str, params=()):
+    """Execute registered statement ``name`` as a prepared statement; returns ``cur``."""
+    t0 = time.perf_counter()
+    failed = True
+    try:
+        cur.execute(QUERIES[name], params, prepare=True)
+        failed = False
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        with _query_stats_lock:
+            st = _query_stats.get(name)
+            if st is None:
+                st = _query_stats[name] = {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                           "buckets": [0] * (len(QUERY_LATENCY_BUCKETS_MS) + 1)}
+            st["calls"] += 1
+            st["errors"] += failed
+            st["total_ms"] += ms
+            st["max_ms"] = max(st["max_ms"], ms)
+            st["buckets"][_bucket_index(QUERY_LATENCY_BUCKETS_MS, ms)] += 1
+    return cur
+
+def query_stats() -> dict:
+    with _query_stats_lock:
+        snap = {k: dict(v, buckets=list(v["buckets"])) for k, v in _query_stats.items()}
+    out = {}
+    for name in sorted(QUERIES, key=lambda n: -snap.get(n, {}).get("total_ms", 0.0)):
+        st = snap.get(name) or {"calls": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0,
+                                "buckets": [0] * (len(QUERY_LATENCY_BUCKETS_MS) + 1)}
+        out[name] = {
+            "calls": st["calls"], "errors": st["errors"],
+            "total_ms": round(st["total_ms"], 2), "max_ms": round(st["max_ms"], 3),
+            "avg_ms": round(st["total_ms"] / st["calls"], 3) if st["calls"] else 0.0,
+            "buckets": _histogram_dict(QUERY_LATENCY_BUCKETS_MS, st["buckets"]),
+        }
+    return out
+
+Q_IDENTITY = register_query("identity.load", """
+    SELECT u.id, u.email, u.role, u.nickname, u.last_login, p.avatar
+    FROM users u
+    LEFT JOIN profiles p ON p.user_id = u.id
+    WHERE u.id = %s AND u.is_deleted = false
+""")
+Q_LOGIN_LOOKUP = register_query("auth.login_lookup",
+    "SELECT id, password_hash FROM users WHERE email = %s AND is_deleted = false")
+Q_BART_LOOKUP = register_query("auth.bart_lookup", """
+    SELECT id, password_hash, role, nickname
+    FROM users
+    WHERE email = %s AND is_verified = TRUE AND is_deleted = FALSE
+""")
+Q_TOUCH_LAST_LOGIN = register_query("users.touch_last_login", "UPDATE users SET last_login = now() WHERE id = %s")
+Q_ALBUMS_STAMP = register_query("albums.list_stamp",
+    "SELECT MAX(updated_at), COUNT(*) FROM albums WHERE user_id = %s")
+Q_ALBUM_GET = register_query("albums.get", """
+    SELECT id::text, user_id, slug, title, subtitle, description_md, cover_path,
+           visibility::text, metadata, created_at, updated_at
+    FROM albums
+    WHERE id = %s AND user_id = %s
+""")
+Q_ALBUM_HAS_RENDITIONS = register_query("albums.has_cover_renditions",
+    "SELECT extract(epoch FROM max(created_at))::bigint FROM image_renditions WHERE owner_kind = 'album' AND owner_id = %s")
+Q_ALBUM_TRACKS = register_query("albums.tracks", """
+    SELECT t.id::text, t.position, COALESCE(t.label, ''), t.variant, m.id::text, m.rel_path, m.duration_sec
+    FROM album_tracks t
+    JOIN media_items m ON m.id = t.media_id
+    WHERE t.album_id = %s
+    ORDER BY t.position
+""")
+
+@app.errorhandler(PoolTimeout)
+def _pool_exhausted(e):
+    # TooManyRequests (max_waiting reached) is a PoolTimeout subclass
+    app.logger.warning("DB pool checkout failed: %s", e)
+    resp = jsonify({"error": "db_busy"})
+    resp.status_code = 503
+    resp.headers["Retry-After"] = "1"
+    return resp
+
+@app.after_request
+def _db_timing_header(response):
+    if g.get("db_checkouts"):
+        response.headers.add("Server-Timing", f'db-wait;dur={g.db_wait_ms:.2f};desc="{g.db_checkouts} checkout(s)"')
+    if g.get("db_queries"):
+        response.headers.add("Server-Timing", f'db;dur={g.db_ms:.2f};desc="{g.db_queries} queries"')
+    return response
+
+# ----------------------------
+# Metrics (Prometheus)
+# ----------------------------
+# Labelled by Flask endpoint (the same names as route_docs.endpoint). Under gunicorn the values
+# live in mmap files in PROMETHEUS_MULTIPROC_DIR (see gunicorn.conf.py) and /metrics merges all
+# workers; without it they are per process. Unmatched URLs are folded into one "<unmatched>" label.
+_LATENCY_BUCKETS = (.0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+METRIC_REQUEST_SECONDS = Histogram(
+    "studio333_http_request_duration_seconds", "Time from before_request to after_request",
+    ["endpoint", "method", "status"], buckets=_LATENCY_BUCKETS)
+METRIC_RESPONSE_BYTES = Histogram(
+    "studio333_http_response_size_bytes", "Response body size (unknown for streamed files)",
+    ["endpoint"], buckets=(256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304, 16777216))
+METRIC_IN_FLIGHT = Gauge(
+    "studio333_http_requests_in_flight", "Requests being handled, per worker (pid label)", multiprocess_mode="liveall")
+METRIC_DB_SECONDS = Histogram(
+    "studio333_db_time_seconds", "Time spent in cursor.execute per request", ["endpoint"],
+    buckets=(.0005, .001, .0025, .005, .01, .025, .05, .1, .25, 1, 5))
+METRIC_DB_QUERIES = Histogram(
+    "studio333_db_queries_per_request", "Statements executed per request", ["endpoint"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 50, 100))
+METRIC_POOL_WAIT = Histogram(
+    "studio333_db_pool_wait_seconds", "Connection checkout wait per request", ["endpoint"],
+    buckets=tuple(b / 1000 for b in POOL_WAIT_BUCKETS_MS))
+METRIC_POOL_TIMEOUTS = Counter(
+    "studio333_db_pool_timeouts_total", "Checkouts that gave up after DB_POOL_TIMEOUT")
+
+def _metrics_endpoint() -> str:
+    return request.endpoint or "<unmatched>"
+
+@app.before_request
+def _metrics_start():
+    g.metrics_t0 = time.perf_counter()
+    METRIC_IN_FLIGHT.inc()
+
+@app.after_request
+def _metrics_observe(response):
+    t0 = g.get("metrics_t0")
+    if t0 is None:
+        return response
+    endpoint = _metrics_endpoint()
+    METRIC_REQUEST_SECONDS.labels(endpoint, request.method, str(response.status_code)).observe(time.perf_counter() - t0)
+    if response.content_length is not None:
+        METRIC_RESPONSE_BYTES.labels(endpoint).observe(response.content_length)
+    METRIC_DB_SECONDS.labels(endpoint).observe(g.get("db_ms", 0.0) / 1000)
+    METRIC_DB_QUERIES.labels(endpoint).observe(g.get("db_queries", 0))
+    if g.get("db_checkouts"):
+        METRIC_POOL_WAIT.labels(endpoint).observe(g.db_wait_ms / 1000)
+    return response
+
+@app.teardown_request
+def _metrics_finish(exc):
+    if g.pop("metrics_t0", None) is not None:
+        METRIC_IN_FLIGHT.dec()
+
+# ----------------------------
+# Sampling profiler (/dev/profile)
+# ----------------------------
+# The profiling request itself samples sys._current_frames() of the other threads in this worker
+# for N seconds and aggregates them into collapsed stacks (flamegraph.pl / speedscope input).
+# Each sample walks every request thread's stack while holding the GIL: roughly 1 µs per frame,
+# i.e. ~0.2 ms per sample for 4 threads x 50 frames, so ~2% of one core at 100 Hz. The sampler
+# measures its own CPU time and halves its rate whenever it exceeds PROFILE_OVERHEAD_BUDGET.
+PROFILE_MAX_SEC         = 30          # stays below gunicorn's worker timeout
+PROFILE_DEFAULT_HZ      = 100
+PROFILE_MAX_HZ          = 250
+PROFILE_OVERHEAD_BUDGET = 0.02        # sampler CPU / wall time
+PROFILE_MAX_DEPTH       = 128
+
+_request_threads: dict[int, str] = {}   # thread ident -> endpoint while a request is handled
+_profile_lock = threading.Lock()
+_frame_labels: dict = {}
+
+@app.before_request
+def _profile_track_thread():
+    _request_threads[threading.get_ident()] = request.endpoint or "<unmatched>"
+
+@app.teardown_request
+def _profile_untrack_thread(exc):
+    _request_threads.pop(threading.get_ident(), None)
+
+def _frame_label(code) -> str:
+    label = _frame_labels.get(code)
+    if label is None:
+        path = code.co_filename
+        if path.startswith(APP_DIR):
+            path = os.path.relpath(path, APP_DIR)
+        else:
+            path = "/".join(path.replace(os.sep, "/").split("/")[-2:])
+        label = _frame_labels[code] = f"{code.co_name} ({path}:{code.co_firstlineno})"
+    return label
+
+def sample_stacks(seconds: float, hz: int = PROFILE_DEFAULT_HZ, endpoint: str | None = None,
+                  include_idle: bool = False) -> dict:
+    """Sample other threads for ``seconds``; returns collapsed stack counts and overhead stats.
+
+    Only threads inside a request are sampled (``endpoint`` narrows that to one Flask endpoint)
+    unless ``include_idle`` also asks for background/idle threads.
+    """
+    me = threading.get_ident()
+    interval = 1.0 / max(1, min(hz, PROFILE_MAX_HZ))
+    stacks: dict[str, int] = {}
+    samples = hits = backoffs = 0
+    t_start = time.perf_counter()
+    cpu_start = time.thread_time()
+    deadline = t_start + seconds
+    while (now := time.perf_counter()) < deadline:
+        for tid, frame in sys._current_frames().items():
+            if tid == me:
+                continue
+            ep = _request_threads.get(tid)
+            if (ep is None and not include_idle) or (endpoint and ep != endpoint):
+                continue
+            labels = []
+            while frame is not None and len(labels) < PROFILE_MAX_DEPTH:
+                labels.append(_frame_label(frame.f_code))
+                frame = frame.f_back
+            labels.append(f"[{ep or 'idle'}]")
+            key = ";".join(reversed(labels))
+            stacks[key] = stacks.get(key, 0) + 1
+            hits += 1
+        samples += 1
+        wall = now - t_start
+        if wall > 0.5 and (time.thread_time() - cpu_start) / wall > PROFILE_OVERHEAD_BUDGET and interval < 0.5:
+            interval *= 2
+            backoffs += 1
+        time.sleep(interval)
+    wall = time.perf_counter() - t_start
+    return {
+        "pid": os.getpid(), "seconds": round(wall, 3), "samples": samples, "thread_samples": hits,
+        "final_hz": round(1.0 / interval, 1), "backoffs": backoffs,
+        "overhead": round((time.thread_time() - cpu_start) / wall, 4) if wall else 0.0,
+        "stacks": stacks,
+    }
+
+@app.route("/metrics", methods=["GET"])
+@cache_policy("no-store")
+def metrics():
+    """Prometheus exposition of request/DB/pool metrics, merged across gunicorn workers."""
+    if METRICS_TOKEN:
+        if not hmac.compare_digest(request.headers.get("Authorization", "").encode(), f"Bearer {METRICS_TOKEN}".encode()):
+            return jsonify({"error": "Forbidden"}), 403
+    elif not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        prom_multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    resp = make_response(generate_latest(registry))
+    resp.headers["Content-Type"] = CONTENT_TYPE_LATEST
+    return resp
 
 def query_one(sql_txt, params=()):
     with get_conn() as conn, conn.cursor() as cur:
@@ -81,35 +897,217 @@ def execute(sql_txt, params=()):
         cur.execute(sql_txt, params)
         conn.commit()
 
+def warm_pool(timeout: float = DB_POOL_WARM_TIMEOUT) -> bool:
+    """Open this process's pool and block until min_size connections are up (gunicorn post_worker_init)."""
+    init_pool()
+    t0 = time.monotonic()
+    try:
+        _pool.wait(timeout=timeout)
+    except PoolTimeout:
+        app.logger.warning("DB pool not warm after %.1fs (pid %s); serving anyway", timeout, os.getpid())
+        return False
+    app.logger.info("DB pool warm: %s connection(s) in %.0f ms (pid %s)",
+                    DB_MIN_CONN, (time.monotonic() - t0) * 1000, os.getpid())
+    return True
+
+def shutdown_worker(timeout: float = 10.0) -> None:
+    """Drain background work and close the pool; safe to call twice (worker_exit, then atexit)."""
+    global _pool
+    try:
+        flush_activity_log()
+    except Exception:
+        pass
+    try:
+        if _image_executor is not None and _image_executor_pid == os.getpid():
+            _image_executor.shutdown(wait=True)
+    except Exception:
+        pass
+    try:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close(timeout=timeout)
+        _pool = None
+    except Exception:
+        pass
+
 @atexit.register
 def _close_pool_on_exit():
-    global _pool
+    shutdown_worker()
+
+# ----------------------------
+# Activity log writer
+# ----------------------------
+# log_user_activity() only enqueues; one flusher thread per worker COPYs rows in batches
+# of ACTIVITY_BATCH_SIZE or every ACTIVITY_FLUSH_SEC, whichever comes first.
+_activity_queue: queue.Queue = queue.Queue(maxsize=ACTIVITY_QUEUE_MAX)
+_activity_thread: threading.Thread | None = None
+_activity_pid = None
+_activity_stop = threading.Event()
+_activity_lock = threading.Lock()
+_activity_stats = {"enqueued": 0, "written": 0, "dropped": 0, "failed": 0, "batches": 0}
+
+def _activity_count(key, n=1):
+    with _activity_lock:
+        _activity_stats[key] += n
+
+def _write_activity_batch(rows):
     try:
-        if _pool is not None:
-            _pool.close()
+        with get_conn() as conn, conn.cursor() as cur:
+            with cur.copy(
+                "COPY user_activity_log (user_id, activity_type, user_agent, ip_address, context, timestamp) "
+                "FROM STDIN"
+            ) as cp:
+                for row in rows:
+                    cp.write_row(row)
+            conn.commit()
+        _activity_count("written", len(rows))
+        _activity_count("batches")
     except Exception:
+        logging.exception("user_activity_log: failed to write %d rows", len(rows))
+        _activity_count("failed", len(rows))
+
+def _activity_flusher():
+    while True:
+        batch = []
+        deadline = None
+        while len(batch) < ACTIVITY_BATCH_SIZE:
+            timeout = ACTIVITY_FLUSH_SEC if deadline is None else deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = _activity_queue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                break
+            batch.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + ACTIVITY_FLUSH_SEC
+        if _activity_stop.is_set():
+            while True:
+                try:
+                    item = _activity_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is not None:
+                    batch.append(item)
+            for i in range(0, len(batch), ACTIVITY_BATCH_SIZE):
+                _write_activity_batch(batch[i:i + ACTIVITY_BATCH_SIZE])
+            return
+        if batch:
+            _write_activity_batch(batch)
+
+def _ensure_activity_thread():
+    global _activity_thread, _activity_pid
+    # Threads do not survive fork(); start one lazily in each worker.
+    if _activity_thread is not None and _activity_pid == os.getpid() and _activity_thread.is_alive():
+        return
+    with _activity_lock:
+        if _activity_thread is not None and _activity_pid == os.getpid() and _activity_thread.is_alive():
+            return
+        _activity_stop.clear()
+        _activity_pid = os.getpid()
+        _activity_thread = threading.Thread(target=_activity_flusher, name="activity-log-flusher", daemon=True)
+        _activity_thread.start()
+
+def enqueue_activity(user_id, activity_type, user_agent, ip_address, context=None):
+    row = (
+        user_id, activity_type, user_agent, ip_address,
+        json.dumps(context) if context is not None else None,
+        datetime.now(timezone.utc),
+    )
+    _ensure_activity_thread()
+    try:
+        _activity_queue.put_nowait(row)
+        _activity_count("enqueued")
+    except queue.Full:
+        _activity_count("dropped")
+
+def flush_activity_log(timeout=5.0):
+    if _activity_thread is None or _activity_pid != os.getpid() or not _activity_thread.is_alive():
+        return
+    _activity_stop.set()
+    try:
+        _activity_queue.put_nowait(None)
+    except queue.Full:
         pass
+    _activity_thread.join(timeout)
+
+def activity_log_stats():
+    with _activity_lock:
+        out = dict(_activity_stats)
+    out["backlog"] = _activity_queue.qsize()
+    return out
 
 # ----------------------------
 # Helpers
 # ----------------------------
-def nocache(resp):
-    resp.headers["Cache-Control"] = "no-store, no-cache, must-revalidate, max-age=0"
-    resp.headers["Pragma"] = "no-cache"
-    resp.headers["Expires"] = "0"
-    return resp
-
 def current_user_id():
     return session.get("user_id")
 
-def current_user_role():
-    uid = current_user_id()
+# Identity: users + profiles in one query, memoized on flask.g for the request and in a small
+# TTL/LRU dict for the process. Call invalidate_identity() after writing users/profiles rows.
+_identity_cache: "OrderedDict[int, tuple[float, dict]]" = OrderedDict()
+_identity_lock = threading.Lock()
+
+def _load_identity(cur, user_id):
+    row = run_query(cur, Q_IDENTITY, (user_id,)).fetchone()
+    if not row:
+        return None
+    return {
+        "id": row[0],
+        "email": row[1],
+        "role": row[2],
+        "nickname": row[3],
+        "last_login": row[4],
+        "avatar": row[5],
+    }
+
+def get_identity(user_id=None, cur=None):
+    uid = user_id or current_user_id()
     if not uid:
         return None
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT role FROM users WHERE id=%s AND is_deleted=false", (uid,))
-        row = cur.fetchone()
-        return row[0] if row else None
+    cached = g.get("identity")
+    if cached is not None and cached["id"] == uid:
+        return cached
+
+    now = time.monotonic()
+    with _identity_lock:
+        hit = _identity_cache.get(uid)
+        if hit and hit[0] > now:
+            _identity_cache.move_to_end(uid)
+            g.identity = hit[1]
+            return hit[1]
+
+    if cur is not None:
+        ident = _load_identity(cur, uid)
+    else:
+        with get_conn() as conn, conn.cursor() as c:
+            ident = _load_identity(c, uid)
+    if ident is None:
+        invalidate_identity(uid)
+        return None
+
+    with _identity_lock:
+        _identity_cache[uid] = (now + IDENTITY_CACHE_TTL_SEC, ident)
+        _identity_cache.move_to_end(uid)
+        while len(_identity_cache) > IDENTITY_CACHE_MAX:
+            _identity_cache.popitem(last=False)
+    g.identity = ident
+    return ident
+
+def invalidate_identity(user_id):
+    with _identity_lock:
+        _identity_cache.pop(user_id, None)
+    try:
+        ident = g.get("identity")
+        if ident is not None and ident["id"] == user_id:
+            g.pop("identity")
+    except RuntimeError:
+        pass  # outside an app context (CLI)
+
+def current_user_role():
+    ident = get_identity()
+    return ident["role"] if ident else None
 
 def is_admin():
     role = current_user_role()
@@ -140,20 +1138,20 @@ def require_login(fn):
         return fn(*args, **kwargs)
     return _wrapped
 
+def client_ip() -> str:
+    """Peer address as seen by our own proxy (used by the audit log and login throttling)."""
+    # nginx appends the peer address; the rightmost X-Forwarded-For entry is the one it vouches
+    # for, anything to its left is client-supplied.
+    xff = request.headers.get("X-Forwarded-For", "")
+    return xff.rsplit(",", 1)[-1].strip() if xff else request.remote_addr
+
 def log_user_activity(user_id, activity_type, context=None):
     try:
         ua = (request.user_agent.string or "")[:500]
-        xff = request.headers.get("X-Forwarded-For", "")
-        ip = xff.split(",")[0].strip() if xff else request.remote_addr
+        ip = client_ip()
     except Exception:
         ua, ip = "", None
-    execute(
-        """
-        INSERT INTO user_activity_log (user_id, activity_type, user_agent, ip_address, context)
-        VALUES (%s, %s, %s, %s, %s)
-        """,
-        (user_id, activity_type, ua, ip, PgJson(context) if context is not None else None),
-    )
+    enqueue_activity(user_id, activity_type, ua, ip, context)
 
 _slug_re = re.compile(r'[^a-z0-9]+')
 
@@ -162,15 +1160,32 @@ def make_slug(title: str) -> str:
     s = _slug_re.sub("-", s).strip("-")
     return s or "album"
 
-def unique_album_slug(cur, user_id: int, base: str) -> str:
-    slug = base
-    n = 2
-    while True:
-        cur.execute("SELECT 1 FROM albums WHERE user_id=%s AND slug=%s LIMIT 1", (user_id, slug))
-        if not cur.fetchone():
-            return slug
-        slug = f"{base}-{n}"
-        n += 1
+# Next free slug, evaluated inside the INSERT: `base` if unused, else `base-N` with N one past the
+# highest numeric suffix (at most 9 digits, so the ::int cast can't overflow on a title that ends
+# in a long number). Racing inserts are resolved by ON CONFLICT + retry (under an advisory lock on
+# the base after the first miss). Slugs are allocated per user once `initdb --per-user-slugs` has
+# dropped the global albums_slug_key, and across all users while it is still there.
+# Expects %(uid)s and %(base)s; make_slug() output is [a-z0-9-] only, so it is regex-safe.
+NEXT_ALBUM_SLUG_SQL = """
+CASE WHEN NOT EXISTS (SELECT 1 FROM albums WHERE {owner} slug = %(base)s)
+     THEN %(base)s
+     ELSE %(base)s || '-' || (
+        SELECT COALESCE(MAX(substring(slug::text FROM '-([0-9]{{1,9}})$')::int), 1) + 1
+        FROM albums
+        WHERE {owner} slug::text ~ ('^' || %(base)s || '-[0-9]{{1,9}}$')
+     )
+END
+"""
+_album_slugs_global: bool | None = None   # albums_slug_key present; checked once per process
+
+def next_album_slug_sql(cur) -> str:
+    global _album_slugs_global
+    if _album_slugs_global is None:
+        cur.execute("SELECT to_regclass('albums_slug_key') IS NOT NULL")
+        _album_slugs_global = bool(cur.fetchone()[0])
+    return NEXT_ALBUM_SLUG_SQL.format(owner="" if _album_slugs_global else "user_id = %(uid)s AND")
+
+SLUG_INSERT_ATTEMPTS = 5
 
 def normalize_media_url(url_str: str | None) -> str | None:
     if not url_str:
@@ -187,6 +1202,304 @@ def normalize_media_url(url_str: str | None) -> str | None:
         return parsed.path or "/"
     return s
 
+# ----------------------------
+# Image uploads & renditions
+# ----------------------------
+# Uploads are validated (header only) and stored untouched on the request thread; a per-worker
+# thread pool then writes IMAGE_RENDITION_WIDTHS in WebP and JPEG under static/renditions/ and
+# records them in image_renditions. The owner is pointed at /img/<kind>/<id>/512 right away, which
+# serves a placeholder until the renditions exist; image_uploads holds each owner's current
+# original, so a replaced one can be deleted and a superseded render job can tell it lost.
+_image_executor: ThreadPoolExecutor | None = None
+_image_executor_pid = None
+_image_lock = threading.Lock()
+
+def _get_image_executor() -> ThreadPoolExecutor:
+    global _image_executor, _image_executor_pid
+    with _image_lock:
+        if _image_executor is None or _image_executor_pid != os.getpid():
+            _image_executor = ThreadPoolExecutor(max_workers=IMAGE_WORKERS, thread_name_prefix="image-render")
+            _image_executor_pid = os.getpid()
+        return _image_executor
+
+def save_image_upload(file_storage, folder: str, stem: str):
+    """Store an uploaded image under static/<folder>/; returns (url, fs path) or None if not an image."""
+    data = file_storage.stream.read(IMAGE_UPLOAD_MAX_BYTES + 1)
+    if len(data) > IMAGE_UPLOAD_MAX_BYTES:
+        raise ValueError("too_large")
+    from PIL import Image  # lazy: Pillow (and the numpy it pulls in) costs ~80 ms per worker boot
+    try:
+        with Image.open(BytesIO(data)) as probe:
+            fmt = (probe.format or "").lower()
+    except Exception:
+        return None
+    ext = {"jpeg": ".jpg", "png": ".png", "webp": ".webp", "gif": ".gif"}.get(fmt, ".img")
+    digest = hashlib.sha1(data).hexdigest()[:12]
+    fname = secure_filename(f"{stem}-{digest}{ext}")
+    root = os.path.join(app.static_folder, folder)
+    os.makedirs(root, exist_ok=True)
+    path_fs = os.path.join(root, fname)
+    with open(path_fs, "wb") as fh:
+        fh.write(data)
+    return f"/static/{folder}/{fname}", path_fs
+
+def owner_image_url(owner_kind: str, owner_id) -> str:
+    """What albums.cover_path / profiles.avatar store for an uploaded image (see image_rendition)."""
+    return f"/img/{owner_kind}/{owner_id}/{IMAGE_MAIN_WIDTH}"
+
+def record_image_upload(cur, owner_kind: str, owner_id, src_url: str) -> str | None:
+    """Make `src_url` the owner's current original; returns the original it replaces, if that
+    one is no longer referenced anywhere (delete it with remove_image_upload after commit)."""
+    cur.execute("SELECT path FROM image_uploads WHERE owner_kind=%s AND owner_id=%s FOR UPDATE",
+                (owner_kind, str(owner_id)))
+    row = cur.fetchone()
+    cur.execute(
+        """
+        INSERT INTO image_uploads (owner_kind, owner_id, path) VALUES (%s, %s, %s)
+        ON CONFLICT (owner_kind, owner_id) DO UPDATE SET path = EXCLUDED.path, uploaded_at = now()
+        """,
+        (owner_kind, str(owner_id), src_url),
+    )
+    if not row or row[0] == src_url:
+        return None
+    # covers/avatars stored before image_uploads existed (and their clones) may still link it
+    cur.execute("SELECT EXISTS (SELECT 1 FROM albums WHERE cover_path = %s)"
+                " OR EXISTS (SELECT 1 FROM profiles WHERE avatar = %s)", (row[0], row[0]))
+    return None if cur.fetchone()[0] else row[0]
+
+def remove_image_upload(src_url: str | None) -> None:
+    if not src_url or not src_url.startswith("/static/"):
+        return
+    path_fs = safe_join(app.static_folder, src_url[len("/static/"):])
+    try:
+        if path_fs:
+            os.remove(path_fs)
+    except OSError:
+        pass
+
+def _render_image(owner_kind: str, owner_id: str, src_fs: str, src_url: str) -> None:
+    stem = os.path.splitext(os.path.basename(src_fs))[0]
+    out_dir = os.path.join(app.static_folder, "renditions", owner_kind)
+    os.makedirs(out_dir, exist_ok=True)
+    from PIL import Image, ImageOps
+    rows = []
+    try:
+        im = Image.open(src_fs)
+    except FileNotFoundError:
+        return   # replaced (and deleted) by a newer upload before this job ran
+    with im:
+        im = ImageOps.exif_transpose(im)
+        rgb = im.convert("RGB")
+        longest = max(rgb.size)
+        for width in IMAGE_RENDITION_WIDTHS:
+            if width > longest and width != IMAGE_RENDITION_WIDTHS[0]:
+                continue
+            copy = rgb.copy()
+            copy.thumbnail((width, width), Image.LANCZOS)
+            for fmt, ext, opts in (("webp", "webp", {"quality": 80, "method": 4}),
+                                   ("jpeg", "jpg", {"quality": 82, "progressive": True})):
+                fname = f"{stem}-{width}.{ext}"
+                path_fs = os.path.join(out_dir, fname)
+                copy.save(path_fs, format=fmt.upper(), **opts)
+                rows.append((width, fmt, f"renditions/{owner_kind}/{fname}", os.path.getsize(path_fs)))
+
+    with get_conn() as conn, conn.cursor() as cur:
+        # Only publish if this is still the owner's latest upload; the row lock orders racing jobs.
+        cur.execute("SELECT path FROM image_uploads WHERE owner_kind=%s AND owner_id=%s FOR UPDATE",
+                    (owner_kind, owner_id))
+        current = cur.fetchone()
+        if current is None or current[0] != src_url:
+            conn.rollback()
+            stale = {r[2] for r in rows}
+        else:
+            cur.execute("DELETE FROM image_renditions WHERE owner_kind=%s AND owner_id=%s RETURNING path",
+                        (owner_kind, owner_id))
+            stale = {r[0] for r in cur.fetchall()} - {r[2] for r in rows}
+            cur.executemany(
+                "INSERT INTO image_renditions (owner_kind, owner_id, width, format, path, bytes) VALUES (%s,%s,%s,%s,%s,%s)",
+                [(owner_kind, owner_id) + r for r in rows],
+            )
+            conn.commit()
+    for rel in stale:
+        try:
+            os.remove(os.path.join(app.static_folder, rel))
+        except OSError:
+            pass
+
+def _render_image_job(*args):
+    try:
+        _render_image(*args)
+    except Exception:
+        logging.exception("image rendition failed for %s/%s", args[0], args[1])
+
+def queue_image_renditions(owner_kind: str, owner_id, src_fs: str, src_url: str) -> None:
+    _get_image_executor().submit(_render_image_job, owner_kind, str(owner_id), src_fs, src_url)
+
+def rendition_srcset(owner_kind: str, owner_id, version=None) -> str:
+    """`version` (epoch of the current rendition set) makes the URLs cacheable as immutable."""
+    v = f"?v={version}" if version else ""
+    return ", ".join(f"/img/{owner_kind}/{owner_id}/{w}{v} {w}w" for w in IMAGE_RENDITION_WIDTHS)
+
+# ----------------------------
+# Sessions
+# ----------------------------
+# Requests to these endpoints never read or write the session: no DB/store lookup, no
+# Set-Cookie and no "Vary: Cookie" on cacheable media.
+SESSIONLESS_ENDPOINTS = frozenset({
+    "static", "media", "media_peaks", "media_stream", "rendition_file", "image_rendition",
+})
+
+SESSIONS_SQL = """
+CREATE UNLOGGED TABLE IF NOT EXISTS http_sessions (
+  sid TEXT PRIMARY KEY,
+  data TEXT NOT NULL,
+  expires_at TIMESTAMPTZ NOT NULL
+);
+CREATE INDEX IF NOT EXISTS http_sessions_expires_idx ON http_sessions (expires_at);
+"""
+
+class PgSessionStore:
+    purge_every_sec = 300
+
+    def __init__(self):
+        self._last_purge = 0.0
+
+    def load(self, sid):
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT data FROM http_sessions WHERE sid = %s AND expires_at > now()", (sid,))
+            row = cur.fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, ttl_sec):
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                INSERT INTO http_sessions (sid, data, expires_at) VALUES (%s, %s, now() + make_interval(secs => %s))
+                ON CONFLICT (sid) DO UPDATE SET data = EXCLUDED.data, expires_at = EXCLUDED.expires_at
+                """,
+                (sid, data, ttl_sec),
+            )
+            if time.monotonic() - self._last_purge > self.purge_every_sec:
+                self._last_purge = time.monotonic()
+                cur.execute("DELETE FROM http_sessions WHERE expires_at < now()")
+            conn.commit()
+
+    def delete(self, sid):
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM http_sessions WHERE sid = %s", (sid,))
+            conn.commit()
+
+class ShmSessionStore:
+    """SQLite on tmpfs: shared by every worker on the host, gone after a reboot."""
+    purge_every_sec = 300
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._last_purge = 0.0
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None or self._local.pid != os.getpid():
+            import sqlite3
+            db = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute("PRAGMA synchronous=OFF")
+            db.execute("CREATE TABLE IF NOT EXISTS http_sessions (sid TEXT PRIMARY KEY, data TEXT NOT NULL, expires_at REAL NOT NULL)")
+            self._local.db, self._local.pid = db, os.getpid()
+        return db
+
+    def load(self, sid):
+        row = self._db().execute("SELECT data FROM http_sessions WHERE sid = ? AND expires_at > ?",
+                                 (sid, time.time())).fetchone()
+        return row[0] if row else None
+
+    def save(self, sid, data, ttl_sec):
+        db = self._db()
+        db.execute("INSERT OR REPLACE INTO http_sessions (sid, data, expires_at) VALUES (?, ?, ?)",
+                   (sid, data, time.time() + ttl_sec))
+        if time.monotonic() - self._last_purge > self.purge_every_sec:
+            self._last_purge = time.monotonic()
+            db.execute("DELETE FROM http_sessions WHERE expires_at < ?", (time.time(),))
+
+    def delete(self, sid):
+        self._db().execute("DELETE FROM http_sessions WHERE sid = ?", (sid,))
+
+class ServerSession(SecureCookieSession):
+    def __init__(self, initial=None, sid=None):
+        super().__init__(initial)
+        self.sid = sid
+        self.loaded_user_id = (initial or {}).get("user_id")
+
+class ServerSessionInterface(SessionInterface):
+    """Session data in a store; the cookie carries only a signed random id.
+
+    The id is rotated whenever the logged-in user changes (login/logout), so a pre-login id
+    can't be fixed on a victim. The store is only written when the session was modified.
+    """
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store):
+        self.store = store
+
+    def _signer(self, app):
+        return Signer(app.secret_key, salt="studio333-session-id")
+
+    @staticmethod
+    def _endpoint(app, request):
+        # open_session runs before Flask matches the URL, so request.endpoint is still None here
+        try:
+            return app.create_url_adapter(request).match()[0]
+        except HTTPException:
+            return None
+
+    def open_session(self, app, request):
+        raw = request.cookies.get(self.get_cookie_name(app))
+        if not raw or self._endpoint(app, request) in SESSIONLESS_ENDPOINTS:
+            return ServerSession()
+        try:
+            sid = self._signer(app).unsign(raw).decode()
+        except BadSignature:
+            return ServerSession()
+        data = self.store.load(sid)
+        if data is None:
+            return ServerSession()
+        try:
+            return ServerSession(self.serializer.loads(data), sid=sid)
+        except ValueError:
+            return ServerSession()
+
+    def save_session(self, app, session, response):
+        name, domain, path = self.get_cookie_name(app), self.get_cookie_domain(app), self.get_cookie_path(app)
+        if session.accessed:
+            response.vary.add("Cookie")
+        if not session:
+            if session.sid and session.modified:
+                self.store.delete(session.sid)
+                response.delete_cookie(name, domain=domain, path=path)
+            return
+        if not session.modified and session.sid:
+            return
+        rotate = session.sid is None or session.get("user_id") != session.loaded_user_id
+        if rotate and session.sid:
+            self.store.delete(session.sid)
+        if rotate:
+            session.sid = secrets.token_urlsafe(32)
+        ttl = int(app.permanent_session_lifetime.total_seconds())
+        self.store.save(session.sid, self.serializer.dumps(dict(session)), ttl)
+        if rotate:
+            response.set_cookie(
+                name, self._signer(app).sign(session.sid).decode(),
+                max_age=ttl if session.permanent else None, domain=domain, path=path,
+                httponly=self.get_cookie_httponly(app), secure=self.get_cookie_secure(app),
+                samesite=self.get_cookie_samesite(app),
+            )
+
+if SESSION_STORE == "postgres":
+    app.session_interface = ServerSessionInterface(PgSessionStore())
+elif SESSION_STORE == "shm":
+    app.session_interface = ServerSessionInterface(ShmSessionStore(SESSION_SHM_PATH))
+
 # ----------------------------
 # Auth helpers (enhanced timeout)
 # ----------------------------
@@ -222,28 +1535,139 @@ def _refresh_last_active(now_ts: float) -> None:
 
 @app.before_request
 def enforce_session_timeout():
-    if not session.get("user_id"):
+    if request.endpoint in SESSIONLESS_ENDPOINTS or not session.get("user_id"):
         return
-    timeout = int(session.get("session_timeout", 0) or 0)
-    last = session.get("last_active")
-    now = time.time()
-    if timeout and last and (now - last) > timeout:
+    now = _now_ts()
+    if _expired_by_idle(now) or _expired_by_absolute(now):
         uid = session.get("user_id")
         session.clear()
         if uid: log_user_activity(uid, "session_expired")
         flash("Session expired.", "info")
         return redirect(url_for("bart"))
-    session["last_active"] = now
+    _refresh_last_active(now)
+
+# ----------------------------
+# Login throttling & password hashing
+# ----------------------------
+# Sliding-window counter: the previous fixed window's count weighted by how much of it still
+# overlaps the sliding window, plus the current window's count. Two integers per key.
+LOGIN_THROTTLE_SQL = """
+CREATE UNLOGGED TABLE IF NOT EXISTS login_throttle (
+  key TEXT NOT NULL,
+  window_start TIMESTAMPTZ NOT NULL,
+  hits INTEGER NOT NULL,
+  PRIMARY KEY (key, window_start)
+);
+"""
+
+METRIC_LOGIN_REJECTED = Counter(
+    "studio333_login_rejected_total", "Login attempts refused before hashing", ["reason"])
+METRIC_LOGIN_ATTEMPTS = Counter(
+    "studio333_login_attempts_total", "Login attempts that reached the password check", ["result"])
+
+_throttle: dict[str, list] = {}   # key -> [window_index, current_hits, previous_hits]
+_throttle_lock = threading.Lock()
+_throttle_last_sweep = 0.0
+_hash_slots = threading.BoundedSemaphore(LOGIN_HASH_SLOTS)
+
+class LoginThrottled(Exception):
+    def __init__(self, reason: str, retry_after: int):
+        super().__init__(reason)
+        self.reason, self.retry_after = reason, retry_after
+
+def _sliding_estimate(cur_hits: int, prev_hits: int, into_window: float) -> float:
+    return prev_hits * max(0.0, 1.0 - into_window / LOGIN_WINDOW_SEC) + cur_hits
+
+def _local_hits(key: str, add: int) -> float:
+    global _throttle_last_sweep
+    now = time.time()
+    idx, into = divmod(now, LOGIN_WINDOW_SEC)
+    with _throttle_lock:
+        slot = _throttle.get(key)
+        if slot is None or slot[0] < idx - 1:
+            slot = _throttle[key] = [idx, 0, 0]
+        elif slot[0] == idx - 1:
+            slot[:] = [idx, 0, slot[1]]
+        slot[1] += add
+        estimate = _sliding_estimate(slot[1], slot[2], into)
+        if now - _throttle_last_sweep > LOGIN_WINDOW_SEC:
+            _throttle_last_sweep = now
+            for k in [k for k, v in _throttle.items() if v[0] < idx - 1]:
+                del _throttle[k]
+    return estimate
+
+def _shared_hits(key: str, add: int) -> float | None:
+    """Cross-worker estimate from login_throttle; None when the DB is unavailable."""
+    try:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                WITH w AS (
+                  SELECT to_timestamp(floor(extract(epoch FROM now()) / %(win)s) * %(win)s) AS start
+                ), up AS (
+                  INSERT INTO login_throttle (key, window_start, hits)
+                  SELECT %(key)s, w.start, %(add)s FROM w
+                  ON CONFLICT (key, window_start) DO UPDATE SET hits = login_throttle.hits + EXCLUDED.hits
+                  RETURNING window_start, hits
+                )
+                SELECT up.hits,
+                       COALESCE((SELECT p.hits FROM login_throttle p
+                                 WHERE p.key = %(key)s AND p.window_start = up.window_start - make_interval(secs => %(win)s)), 0),
+                       extract(epoch FROM now() - up.window_start)::float8
+                FROM up
+                """,
+                {"key": key, "add": add, "win": LOGIN_WINDOW_SEC},
+            )
+            cur_hits, prev_hits, into = cur.fetchone()
+            if random.random() < 0.01:
+                cur.execute("DELETE FROM login_throttle WHERE window_start < now() - make_interval(secs => %s)",
+                            (2 * LOGIN_WINDOW_SEC,))
+            conn.commit()
+        return _sliding_estimate(cur_hits, prev_hits, into)
+    except (psycopg.Error, PoolTimeout):
+        return None
+
+def _throttle_hit(key: str, add: int) -> float:
+    local = _local_hits(key, add)
+    if not LOGIN_THROTTLE_SHARED:
+        return local
+    shared = _shared_hits(key, add)
+    return local if shared is None else max(local, shared)
+
+def check_login_throttle(email: str) -> None:
+    """Count this attempt against the IP and refuse (LoginThrottled) if the IP or email is over its limit."""
+    retry = LOGIN_WINDOW_SEC - int(time.time() % LOGIN_WINDOW_SEC) + 1
+    if _throttle_hit(f"ip:{client_ip()}", 1) > LOGIN_MAX_PER_IP:
+        METRIC_LOGIN_REJECTED.labels("ip").inc()
+        raise LoginThrottled("ip", retry)
+    if email and _throttle_hit(f"email:{email}", 0) >= LOGIN_MAX_FAILS_PER_EMAIL:
+        METRIC_LOGIN_REJECTED.labels("email").inc()
+        raise LoginThrottled("email", retry)
+
+def note_login_failure(email: str) -> None:
+    if email:
+        _throttle_hit(f"email:{email}", 1)
+
+def verify_password(pw_hash: str, password: str) -> bool:
+    """check_password_hash on the request thread, at most LOGIN_HASH_SLOTS at a time per worker;
+    LoginThrottled("hash_busy") when they are all taken."""
+    if not _hash_slots.acquire(blocking=False):
+        METRIC_LOGIN_REJECTED.labels("hash_busy").inc()
+        raise LoginThrottled("hash_busy", 1)
+    try:
+        return check_password_hash(pw_hash, password)
+    finally:
+        _hash_slots.release()
 
 # ----------------------------
 # Routes
 # ----------------------------
 @app.route("/")
 def index():
-    resp = make_response(render_template("index.html", logged_in=bool(session.get("user_id"))))
-    return nocache(resp)
+    return render_template("index.html", logged_in=bool(session.get("user_id")))
 
 @app.route("/bart", methods=["GET", "POST"])
+@cache_policy("no-store")
 def bart():
     if request.method == "GET" and session.get("user_id"):
         session.clear()
@@ -255,13 +1679,17 @@ def bart():
         email = (request.form.get("email") or "").strip().lower()
         password = (request.form.get("password") or "").strip()
 
-        row = query_one("""
-            SELECT id, password_hash, role, nickname
-            FROM users
-            WHERE email = %s AND is_verified = TRUE AND is_deleted = FALSE
-        """, (email,))
+        try:
+            check_login_throttle(email)
+            with get_conn() as conn, conn.cursor() as cur:
+                row = run_query(cur, Q_BART_LOOKUP, (email,)).fetchone()
+            ok = bool(row) and verify_password(row[1], password)
+        except LoginThrottled:
+            flash("Too many login attempts. Try again in a few minutes.", "error")
+            return redirect(url_for("bart"))
+        METRIC_LOGIN_ATTEMPTS.labels("ok" if ok else ("bad_password" if row else "no_user")).inc()
 
-        if row and check_password_hash(row[1], password):
+        if ok:
             user_id, _, role, nickname = row
 
             chosen_min = int(request.form.get("timeout", 0) or 0)
@@ -283,7 +1711,10 @@ def bart():
                 log_user_activity(user_id, "login")
             except Exception:
                 pass
-            execute("UPDATE users SET last_login = NOW() WHERE id = %s", (user_id,))
+            with get_conn() as conn, conn.cursor() as cur:
+                run_query(cur, Q_TOUCH_LAST_LOGIN, (user_id,))
+                conn.commit()
+            invalidate_identity(user_id)
 
             try:
                 app.permanent_session_lifetime = timedelta(seconds=_absolute_lifetime_sec())
@@ -294,6 +1725,7 @@ def bart():
             return redirect(url_for("dashboard"))
         else:
             session["login_failures"] = session.get("login_failures", 0) + 1
+            note_login_failure(email)
             try:
                 if row:
                     log_user_activity(row[0], "login_failed")
@@ -302,10 +1734,10 @@ def bart():
             flash("Invalid email or password", "error")
             return redirect(url_for("bart"))
 
-    resp = make_response(render_template("bart.html"))
-    return nocache(resp)
+    return render_template("bart.html")
 
 @app.route("/puzzle")
+@cache_policy("no-store")
 def puzzle():
     return render_template("puzzle.html")
 
@@ -332,18 +1764,21 @@ def edit_user_profile():
             github     = request.form.get('github', '').strip()
 
             avatar_file = request.files.get('avatar_file')
+            avatar_upload = None
             if avatar_file and avatar_file.filename:
                 safe_nick = nickname or f"user{user_id}"
-                filename = secure_filename(f"{safe_nick}_{uuid.uuid4().hex}.jpg")
-                upload_path = os.path.join('static', 'avatars', filename)
-                os.makedirs(os.path.dirname(upload_path), exist_ok=True)
-
-                img = Image.open(avatar_file.stream).convert('RGB')
-                img.thumbnail((512, 512), Image.LANCZOS)
-                img.save(upload_path, format='JPEG', quality=85, optimize=True)
-
-                avatar_url = f"/static/avatars/{filename}"
-
+                try:
+                    avatar_upload = save_image_upload(avatar_file, "avatars", safe_nick)
+                except ValueError:
+                    avatar_upload = None
+                if avatar_upload is None:
+                    flash("Avatar must be an image under the upload size limit", "error")
+                    return redirect(url_for('edit_user_profile'))
+                avatar_url = owner_image_url("avatar", user_id)
+
+            replaced = None
+            if avatar_upload:
+                replaced = record_image_upload(cur, "avatar", user_id, avatar_upload[0])
             if nickname:
                 cur.execute("UPDATE users SET nickname = %s WHERE id = %s", (nickname, user_id))
 
@@ -362,6 +1797,10 @@ def edit_user_profile():
                 """, (user_id, avatar_url, bio, phone, homepage, twitter, linkedin, github))
 
             conn.commit()
+            invalidate_identity(user_id)
+            if avatar_upload:
+                remove_image_upload(replaced)
+                queue_image_renditions("avatar", user_id, avatar_upload[1], avatar_upload[0])
             flash("Profile updated successfully", "success")
             try:
                 log_user_activity(user_id, 'profile_updated')
@@ -454,7 +1893,175 @@ CREATE TABLE IF NOT EXISTS invitation_codes (
   used_at TIMESTAMPTZ,
   expires_at TIMESTAMPTZ
 );
+"""
+
+# Albums/media tables. The part up to the albums_simple view reproduces the production dump
+# (backup-db-dev/studio333_backup_20251106_014327.dump); everything after it is added by later
+# features. Idempotent, so initdb brings both a fresh DB and production up to date.
+ALBUMS_SCHEMA_SQL = """
+CREATE EXTENSION IF NOT EXISTS citext;
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+DO $$ BEGIN
+  CREATE TYPE visibility_enum AS ENUM ('private', 'unlisted', 'public');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+
+DO $$ BEGIN
+  CREATE TYPE media_kind_enum AS ENUM ('audio', 'video', 'image', 'hls', 'dash', 'document', 'other');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+
+DO $$ BEGIN
+  CREATE DOMAIN slug AS TEXT CHECK (VALUE ~ '^[a-z0-9]+(?:-[a-z0-9]+)*$');
+EXCEPTION WHEN duplicate_object THEN NULL; END $$;
+
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  NEW.updated_at := now();
+  RETURN NEW;
+END$$;
+
+CREATE OR REPLACE FUNCTION touch_album_tracks_updated_at() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+  NEW.updated_at := now();
+  RETURN NEW;
+END;
+$$;
+
+CREATE TABLE IF NOT EXISTS albums (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  slug CITEXT NOT NULL UNIQUE,
+  title TEXT NOT NULL,
+  subtitle TEXT,
+  description_md TEXT NOT NULL DEFAULT '',
+  cover_path TEXT,
+  visibility visibility_enum NOT NULL DEFAULT 'private',
+  release_date DATE,
+  published_at TIMESTAMPTZ,
+  metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  user_id INTEGER REFERENCES users(id) ON DELETE SET NULL
+);
 
+CREATE TABLE IF NOT EXISTS media_items (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  album_id UUID REFERENCES albums(id) ON DELETE SET NULL,
+  kind media_kind_enum NOT NULL,
+  slug CITEXT UNIQUE,
+  title TEXT NOT NULL,
+  description_md TEXT NOT NULL DEFAULT '',
+  cover_path TEXT,
+  rel_path TEXT,
+  duration_sec INTEGER CHECK (duration_sec IS NULL OR duration_sec >= 0),
+  size_bytes BIGINT CHECK (size_bytes IS NULL OR size_bytes >= 0),
+  codec TEXT,
+  bitrate_kbps INTEGER CHECK (bitrate_kbps IS NULL OR bitrate_kbps >= 0),
+  sample_rate_hz INTEGER CHECK (sample_rate_hz IS NULL OR sample_rate_hz >= 0),
+  disc_no INTEGER NOT NULL DEFAULT 1,
+  track_no INTEGER NOT NULL DEFAULT 1,
+  published_at TIMESTAMPTZ,
+  visibility visibility_enum NOT NULL DEFAULT 'private',
+  metadata JSONB NOT NULL DEFAULT '{}'::jsonb,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+);
+
+CREATE TABLE IF NOT EXISTS album_tracks (
+  id UUID PRIMARY KEY DEFAULT uuid_generate_v4(),
+  album_id UUID NOT NULL REFERENCES albums(id) ON DELETE CASCADE,
+  media_id UUID NOT NULL REFERENCES media_items(id) ON DELETE CASCADE,
+  position INTEGER NOT NULL,
+  variant TEXT NOT NULL DEFAULT '',
+  notes TEXT,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  UNIQUE (album_id, position),
+  UNIQUE (album_id, media_id, variant)
+);
+
+CREATE OR REPLACE TRIGGER albums_touch_updated_at BEFORE UPDATE ON albums
+  FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+CREATE OR REPLACE TRIGGER trg_touch_album_tracks BEFORE UPDATE ON album_tracks
+  FOR EACH ROW EXECUTE FUNCTION touch_album_tracks_updated_at();
+
+CREATE INDEX IF NOT EXISTS albums_user_id_idx ON albums (user_id);
+CREATE INDEX IF NOT EXISTS albums_created_at_idx ON albums (created_at);
+CREATE UNIQUE INDEX IF NOT EXISTS albums_user_slug_uidx ON albums (user_id, slug);
+CREATE INDEX IF NOT EXISTS idx_albums_meta_gin ON albums USING gin (metadata);
+CREATE INDEX IF NOT EXISTS idx_albums_release ON albums (release_date);
+CREATE INDEX IF NOT EXISTS idx_albums_visibility ON albums (visibility);
+CREATE INDEX IF NOT EXISTS idx_album_tracks_media ON album_tracks (media_id);
+CREATE INDEX IF NOT EXISTS idx_album_tracks_album_pos ON album_tracks (album_id, position);
+CREATE INDEX IF NOT EXISTS idx_media_album_sort ON media_items (album_id, disc_no, track_no);
+CREATE INDEX IF NOT EXISTS idx_media_kind ON media_items (kind);
+CREATE INDEX IF NOT EXISTS idx_media_meta_gin ON media_items USING gin (metadata);
+CREATE INDEX IF NOT EXISTS idx_media_visibility ON media_items (visibility);
+
+CREATE OR REPLACE VIEW albums_simple AS
+  SELECT a.id, a.user_id, a.title, COALESCE(a.cover_path, ''::text) AS cover_url, a.created_at, a.updated_at
+  FROM albums a;
+
+-- additions beyond the production dump
+CREATE OR REPLACE TRIGGER media_items_touch_updated_at BEFORE UPDATE ON media_items
+  FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+CREATE INDEX IF NOT EXISTS albums_user_created_idx ON albums (user_id, created_at DESC, id DESC);
+ALTER TABLE album_tracks ADD COLUMN IF NOT EXISTS label TEXT;
+CREATE UNIQUE INDEX IF NOT EXISTS media_items_rel_path_uidx ON media_items (rel_path);
+
+-- filled by `app.py scanmedia`
+ALTER TABLE media_items ADD COLUMN IF NOT EXISTS mtime_ns BIGINT;
+ALTER TABLE media_items ADD COLUMN IF NOT EXISTS scanned_at TIMESTAMPTZ;
+ALTER TABLE media_items ADD COLUMN IF NOT EXISTS missing_since TIMESTAMPTZ;
+
+-- resized copies of album covers / avatars (owner_kind: 'album' | 'avatar')
+CREATE TABLE IF NOT EXISTS image_renditions (
+  owner_kind TEXT NOT NULL,
+  owner_id TEXT NOT NULL,
+  width INTEGER NOT NULL,
+  format TEXT NOT NULL,
+  path TEXT NOT NULL,
+  bytes INTEGER NOT NULL,
+  created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (owner_kind, owner_id, width, format)
+);
+-- the current uploaded original per owner (renditions are built from it)
+CREATE TABLE IF NOT EXISTS image_uploads (
+  owner_kind TEXT NOT NULL,
+  owner_id TEXT NOT NULL,
+  path TEXT NOT NULL,
+  uploaded_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (owner_kind, owner_id)
+);
+
+-- /me/search: 'simple' config (no stemming; titles are Polish/English/names), weights A..C;
+-- search_names feeds pg_trgm for fuzzy artist/title matching ("2g", "hyenaz")
+ALTER TABLE albums ADD COLUMN IF NOT EXISTS search_tsv TSVECTOR GENERATED ALWAYS AS (
+  setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+  setweight(to_tsvector('simple', coalesce(subtitle, '')), 'B') ||
+  setweight(to_tsvector('simple', coalesce(description_md, '')), 'C')
+) STORED;
+ALTER TABLE albums ADD COLUMN IF NOT EXISTS search_names TEXT GENERATED ALWAYS AS (
+  lower(coalesce(title, '') || ' ' || coalesce(subtitle, ''))
+) STORED;
+ALTER TABLE media_items ADD COLUMN IF NOT EXISTS search_tsv TSVECTOR GENERATED ALWAYS AS (
+  setweight(to_tsvector('simple', coalesce(title, '')), 'A') ||
+  setweight(to_tsvector('simple', coalesce(metadata #>> '{tags,artist}', '') || ' ' ||
+                                  coalesce(metadata #>> '{tags,albumartist}', '')), 'A') ||
+  setweight(to_tsvector('simple', coalesce(metadata #>> '{tags,album}', '') || ' ' ||
+                                  coalesce(metadata #>> '{tags,genre}', '')), 'B') ||
+  setweight(to_tsvector('simple', translate(coalesce(rel_path, ''), '/_.-', '    ')), 'C')
+) STORED;
+ALTER TABLE media_items ADD COLUMN IF NOT EXISTS search_names TEXT GENERATED ALWAYS AS (
+  lower(coalesce(title, '') || ' ' || coalesce(metadata #>> '{tags,artist}', '') || ' ' ||
+        coalesce(metadata #>> '{tags,album}', ''))
+) STORED;
+CREATE INDEX IF NOT EXISTS albums_search_tsv_idx ON albums USING gin (search_tsv);
+CREATE INDEX IF NOT EXISTS albums_search_names_trgm_idx ON albums USING gin (search_names gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS media_items_search_tsv_idx ON media_items USING gin (search_tsv);
+CREATE INDEX IF NOT EXISTS media_items_search_names_trgm_idx ON media_items USING gin (search_names gin_trgm_ops);
+"""
+
+ACTIVITY_LOG_SQL = """
 CREATE TABLE IF NOT EXISTS user_activity_log (
   id BIGSERIAL PRIMARY KEY,
   user_id INTEGER REFERENCES users(id),
@@ -466,14 +2073,454 @@ CREATE TABLE IF NOT EXISTS user_activity_log (
 );
 """
 
-def cmd_initdb():
+# Monthly range partitions named user_activity_log_pYYYYMM; the DEFAULT partition only
+# catches rows if `activitylog` has not created the month yet.
+ACTIVITY_LOG_PARTITIONED_SQL = """
+CREATE TABLE IF NOT EXISTS user_activity_log (
+  id BIGSERIAL,
+  user_id INTEGER REFERENCES users(id),
+  activity_type TEXT NOT NULL,
+  user_agent TEXT,
+  ip_address TEXT,
+  context JSONB,
+  timestamp TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+  PRIMARY KEY (id, timestamp)
+) PARTITION BY RANGE (timestamp);
+
+CREATE TABLE IF NOT EXISTS user_activity_log_default PARTITION OF user_activity_log DEFAULT;
+"""
+
+ACTIVITY_INDEX_SQL = """
+CREATE INDEX IF NOT EXISTS user_activity_log_user_ts_idx ON user_activity_log (user_id, timestamp);
+CREATE INDEX IF NOT EXISTS user_activity_log_type_ts_idx ON user_activity_log (activity_type, timestamp);
+
+CREATE TABLE IF NOT EXISTS activity_daily_logins (
+  day DATE NOT NULL,
+  user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+  logins INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, user_id)
+);
+
+CREATE TABLE IF NOT EXISTS activity_daily_failures (
+  day DATE NOT NULL,
+  ip_address TEXT NOT NULL,
+  failures INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY (day, ip_address)
+);
+"""
+
+def _activity_log_relkind(cur):
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('public.user_activity_log')")
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def _month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+def _add_months(d: date, n: int) -> date:
+    m = d.year * 12 + (d.month - 1) + n
+    return date(m // 12, m % 12 + 1, 1)
+
+def _ensure_activity_partitions(cur, first: date, last: date) -> list[str]:
+    created = []
+    m = _month_start(first)
+    while m <= last:
+        name = f"user_activity_log_p{m:%Y%m}"
+        lo, hi = f"{m.isoformat()} 00:00:00+00", f"{_add_months(m, 1).isoformat()} 00:00:00+00"
+        bounds = sql.SQL("FOR VALUES FROM ({}) TO ({})").format(sql.Literal(lo), sql.Literal(hi))
+        cur.execute("SELECT to_regclass(%s) IS NOT NULL", (f"public.{name}",))
+        if not cur.fetchone()[0]:
+            # Rows for this month already in the DEFAULT partition would make a plain
+            # CREATE ... PARTITION OF fail; build the table, move them over, then attach.
+            cur.execute("SELECT EXISTS (SELECT 1 FROM user_activity_log_default WHERE timestamp >= %s AND timestamp < %s)",
+                        (lo, hi))
+            if cur.fetchone()[0]:
+                cur.execute(sql.SQL("CREATE TABLE {} (LIKE user_activity_log INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(
+                    sql.Identifier(name)))
+                cur.execute(sql.SQL("""
+                    WITH moved AS (
+                      DELETE FROM user_activity_log_default WHERE timestamp >= %s AND timestamp < %s RETURNING *
+                    )
+                    INSERT INTO {} SELECT * FROM moved
+                """).format(sql.Identifier(name)), (lo, hi))
+                cur.execute(sql.SQL("ALTER TABLE user_activity_log ATTACH PARTITION {} {}").format(
+                    sql.Identifier(name), bounds))
+            else:
+                cur.execute(sql.SQL("CREATE TABLE {} PARTITION OF user_activity_log {}").format(
+                    sql.Identifier(name), bounds))
+        created.append(name)
+        m = _add_months(m, 1)
+    return created
+
+def _convert_activity_log_to_partitioned(cur):
+    # Keep the old heap as user_activity_log_legacy; copy its rows into the new partitions.
+    cur.execute("SELECT indexrelid::regclass::text FROM pg_index WHERE indrelid = 'public.user_activity_log'::regclass")
+    for (idx,) in cur.fetchall():
+        cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(idx), sql.Identifier(f"legacy_{idx}"[:63])))
+    cur.execute("ALTER TABLE user_activity_log RENAME TO user_activity_log_legacy")
+    cur.execute("ALTER SEQUENCE IF EXISTS user_activity_log_id_seq RENAME TO user_activity_log_legacy_id_seq")
+    cur.execute(ACTIVITY_LOG_PARTITIONED_SQL)
+    cur.execute("SELECT MIN(timestamp), MAX(id) FROM user_activity_log_legacy")
+    oldest, max_id = cur.fetchone()
+    today = datetime.now(timezone.utc).date()
+    _ensure_activity_partitions(cur, (oldest.date() if oldest else today), _add_months(today, ACTIVITY_PARTITIONS_AHEAD))
+    cur.execute("""
+        INSERT INTO user_activity_log (id, user_id, activity_type, user_agent, ip_address, context, timestamp)
+        SELECT id, user_id, activity_type, user_agent, ip_address, context, timestamp
+        FROM user_activity_log_legacy
+    """)
+    if max_id:
+        cur.execute("SELECT setval(pg_get_serial_sequence('user_activity_log', 'id'), %s)", (max_id,))
+
+# Opt-in migration (`initdb --per-user-slugs`): slugs become unique per user only
+# (albums_user_slug_uidx), so two users can both own an "untitled" album.
+ALBUMS_PER_USER_SLUGS_SQL = "ALTER TABLE albums DROP CONSTRAINT IF EXISTS albums_slug_key"
+
+def cmd_initdb(partition_activity=False, per_user_slugs=False):
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute(SCHEMA_SQL)
+        cur.execute(ALBUMS_SCHEMA_SQL)
+        if per_user_slugs:
+            cur.execute(ALBUMS_PER_USER_SLUGS_SQL)
+            print("albums_slug_key dropped: album slugs are now unique per user (restart the app workers to pick it up).")
+        relkind = _activity_log_relkind(cur)
+        if partition_activity and relkind == "r":
+            _convert_activity_log_to_partitioned(cur)
+            print("user_activity_log converted to monthly partitions (old rows kept in user_activity_log_legacy).")
+        elif partition_activity or relkind == "p":
+            cur.execute(ACTIVITY_LOG_PARTITIONED_SQL)
+            today = datetime.now(timezone.utc).date()
+            _ensure_activity_partitions(cur, today, _add_months(today, ACTIVITY_PARTITIONS_AHEAD))
+        else:
+            cur.execute(ACTIVITY_LOG_SQL)
+        cur.execute(ACTIVITY_INDEX_SQL)
+        cur.execute(LOGIN_THROTTLE_SQL)
+        cur.execute(ROUTE_DOCS_SQL)
+        cur.execute(DB_TABLE_COUNTS_SQL)
+        if SESSION_STORE == "postgres":
+            cur.execute(SESSIONS_SQL)
         conn.commit()
     if _pool is not None:
         _pool.close()
     print("DB schema ensured.")
 
+def cmd_migratetracks():
+    """Move albums.metadata->'tracks' into album_tracks, one album per transaction."""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT id::text FROM albums WHERE metadata ? 'tracks' ORDER BY created_at")
+        album_ids = [r[0] for r in cur.fetchall()]
+    moved = 0
+    for album_id in album_ids:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("SELECT metadata->'tracks' FROM albums WHERE id = %s FOR UPDATE", (album_id,))
+            tracks = cur.fetchone()[0]
+            cur.execute("SELECT EXISTS (SELECT 1 FROM album_tracks WHERE album_id = %s)", (album_id,))
+            if not cur.fetchone()[0] and isinstance(tracks, list):
+                sync_album_tracks(cur, album_id, tracks, allow_missing=True)
+                moved += 1
+            cur.execute("UPDATE albums SET metadata = metadata - 'tracks' WHERE id = %s", (album_id,))
+            conn.commit()
+    if _pool is not None:
+        _pool.close()
+    print(f"Tracks migrated for {moved} of {len(album_ids)} album(s).")
+
+# Media catalog scan
+# ------------------
+# Walks MEDIA_ROOT, probes new/changed files with mutagen in a process pool and upserts them
+# into media_items (rel_path relative to MEDIA_ROOT, e.g. "archives/2g/x.mp3") via COPY into a
+# temp table. Unchanged files (same size + mtime) are skipped; vanished ones get missing_since.
+MEDIA_TAG_KEYS = ("title", "artist", "album", "albumartist", "date", "genre", "tracknumber")
+
+def _walk_media(root: str, base: str = MEDIA_ROOT):
+    """Yield (rel_path, fs path, size, mtime_ns) for media files under `root`; rel_path is relative to `base`."""
+    stack = [root]
+    while stack:
+        with os.scandir(stack.pop()) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    ext = entry.name.rsplit(".", 1)[-1].lower() if "." in entry.name else ""
+                    if ext in MEDIA_KIND_BY_EXT:
+                        st = entry.stat()
+                        rel = os.path.relpath(entry.path, base).replace(os.sep, "/")
+                        yield rel, entry.path, st.st_size, st.st_mtime_ns
+
+def _probe_media_file(item):
+    rel, path_fs, size, mtime_ns = item
+    ext = rel.rsplit(".", 1)[-1].lower()
+    out = {
+        "rel_path": rel, "kind": MEDIA_KIND_BY_EXT.get(ext, "other"),
+        "title": os.path.splitext(os.path.basename(rel))[0],
+        "size_bytes": size, "mtime_ns": mtime_ns,
+        "duration_sec": None, "bitrate_kbps": None, "sample_rate_hz": None, "codec": None, "tags": {},
+    }
+    if out["kind"] not in ("audio", "video"):
+        return out
+    try:
+        import mutagen
+        f = mutagen.File(path_fs, easy=True)
+    except Exception:
+        f = None
+    if f is None:
+        return out
+    info = getattr(f, "info", None)
+    if info is not None:
+        if getattr(info, "length", None):
+            out["duration_sec"] = int(round(info.length))
+        if getattr(info, "bitrate", None):
+            out["bitrate_kbps"] = int(info.bitrate // 1000)
+        if getattr(info, "sample_rate", None):
+            out["sample_rate_hz"] = int(info.sample_rate)
+        out["codec"] = type(f).__module__.rsplit(".", 1)[-1]
+    for key in MEDIA_TAG_KEYS:
+        try:
+            val = (f.tags or {}).get(key)
+        except Exception:
+            val = None
+        if val:
+            out["tags"][key] = str(val[0] if isinstance(val, list) else val).strip()
+    if out["tags"].get("title"):
+        out["title"] = out["tags"]["title"]
+    return out
+
+def _upsert_media_scan(cur, records) -> None:
+    cur.execute("""
+        CREATE TEMP TABLE media_scan (
+          rel_path TEXT, kind media_kind_enum, title TEXT, size_bytes BIGINT, mtime_ns BIGINT,
+          duration_sec INTEGER, bitrate_kbps INTEGER, sample_rate_hz INTEGER, codec TEXT, tags JSONB
+        ) ON COMMIT DROP
+    """)
+    with cur.copy("COPY media_scan FROM STDIN") as cp:
+        for r in records:
+            cp.write_row((
+                r["rel_path"], r["kind"], r["title"], r["size_bytes"], r["mtime_ns"], r["duration_sec"],
+                r["bitrate_kbps"], r["sample_rate_hz"], r["codec"], json.dumps(r["tags"]),
+            ))
+    cur.execute("""
+        INSERT INTO media_items (rel_path, kind, title, size_bytes, mtime_ns, duration_sec, bitrate_kbps,
+                                 sample_rate_hz, codec, metadata, scanned_at, missing_since)
+        SELECT rel_path, kind, title, size_bytes, mtime_ns, duration_sec, bitrate_kbps,
+               sample_rate_hz, codec, jsonb_build_object('tags', tags), now(), NULL
+        FROM media_scan
+        ON CONFLICT (rel_path) DO UPDATE SET
+          kind = EXCLUDED.kind, title = EXCLUDED.title, size_bytes = EXCLUDED.size_bytes,
+          mtime_ns = EXCLUDED.mtime_ns, duration_sec = EXCLUDED.duration_sec,
+          bitrate_kbps = EXCLUDED.bitrate_kbps, sample_rate_hz = EXCLUDED.sample_rate_hz,
+          codec = EXCLUDED.codec, metadata = media_items.metadata || EXCLUDED.metadata,
+          scanned_at = now(), missing_since = NULL
+    """)
+
+def cmd_scanmedia(root=None, jobs=None, full=False, batch=1000):
+    root = os.path.abspath(root or MEDIA_ROOT)
+    # rel_path is always relative to MEDIA_ROOT (archives/... is what peaks/renditions/tracks use);
+    # --root only narrows the walk, and only rows under it can be marked missing.
+    prefix = os.path.relpath(root, os.path.abspath(MEDIA_ROOT)).replace(os.sep, "/")
+    if prefix == ".." or prefix.startswith("../"):
+        sys.exit(f"scanmedia: --root must be inside MEDIA_ROOT ({MEDIA_ROOT})")
+    prefix = "" if prefix == "." else prefix + "/"
+    t0 = time.monotonic()
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT rel_path, size_bytes, mtime_ns, missing_since IS NOT NULL FROM media_items WHERE rel_path IS NOT NULL")
+        known = {r[0]: r[1:] for r in cur.fetchall()}
+
+    seen, todo = set(), []
+    for rel, path_fs, size, mtime_ns in _walk_media(root):
+        seen.add(rel)
+        prev = known.get(rel)
+        if not full and prev and prev[0] == size and prev[1] == mtime_ns and not prev[2]:
+            continue
+        todo.append((rel, path_fs, size, mtime_ns))
+
+    done = 0
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        results = pool.map(_probe_media_file, todo, chunksize=32)
+        pending = []
+        for rec in results:
+            pending.append(rec)
+            if len(pending) >= batch:
+                with get_conn() as conn, conn.cursor() as cur:
+                    _upsert_media_scan(cur, pending)
+                    conn.commit()
+                done += len(pending)
+                pending = []
+        if pending:
+            with get_conn() as conn, conn.cursor() as cur:
+                _upsert_media_scan(cur, pending)
+                conn.commit()
+            done += len(pending)
+
+    gone = [rel for rel, prev in known.items()
+            if rel.startswith(prefix) and rel not in seen and not prev[2]]
+    if gone:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("UPDATE media_items SET missing_since = now() WHERE rel_path = ANY(%s)", (gone,))
+            conn.commit()
+    if _pool is not None:
+        _pool.close()
+    print(f"Media scan: {len(seen)} file(s) on disk, {done} probed/updated, "
+          f"{len(seen) - len(todo)} unchanged, {len(gone)} marked missing ({time.monotonic() - t0:.1f}s).")
+
+def _peaks_job(rel_path_and_force):
+    rel, force = rel_path_and_force
+    t0 = time.monotonic()
+    try:
+        key = generate_peaks(rel, force=force)
+        return rel, key, time.monotonic() - t0, None
+    except (OSError, subprocess.CalledProcessError) as e:
+        return rel, None, time.monotonic() - t0, str(e).strip()[:200]
+
+def cmd_peaks(jobs=None, force=False):
+    """Precompute waveform peaks for every catalogued audio file (run `scanmedia` first)."""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT rel_path FROM media_items
+            WHERE kind = 'audio' AND rel_path IS NOT NULL AND missing_since IS NULL
+            ORDER BY rel_path
+        """)
+        rels = [r[0] for r in cur.fetchall()]
+    t0 = time.monotonic()
+    done, failed, cpu = [], 0, 0.0
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for rel, key, secs, err in pool.map(_peaks_job, [(r, force) for r in rels], chunksize=4):
+            cpu += secs
+            if key:
+                done.append((rel, key))
+            else:
+                failed += 1
+                print(f"peaks failed: {rel}: {err}", file=sys.stderr)
+    if done:
+        with get_conn() as conn, conn.cursor() as cur:
+            levels = json.dumps(list(PEAKS_LEVELS))
+            cur.execute(
+                """
+                UPDATE media_items m
+                SET metadata = m.metadata || jsonb_build_object('peaks', jsonb_build_object('key', v.key, 'levels', %s::jsonb))
+                FROM unnest(%s::text[], %s::text[]) AS v(rel_path, key)
+                WHERE m.rel_path = v.rel_path
+                """,
+                (levels, [d[0] for d in done], [d[1] for d in done]),
+            )
+            conn.commit()
+    if _pool is not None:
+        _pool.close()
+    wall = time.monotonic() - t0
+    print(f"Peaks: {len(done)} ok, {failed} failed, {wall:.1f}s wall, {cpu:.1f}s worker time"
+          f"{f', {len(done) / wall:.1f} files/s' if wall > 0 else ''}.")
+
+def _renditions_job(rel_path_and_force):
+    rel, force = rel_path_and_force
+    t0 = time.monotonic()
+    try:
+        manifest = build_audio_renditions(rel, force=force)
+        return rel, manifest, time.monotonic() - t0, None
+    except (OSError, ValueError, subprocess.CalledProcessError) as e:
+        err = getattr(e, "stderr", None) or str(e)
+        return rel, None, time.monotonic() - t0, (err.decode(errors="replace") if isinstance(err, bytes) else err).strip()[:200]
+
+def cmd_renditions(jobs=None, force=False, min_kbps=0):
+    """Build low-bitrate MP3 + HLS renditions for catalogued audio (run `scanmedia` first)."""
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT rel_path FROM media_items
+            WHERE kind = 'audio' AND rel_path IS NOT NULL AND missing_since IS NULL
+              AND COALESCE(bitrate_kbps, 0) >= %s
+            ORDER BY size_bytes DESC NULLS LAST
+        """, (min_kbps,))
+        rels = [r[0] for r in cur.fetchall()]
+    t0 = time.monotonic()
+    done, failed, cpu, src_bytes, out_bytes = [], 0, 0.0, 0, 0
+    # ffmpeg is the heavy part; a couple of jobs per core keeps I/O and encode overlapped.
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for rel, manifest, secs, err in pool.map(_renditions_job, [(r, force) for r in rels]):
+            cpu += secs
+            if manifest is None:
+                failed += 1
+                print(f"renditions failed: {rel}: {err}", file=sys.stderr)
+                continue
+            done.append((rel, json.dumps({"sha256": manifest["sha256"],
+                                          "kbps": sorted(int(k) for k in manifest["variants"])})))
+            src_bytes += os.path.getsize(os.path.join(MEDIA_ROOT, rel))
+            out_bytes += min(v["bytes"] for v in manifest["variants"].values())
+    if done:
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute(
+                """
+                UPDATE media_items m
+                SET metadata = m.metadata || jsonb_build_object('renditions', v.info::jsonb)
+                FROM unnest(%s::text[], %s::text[]) AS v(rel_path, info)
+                WHERE m.rel_path = v.rel_path
+                """,
+                ([d[0] for d in done], [d[1] for d in done]),
+            )
+            conn.commit()
+    if _pool is not None:
+        _pool.close()
+    wall = time.monotonic() - t0
+    ratio = f", lowest rendition is {out_bytes / src_bytes:.0%} of source bytes" if src_bytes else ""
+    print(f"Renditions: {len(done)} ok, {failed} failed, {wall:.1f}s wall, {cpu:.1f}s worker time{ratio}.")
+
+def rollup_activity(cur, days: int) -> None:
+    since = datetime.now(timezone.utc).date() - timedelta(days=max(0, days - 1))
+    cur.execute("""
+        INSERT INTO activity_daily_logins (day, user_id, logins)
+        SELECT (timestamp AT TIME ZONE 'UTC')::date, user_id, COUNT(*)
+        FROM user_activity_log
+        WHERE activity_type = 'login' AND user_id IS NOT NULL AND timestamp >= %s
+        GROUP BY 1, 2
+        ON CONFLICT (day, user_id) DO UPDATE SET logins = EXCLUDED.logins
+    """, (since,))
+    cur.execute("""
+        INSERT INTO activity_daily_failures (day, ip_address, failures)
+        SELECT (timestamp AT TIME ZONE 'UTC')::date, COALESCE(ip_address, ''), COUNT(*)
+        FROM user_activity_log
+        WHERE activity_type LIKE 'login_failed%%' AND timestamp >= %s
+        GROUP BY 1, 2
+        ON CONFLICT (day, ip_address) DO UPDATE SET failures = EXCLUDED.failures
+    """, (since,))
+
+def _archive_partition(cur, name: str, archive_dir: str) -> str:
+    os.makedirs(archive_dir, exist_ok=True)
+    path = os.path.join(archive_dir, f"{name}.csv.gz")
+    with gzip.open(path, "wb") as fh:
+        with cur.copy(sql.SQL("COPY {} TO STDOUT WITH (FORMAT csv, HEADER true)").format(sql.Identifier(name))) as cp:
+            for chunk in cp:
+                fh.write(chunk)
+    return path
+
+def cmd_activitylog(ahead=ACTIVITY_PARTITIONS_AHEAD, retain_months=ACTIVITY_RETAIN_MONTHS,
+                    archive_dir=ACTIVITY_ARCHIVE_DIR, rollup_days=2):
+    today = datetime.now(timezone.utc).date()
+    with get_conn() as conn, conn.cursor() as cur:
+        if _activity_log_relkind(cur) != "p":
+            print("user_activity_log is not partitioned; run `app.py initdb --partition-activity` first.")
+        else:
+            created = _ensure_activity_partitions(cur, today, _add_months(today, max(0, ahead)))
+            print(f"Partitions ensured: {created[0]} .. {created[-1]}")
+            if retain_months > 0:
+                cutoff = _add_months(_month_start(today), -retain_months)
+                cur.execute("""
+                    SELECT c.relname
+                    FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'public.user_activity_log'::regclass
+                      AND c.relname ~ '^user_activity_log_p[0-9]{6}$'
+                    ORDER BY c.relname
+                """)
+                for (name,) in cur.fetchall():
+                    month = date(int(name[-6:-2]), int(name[-2:]), 1)
+                    if _add_months(month, 1) > cutoff:
+                        continue
+                    if archive_dir:
+                        print(f"Archived {name} -> {_archive_partition(cur, name, archive_dir)}")
+                    cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                    print(f"Dropped {name}")
+        conn.commit()
+        rollup_activity(cur, rollup_days)
+        conn.commit()
+    if _pool is not None:
+        _pool.close()
+    print(f"Activity rollups refreshed for the last {rollup_days} day(s).")
+
 def cmd_seedadmin():
     email = os.getenv("ADMIN_EMAIL", "admin@studio333.art")
     pwd   = os.getenv("ADMIN_PASSWORD", "change-me")
@@ -498,49 +2545,69 @@ def cmd_seedadmin():
 # DEV - DB Tables (Markdown + copy-to-clipboard)
 # ----------------------------------------------
 from collections import defaultdict
-import markdown
 
-@app.route('/dev/db_tables', methods=['GET'])
-@login_required
-def dev_db_tables():
-    if not is_admin():
-        return jsonify({"error": "Forbidden"}), 403
+DB_TABLES_COUNT_TIMEOUT_MS = int(os.getenv("DB_TABLES_COUNT_TIMEOUT_MS", 60000))
+
+# Cheap catalog-only hash of every user column (name, type, nullability, default). It changes only
+# on DDL, so the rendered page is cached per fingerprint instead of re-reading information_schema.
+DB_SCHEMA_FINGERPRINT_SQL = """
+    SELECT md5(COALESCE(string_agg(
+             n.nspname || '.' || c.relname || '.' || a.attnum || ':' || a.attname || ':' ||
+             a.atttypid || ':' || a.attnotnull || ':' || COALESCE(pg_get_expr(d.adbin, d.adrelid), ''),
+             ',' ORDER BY n.nspname, c.relname, a.attnum), ''))
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    JOIN pg_attribute a ON a.attrelid = c.oid AND a.attnum > 0 AND NOT a.attisdropped
+    LEFT JOIN pg_attrdef d ON d.adrelid = c.oid AND d.adnum = a.attnum
+    WHERE c.relkind IN ('r','p','v','m','f')
+      AND n.nspname NOT IN ('pg_catalog','information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%'
+"""
 
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("""
-            SELECT
-              table_schema,
-              table_name,
-              column_name,
-              data_type,
-              is_nullable,
-              column_default
-            FROM information_schema.columns
-            WHERE table_schema NOT IN ('pg_catalog','information_schema','pg_toast')
-            ORDER BY table_schema, table_name, ordinal_position;
-        """)
-        rows = cur.fetchall()
+# Planner estimates: reltuples (-1 = never analyzed -> fall back to pg_stat live tuples);
+# partitioned parents have no rows of their own, so sum their partitions.
+DB_TABLE_ESTIMATES_SQL = """
+    SELECT n.nspname, c.relname,
+           CASE WHEN c.relkind = 'p' THEN
+                  (SELECT SUM(GREATEST(pc.reltuples, 0))::bigint
+                   FROM pg_inherits i JOIN pg_class pc ON pc.oid = i.inhrelid
+                   WHERE i.inhparent = c.oid)
+                WHEN c.reltuples >= 0 THEN c.reltuples::bigint
+                ELSE s.n_live_tup END
+    FROM pg_class c
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+    LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid
+    WHERE c.relkind IN ('r','p','m','f')
+      AND n.nspname NOT IN ('pg_catalog','information_schema')
+      AND n.nspname NOT LIKE 'pg_toast%'
+"""
 
-        tables = defaultdict(list)
-        for schema, table, col, dtype, nullable, default in rows:
-            tables[(schema, table)].append((
-                col,
-                dtype,
-                'NO' if (nullable in ('NO', False)) else 'YES',
-                default or "",
-                ""
-            ))
+# Finished exact counts, shared by all workers; only rows for the current fingerprint are shown.
+DB_TABLE_COUNTS_SQL = """
+CREATE TABLE IF NOT EXISTS dev_table_counts (
+  schema_name TEXT NOT NULL,
+  table_name TEXT NOT NULL,
+  fingerprint TEXT NOT NULL,
+  row_count BIGINT NOT NULL,
+  counted_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+  PRIMARY KEY (schema_name, table_name)
+);
+"""
 
-        counts = {}
-        for (schema, table) in tables.keys():
-            try:
-                qry = sql.SQL("SELECT COUNT(*) FROM {}.{}").format(
-                    sql.Identifier(schema), sql.Identifier(table)
-                )
-                cur.execute(qry)
-                counts[(schema, table)] = cur.fetchone()[0]
-            except Exception:
-                counts[(schema, table)] = None
+_db_tables_cache: dict = {}   # (fingerprint, counted_at of the exact counts) -> (markdown_str, html)
+_db_tables_lock = threading.Lock()
+_db_count_job = {"running": False, "started": None}   # this worker's job only
+
+def _db_tables_markdown(columns, estimates, exact):
+    tables = defaultdict(list)
+    for schema, table, col, dtype, nullable, default in columns:
+        tables[(schema, table)].append((
+            col,
+            dtype,
+            'NO' if (nullable in ('NO', False)) else 'YES',
+            default or "",
+            ""
+        ))
 
     md_lines = ["# `DB.md`"]
     last_schema = None
@@ -550,57 +2617,223 @@ def dev_db_tables():
             md_lines.append(f"## Schema: `{schema}`")
             last_schema = schema
         cols = tables[(schema, table)]
-        count_val = counts.get((schema, table))
-        count_str = f" (rows: {count_val})" if count_val is not None else ""
+        if exact.get((schema, table)) is not None:
+            count_str = f" (rows: {exact[(schema, table)]})"
+        elif estimates.get((schema, table)) is not None:
+            count_str = f" (rows: ~{estimates[(schema, table)]})"
+        else:
+            count_str = ""
         md_lines.append(f"\n### Table: `{table}`{count_str}")
         md_lines.append("| Column | Data Type | Nullable | Default | Notes |")
         md_lines.append("|--------|-----------|----------|---------|-------|")
         for col_name, dtype, nullable, default, notes in cols:
             md_lines.append(f"| `{col_name}` | `{dtype}` | {nullable} | `{default}` | {notes} |")
 
-    markdown_str = "\n".join(md_lines + ["\n---\n"])
-    html = markdown.markdown(markdown_str, extensions=["tables"])
-    return render_template('dev/db_tables.html', html=html, markdown_str=markdown_str)
+    return "\n".join(md_lines + ["\n---\n"])
+
+def _count_tables_job(tables, fingerprint):
+    """Exact COUNT(*) per table, one short-lived connection each so the pool is not pinned."""
+    counts = {}
+    try:
+        for schema, table in tables:
+            try:
+                with get_conn() as conn, conn.cursor() as cur:
+                    cur.execute("SELECT set_config('statement_timeout', %s, true)", (str(DB_TABLES_COUNT_TIMEOUT_MS),))
+                    cur.execute(sql.SQL("SELECT COUNT(*) FROM {}.{}").format(
+                        sql.Identifier(schema), sql.Identifier(table)))
+                    counts[(schema, table)] = cur.fetchone()[0]
+                    conn.rollback()
+            except Exception:
+                app.logger.warning("exact count failed for %s.%s", schema, table, exc_info=True)
+        with get_conn() as conn, conn.cursor() as cur:
+            cur.execute("DELETE FROM dev_table_counts")
+            cur.execute(
+                """
+                INSERT INTO dev_table_counts (schema_name, table_name, fingerprint, row_count)
+                SELECT s, t, %s, n FROM unnest(%s::text[], %s::text[], %s::bigint[]) AS u(s, t, n)
+                """,
+                (fingerprint, [k[0] for k in counts], [k[1] for k in counts], list(counts.values())),
+            )
+            conn.commit()
+    except Exception:
+        app.logger.warning("storing exact table counts failed", exc_info=True)
+    finally:
+        with _db_tables_lock:
+            _db_count_job.update(running=False)
+
+@app.route('/dev/db_tables', methods=['GET'])
+@login_required
+def dev_db_tables():
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(DB_SCHEMA_FINGERPRINT_SQL)
+        fingerprint = cur.fetchone()[0]
+        try:
+            cur.execute("SELECT schema_name, table_name, row_count, counted_at FROM dev_table_counts "
+                        "WHERE fingerprint = %s", (fingerprint,))
+            rows = cur.fetchall()
+        except psycopg.errors.UndefinedTable:   # initdb not re-run yet
+            conn.rollback()
+            rows = []
+        exact = {(r[0], r[1]): r[2] for r in rows}
+        finished = max((r[3] for r in rows), default=None)
+        key = (fingerprint, finished)
+        with _db_tables_lock:
+            status = dict(_db_count_job, finished=finished)
+        cached = None if request.args.get("refresh") else _db_tables_cache.get(key)
+        if cached is None:
+            cur.execute("""
+                SELECT
+                  table_schema,
+                  table_name,
+                  column_name,
+                  data_type,
+                  is_nullable,
+                  column_default
+                FROM information_schema.columns
+                WHERE table_schema NOT IN ('pg_catalog','information_schema','pg_toast')
+                ORDER BY table_schema, table_name, ordinal_position;
+            """)
+            columns = cur.fetchall()
+            cur.execute(DB_TABLE_ESTIMATES_SQL)
+            estimates = {(r[0], r[1]): r[2] for r in cur.fetchall()}
+
+    if cached is None:
+        import markdown
+        markdown_str = _db_tables_markdown(columns, estimates, exact)
+        cached = (markdown_str, markdown.markdown(markdown_str, extensions=["tables"]))
+        with _db_tables_lock:
+            _db_tables_cache.clear()   # only the current fingerprint is worth keeping
+            _db_tables_cache[key] = cached
+
+    markdown_str, html = cached
+    return render_template('dev/db_tables.html', html=html, markdown_str=markdown_str,
+                           fingerprint=fingerprint, counts=status)
+
+@app.route('/dev/db_tables/count', methods=['POST'])
+@login_required
+def dev_db_tables_count():
+    """Start an exact row count of every table in the background (estimates are shown until it finishes)."""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute(DB_SCHEMA_FINGERPRINT_SQL)
+        fingerprint = cur.fetchone()[0]
+        cur.execute(DB_TABLE_ESTIMATES_SQL)
+        tables = sorted((r[0], r[1]) for r in cur.fetchall())
+    with _db_tables_lock:
+        if not _db_count_job["running"]:
+            _db_count_job.update(running=True, started=datetime.now(timezone.utc))
+            threading.Thread(target=_count_tables_job, args=(tables, fingerprint),
+                             name="db-exact-count", daemon=True).start()
+    return redirect(url_for("dev_db_tables"))
 
 # DEV - Routes registry & docs
 # ----------------------------
-logging.basicConfig(level=logging.DEBUG)
 
-def _ensure_route_docs_table():
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS public.route_docs (
-                id SERIAL PRIMARY KEY,
-                path TEXT NOT NULL,
-                methods TEXT NOT NULL,
-                endpoint TEXT NOT NULL,
-                doc TEXT DEFAULT NULL,
-                UNIQUE (path, endpoint)
-            );
-        """)
-        conn.commit()
+ROUTE_DOCS_SQL = """
+CREATE TABLE IF NOT EXISTS public.route_docs (
+    id SERIAL PRIMARY KEY,
+    path TEXT NOT NULL,
+    methods TEXT NOT NULL,
+    endpoint TEXT NOT NULL,
+    doc TEXT DEFAULT NULL,
+    UNIQUE (path, endpoint)
+);
+CREATE TABLE IF NOT EXISTS public.route_docs_meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL,
+    updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+"""
+
+_route_index: dict | None = None      # endpoint -> {path, methods, doc, source}; built once per process
+_route_index_version = ""
+_routes_synced_version = None
+_route_index_lock = threading.Lock()
+
+def route_index():
+    """Rules, docstrings and view source, computed once (url_map is fixed after import)."""
+    global _route_index, _route_index_version
+    if _route_index is not None:
+        return _route_index
+    with _route_index_lock:
+        if _route_index is None:
+            import inspect
+            index = {}
+            for rule in sorted(app.url_map.iter_rules(), key=lambda r: (str(r), r.endpoint)):
+                if rule.endpoint == "static" or rule.endpoint in index:
+                    continue
+                view_func = app.view_functions.get(rule.endpoint)
+                try:
+                    source = inspect.getsource(view_func) if view_func else ""
+                except (OSError, TypeError):
+                    source = "# Source not available"
+                index[rule.endpoint] = {
+                    "path": str(rule),
+                    "methods": ",".join(sorted(m for m in rule.methods if m not in {"HEAD", "OPTIONS"})),
+                    "doc": ((view_func.__doc__ or "").strip() if view_func else ""),
+                    "source": source,
+                }
+            digest = hashlib.sha1()
+            for endpoint, r in index.items():
+                digest.update(f"{r['path']}\0{r['methods']}\0{endpoint}\0{r['doc']}\n".encode())
+            _route_index_version = digest.hexdigest()
+            _route_index = index
+    return _route_index
 
 def sync_routes_to_db(app):
-    logging.debug("Syncing Flask routes to DB...")
-    _ensure_route_docs_table()
+    """Bulk-upsert the route index into route_docs; a no-op when route_docs_meta already has this version."""
+    index = route_index()
     with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT path, endpoint FROM public.route_docs;")
-        existing = {(row[0], row[1]) for row in cur.fetchall()}
-        for rule in app.url_map.iter_rules():
-            if rule.endpoint == "static":
-                continue
-            path = str(rule)
-            methods = ",".join(sorted(m for m in rule.methods if m not in {"HEAD", "OPTIONS"}))
-            endpoint = rule.endpoint
-            if (path, endpoint) not in existing:
-                view_func = app.view_functions.get(endpoint)
-                func_doc = (view_func.__doc__.strip() if (view_func and view_func.__doc__) else "")
-                cur.execute(
-                    "INSERT INTO public.route_docs (path, methods, endpoint, doc) VALUES (%s, %s, %s, %s)",
-                    (path, methods, endpoint, func_doc)
-                )
+        try:
+            cur.execute("SELECT value FROM public.route_docs_meta WHERE key = 'routes_version'")
+        except psycopg.errors.UndefinedTable:
+            conn.rollback()
+            cur.execute(ROUTE_DOCS_SQL)
+            cur.execute("SELECT value FROM public.route_docs_meta WHERE key = 'routes_version'")
+        row = cur.fetchone()
+        if row and row[0] == _route_index_version:
+            conn.rollback()
+            return False
+        cur.execute(
+            """
+            INSERT INTO public.route_docs (path, methods, endpoint, doc)
+            SELECT * FROM unnest(%s::text[], %s::text[], %s::text[], %s::text[])
+            ON CONFLICT (path, endpoint) DO UPDATE SET methods = EXCLUDED.methods
+            WHERE route_docs.methods IS DISTINCT FROM EXCLUDED.methods
+            """,
+            (
+                [r["path"] for r in index.values()],
+                [r["methods"] for r in index.values()],
+                list(index.keys()),
+                [r["doc"] for r in index.values()],
+            ),
+        )
+        cur.execute(
+            """
+            INSERT INTO public.route_docs_meta (key, value) VALUES ('routes_version', %s)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = now()
+            """,
+            (_route_index_version,),
+        )
         conn.commit()
-    logging.debug("Route sync complete.")
+    logging.info("Route registry synced: %d route(s), version %s", len(index), _route_index_version[:12])
+    return True
+
+def sync_routes_once() -> None:
+    """Sync once per process (gunicorn post_worker_init; first /dev/routes view under the dev server)."""
+    global _routes_synced_version
+    route_index()
+    if _routes_synced_version == _route_index_version:
+        return
+    try:
+        sync_routes_to_db(app)
+        _routes_synced_version = _route_index_version
+    except (psycopg.Error, PoolTimeout):
+        app.logger.warning("route registry sync failed", exc_info=True)
 
 @app.route("/dev/routes/<int:route_id>/details", methods=["GET"])
 @login_required
@@ -618,15 +2851,9 @@ def route_details(route_id: int):
         abort(404)
 
     rid, path, methods_csv, endpoint, doc = row
-    source_code = ""
-    source_docstring = ""
-    view_func = app.view_functions.get(endpoint)
-    if view_func:
-        try:
-            source_code = inspect.getsource(view_func)
-            source_docstring = (view_func.__doc__ or "").strip()
-        except OSError:
-            source_code = "# Source not available"
+    entry = route_index().get(endpoint) or {}
+    source_code = entry.get("source", "")
+    source_docstring = entry.get("doc", "")
 
     return jsonify({
         "id": rid,
@@ -648,7 +2875,6 @@ def update_doc():
     doc = data.get("doc", "")
     if not isinstance(rid, int):
         return jsonify({"error": "Invalid id"}), 400
-    _ensure_route_docs_table()
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute("UPDATE public.route_docs SET doc=%s WHERE id=%s", (doc, rid))
         conn.commit()
@@ -659,7 +2885,8 @@ def update_doc():
 def admin_routes():
     if not is_admin():
         return jsonify({"error": "Forbidden"}), 403
-    sync_routes_to_db(app)
+    sync_routes_once()
+    index = route_index()
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute("""
             SELECT id, path, methods, endpoint, COALESCE(doc, '') AS doc
@@ -669,10 +2896,7 @@ def admin_routes():
         rows = cur.fetchall()
     routes = []
     for db_id, path, methods_csv, endpoint, db_doc in rows:
-        view_func = app.view_functions.get(endpoint)
-        source_doc = ""
-        if view_func and getattr(view_func, "__doc__", None):
-            source_doc = (view_func.__doc__ or "").strip()
+        source_doc = (index.get(endpoint) or {}).get("doc", "")
         routes.append({
             "id": db_id,
             "rule": path,
@@ -695,20 +2919,99 @@ def dev_db_health():
             current_schema = cur.fetchone()[0]
             missing = []
             try:
-                cur.execute("SELECT 1 FROM pg_extension WHERE extname='uuid-ossp'")
-                if cur.fetchone() is None:
-                    missing.append("uuid-ossp")
+                wanted = ["uuid-ossp", "citext", "pg_trgm"]
+                cur.execute("SELECT extname FROM pg_extension WHERE extname = ANY(%s)", (wanted,))
+                present = {r[0] for r in cur.fetchall()}
+                missing = [e for e in wanted if e not in present]
             except Exception:
                 pass
         return jsonify({
             "ok": True,
             "server_version": server_version,
             "current_schema": current_schema,
-            "missing_extensions": missing
+            "missing_extensions": missing,
+            "activity_log": activity_log_stats(),
+            "pool": pool_stats()["pool"]
         }), 200
     except Exception as e:
         return jsonify({"ok": False, "error": str(e)}), 503
 
+# DEV: DB pool
+# ------------
+@app.route("/dev/db_pool", methods=["GET"])
+@login_required
+def dev_db_pool():
+    """Pool state for this worker; each gunicorn worker has its own pool (see ``pid``)."""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify(pool_stats()), 200
+
+# DEV: sampling profiler
+# -----------------------
+@app.route("/dev/profile", methods=["GET"])
+@login_required
+@cache_policy("no-store")
+def dev_profile():
+    """Profile this worker for ``seconds`` (max 30); ``endpoint=`` filters, ``format=collapsed|json``."""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    seconds = max(0.1, min(request.args.get("seconds", 10, type=float), PROFILE_MAX_SEC))
+    hz = request.args.get("hz", PROFILE_DEFAULT_HZ, type=int)
+    endpoint = request.args.get("endpoint") or None
+    if endpoint and endpoint not in app.view_functions:
+        return jsonify({"error": "unknown_endpoint"}), 400
+    if not _profile_lock.acquire(blocking=False):
+        return jsonify({"error": "profile_running"}), 409
+    try:
+        result = sample_stacks(seconds, hz=hz, endpoint=endpoint,
+                               include_idle=request.args.get("idle") == "1")
+    finally:
+        _profile_lock.release()
+
+    ordered = sorted(result.pop("stacks").items(), key=lambda kv: -kv[1])
+    if request.args.get("format") == "json":
+        result["stacks"] = [{"stack": k, "count": n} for k, n in ordered]
+        return jsonify(result), 200
+    resp = make_response("".join(f"{k} {n}\n" for k, n in ordered))
+    resp.mimetype = "text/plain"
+    resp.headers["Content-Disposition"] = f'attachment; filename="profile-{result["pid"]}-{int(time.time())}.folded"'
+    for key in ("samples", "thread_samples", "final_hz", "overhead"):
+        resp.headers[f"X-Profile-{key.replace('_', '-').title()}"] = str(result[key])
+    return resp
+
+# DEV: query registry
+# -------------------
+@app.route("/dev/queries", methods=["GET"])
+@login_required
+def dev_queries():
+    """Per-statement call counts and latency histograms for this worker (see ``pid``)."""
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    return jsonify({"pid": os.getpid(), "prepare_threshold": DB_PREPARE_THRESHOLD,
+                    "queries": query_stats()}), 200
+
+# DEV: activity rollups
+# ---------------------
+@app.route("/dev/activity_summary", methods=["GET"])
+@login_required
+def dev_activity_summary():
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    days = max(1, min(request.args.get("days", 30, type=int) or 30, 366))
+    since = datetime.now(timezone.utc).date() - timedelta(days=days - 1)
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT day, SUM(logins), COUNT(*) FROM activity_daily_logins
+            WHERE day >= %s GROUP BY day ORDER BY day
+        """, (since,))
+        logins = [{"day": r[0].isoformat(), "logins": int(r[1]), "users": r[2]} for r in cur.fetchall()]
+        cur.execute("""
+            SELECT ip_address, SUM(failures) AS n FROM activity_daily_failures
+            WHERE day >= %s GROUP BY ip_address ORDER BY n DESC LIMIT 20
+        """, (since,))
+        failures = [{"ip_address": r[0], "failures": int(r[1])} for r in cur.fetchall()]
+    return jsonify({"days": days, "logins": logins, "top_failed_ips": failures}), 200
+
 # ── HTTPS & cache headers
 def generate_temp_ssl_cert():
     import subprocess
@@ -725,11 +3028,48 @@ def generate_temp_ssl_cert():
         ], check=True)
     return cert_file, key_file
 
+@app.url_defaults
+def _static_cache_buster(endpoint, values):
+    if endpoint == "static" and "filename" in values and "v" not in values:
+        fp = static_fingerprint(values["filename"])
+        if fp:
+            values["v"] = fp
+
+def _resolve_cache_policy(response) -> str:
+    if request.method not in ("GET", "HEAD") or (response.status_code >= 300 and response.status_code != 304):
+        return "no-store"
+    endpoint = request.endpoint or ""
+    if endpoint == "static":
+        filename = (request.view_args or {}).get("filename", "")
+        if filename.startswith(STATIC_IMMUTABLE_PREFIXES):
+            return "immutable"
+        if filename.startswith(STATIC_REVALIDATE_PREFIXES):
+            return "revalidate"
+        v = request.args.get("v")
+        if v and v == static_fingerprint(filename):
+            return "immutable"
+        return "static"
+    view = app.view_functions.get(endpoint)
+    name = getattr(view, "_cache_policy", None)
+    if name:
+        return name
+    return BLUEPRINT_CACHE_POLICY.get(request.blueprint, DEFAULT_CACHE_POLICY)
+
 @app.after_request
 def add_header(response):
-    response.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
+    policy = _resolve_cache_policy(response)
+    header = CACHE_POLICIES[policy]
+    if header is None:
+        return response
+    response.headers["Cache-Control"] = header
+    if policy == "no-store":
+        response.headers["Pragma"] = "no-cache"
+        response.headers["Expires"] = "0"
+        return response
+    if policy in ETAG_POLICIES and response.status_code == 200 and not response.direct_passthrough:
+        if not response.get_etag()[0]:
+            response.add_etag()
+        response.make_conditional(request)
     return response
 
 # ----------------------------
@@ -737,24 +3077,17 @@ def add_header(response):
 # ----------------------------
 api_auth = Blueprint("api_auth", __name__)
 
-def _row_to_user(cur, user_id):
-    cur.execute(
-        "SELECT id, email, role, nickname, last_login FROM users WHERE id=%s AND is_deleted=false",
-        (user_id,)
-    )
-    u = cur.fetchone()
+def _row_to_user(user_id, cur=None):
+    u = get_identity(user_id, cur=cur)
     if not u:
         return None
-    cur.execute("SELECT avatar FROM profiles WHERE user_id=%s", (user_id,))
-    p = cur.fetchone()
-    avatar_url = p[0] if p and p[0] else "media/icons/user.svg"
     return {
-        "id": u[0],
-        "email": u[1],
-        "role": u[2],
-        "name": u[3] or (u[1].split("@")[0] if u[1] else "User"),
-        "last_login": (u[4].isoformat() if isinstance(u[4], datetime) else u[4]),
-        "avatar_url": avatar_url
+        "id": u["id"],
+        "email": u["email"],
+        "role": u["role"],
+        "name": u["nickname"] or (u["email"].split("@")[0] if u["email"] else "User"),
+        "last_login": (u["last_login"].isoformat() if isinstance(u["last_login"], datetime) else u["last_login"]),
+        "avatar_url": u["avatar"] or "media/icons/user.svg"
     }
 
 @api_auth.post("/login")
@@ -765,40 +3098,48 @@ def api_login():
     if not email or not password:
         return jsonify({"error": "missing_credentials"}), 400
 
+    try:
+        check_login_throttle(email)
+    except LoginThrottled as e:
+        resp = jsonify({"error": "too_many_attempts" if e.reason != "hash_busy" else "auth_busy",
+                        "retry_after": e.retry_after})
+        resp.status_code = 429 if e.reason != "hash_busy" else 503
+        resp.headers["Retry-After"] = str(e.retry_after)
+        return resp
+
     with get_conn() as conn, conn.cursor() as cur:
-        cur.execute("SELECT id, password_hash FROM users WHERE email=%s AND is_deleted=false", (email,))
-        row = cur.fetchone()
+        row = run_query(cur, Q_LOGIN_LOOKUP, (email,)).fetchone()
         if not row:
-            cur.execute(
-                "INSERT INTO user_activity_log(user_id, activity_type, user_agent, ip_address, context) "
-                "VALUES (%s,%s,%s,%s,%s)",
-                (None, "login_failed_no_user", request.headers.get("User-Agent"), request.remote_addr, PgJson({"email": email}))
-            )
-            conn.commit()
+            METRIC_LOGIN_ATTEMPTS.labels("no_user").inc()
+            note_login_failure(email)
+            log_user_activity(None, "login_failed_no_user", {"email": email})
             return jsonify({"error": "invalid_credentials", "reason": "email"}), 401
 
         user_id, pw_hash = row[0], row[1]
-        if not check_password_hash(pw_hash, password):
-            cur.execute(
-                "INSERT INTO user_activity_log(user_id, activity_type, user_agent, ip_address, context) "
-                "VALUES (%s,%s,%s,%s,%s)",
-                (user_id, "login_failed_bad_password", request.headers.get("User-Agent"), request.remote_addr, PgJson({"email": email}))
-            )
-            conn.commit()
+        try:
+            ok = verify_password(pw_hash, password)
+        except LoginThrottled as e:
+            resp = jsonify({"error": "auth_busy", "retry_after": e.retry_after})
+            resp.status_code = 503
+            resp.headers["Retry-After"] = str(e.retry_after)
+            return resp
+        if not ok:
+            METRIC_LOGIN_ATTEMPTS.labels("bad_password").inc()
+            note_login_failure(email)
+            log_user_activity(user_id, "login_failed_bad_password", {"email": email})
             return jsonify({"error": "invalid_credentials", "reason": "password"}), 401
+        METRIC_LOGIN_ATTEMPTS.labels("ok").inc()
 
         session["user_id"] = user_id
+        session["login_at"] = session["last_active"] = _now_ts()
         session.modified = True
 
-        cur.execute("UPDATE users SET last_login=now() WHERE id=%s", (user_id,))
-        cur.execute(
-            "INSERT INTO user_activity_log(user_id, activity_type, user_agent, ip_address) "
-            "VALUES (%s,%s,%s,%s)",
-            (user_id, "login", request.headers.get("User-Agent"), request.remote_addr)
-        )
+        run_query(cur, Q_TOUCH_LAST_LOGIN, (user_id,))
         conn.commit()
+        log_user_activity(user_id, "login")
+        invalidate_identity(user_id)
 
-        user = _row_to_user(cur, user_id)
+        user = _row_to_user(user_id, cur)
         return jsonify({"user": user}), 200
 
 @api_auth.get("/me")
@@ -806,39 +3147,216 @@ def api_me():
     uid = session.get("user_id")
     if not uid:
         return jsonify({"user": None}), 401
-    with get_conn() as conn, conn.cursor() as cur:
-        user = _row_to_user(cur, uid)
-        if not user:
-            session.pop("user_id", None)
-            return jsonify({"user": None}), 401
-        return jsonify({"user": user}), 200
+    user = _row_to_user(uid)
+    if not user:
+        session.pop("user_id", None)
+        return jsonify({"user": None}), 401
+    return jsonify({"user": user}), 200
 
 # Albums: list/create/get/update/tracks/cover/delete/clone
+ALBUM_LIST_FIELDS = {
+    "id":         "id::text",
+    "title":      "title",
+    "subtitle":   "COALESCE(subtitle, '')",
+    "cover_url":  "COALESCE(cover_path, '')",
+    "slug":       "slug::text",
+    "visibility": "visibility::text",
+    "created_at": "created_at",
+    "updated_at": "updated_at",
+}
+ALBUM_LIST_DEFAULT_FIELDS = ("id", "title", "subtitle", "cover_url", "created_at")
+
+def _encode_album_cursor(created_at, album_id) -> str:
+    raw = f"{created_at.isoformat()}|{album_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_album_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+        ts, album_id = raw.rsplit("|", 1)
+        return datetime.fromisoformat(ts), str(uuid.UUID(album_id))
+    except (ValueError, UnicodeDecodeError):
+        return None
+
 @api_auth.get("/me/albums")
+@cache_policy("private")
 def api_me_albums():
+    """List the user's albums, newest first.
+
+    Optional query args: ``limit`` (1..ALBUMS_PAGE_MAX) and ``cursor`` (``next_cursor`` of the
+    previous page) for keyset paging, ``fields`` (comma separated) to trim each item.
+    Without ``limit`` the whole list is returned.
+    """
     uid = session.get("user_id")
     if not uid:
         return jsonify({"albums": []}), 401
+
+    fields = [f for f in (request.args.get("fields") or "").split(",") if f.strip()]
+    fields = [f.strip() for f in fields] or list(ALBUM_LIST_DEFAULT_FIELDS)
+    unknown = [f for f in fields if f not in ALBUM_LIST_FIELDS]
+    if unknown:
+        return jsonify({"error": "unknown_fields", "fields": unknown}), 400
+
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, ALBUMS_PAGE_MAX))
+    cursor = None
+    if request.args.get("cursor"):
+        cursor = _decode_album_cursor(request.args["cursor"])
+        if cursor is None:
+            return jsonify({"error": "bad_cursor"}), 400
+
     with get_conn() as conn, conn.cursor() as cur:
+        newest, total = run_query(cur, Q_ALBUMS_STAMP, (uid,)).fetchone()
+        etag = hashlib.md5(
+            f"{uid}:{newest.isoformat() if newest else ''}:{total}:{request.query_string.decode()}".encode()
+        ).hexdigest()
+        if request.if_none_match.contains(etag):
+            resp = make_response("", 304)
+            resp.set_etag(etag)
+            return resp
+
+        cols = ", ".join(ALBUM_LIST_FIELDS[f] for f in fields)
+        where = "user_id = %s"
+        params = [uid]
+        if cursor:
+            where += " AND (created_at, id) < (%s, %s::uuid)"
+            params += list(cursor)
+        tail = ""
+        if limit is not None:
+            tail = " LIMIT %s"
+            params.append(limit + 1)
         cur.execute(
-            """
-            SELECT id::text, title, COALESCE(subtitle, '') AS subtitle,
-                   COALESCE(cover_path, '') AS cover_url, created_at
-            FROM albums
-            WHERE user_id = %s
-            ORDER BY created_at DESC, id DESC
-            """,
-            (uid,),
+            f"SELECT created_at, id::text, {cols} FROM albums WHERE {where} "
+            f"ORDER BY created_at DESC, id DESC{tail}",
+            params,
         )
         rows = cur.fetchall() or []
-        albums = [{
-            "id": r[0],
-            "title": r[1],
-            "subtitle": r[2],
-            "cover_url": r[3],
-            "created_at": (r[4].isoformat() if r[4] else None),
-        } for r in rows]
-        return jsonify({"albums": albums}), 200
+
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_album_cursor(rows[-1][0], rows[-1][1])
+    albums = []
+    for r in rows:
+        item = {}
+        for name, val in zip(fields, r[2:]):
+            item[name] = val.isoformat() if isinstance(val, datetime) else val
+        albums.append(item)
+    resp = jsonify({"albums": albums, "next_cursor": next_cursor})
+    resp.set_etag(etag)
+    return resp
+
+# Search: each word becomes a prefix term ("hyen" matches "hyenaz"); names that only match
+# fuzzily (typos, "2g" vs "2-g") come in through pg_trgm word similarity on search_names.
+_SEARCH_WORD_RE = re.compile(r"\w+", re.UNICODE)
+_HL_START, _HL_STOP = "\x02", "\x03"
+_HL_OPTS = f"StartSel={_HL_START}, StopSel={_HL_STOP}, HighlightAll=true"
+_HL_FRAGMENT_OPTS = f"StartSel={_HL_START}, StopSel={_HL_STOP}, MaxWords=18, MinWords=6, MaxFragments=1"
+
+SEARCH_SQL = f"""
+WITH q AS (SELECT to_tsquery('simple', %(tsq)s) AS tsq),
+own_media AS (
+  SELECT t.media_id FROM album_tracks t JOIN albums a ON a.id = t.album_id WHERE a.user_id = %(uid)s
+  UNION
+  SELECT m.id FROM media_items m JOIN albums a ON a.id = m.album_id WHERE a.user_id = %(uid)s
+),
+hits AS (
+  SELECT 'album' AS kind, a.id, a.title, a.subtitle AS detail, a.description_md AS body,
+         a.cover_path, NULL::text AS rel_path, NULL::int AS duration_sec,
+         ts_rank_cd(a.search_tsv, q.tsq, 1) + word_similarity(%(raw)s, a.search_names) AS score
+  FROM albums a, q
+  WHERE %(albums)s AND a.user_id = %(uid)s
+    AND (a.search_tsv @@ q.tsq OR %(raw)s <%% a.search_names)
+  UNION ALL
+  SELECT 'media', m.id, m.title, m.metadata #>> '{{tags,artist}}', NULL,
+         m.cover_path, m.rel_path, m.duration_sec,
+         ts_rank_cd(m.search_tsv, q.tsq, 1) + word_similarity(%(raw)s, m.search_names)
+  FROM media_items m, q
+  WHERE %(media)s AND m.missing_since IS NULL AND m.rel_path IS NOT NULL
+    AND (m.visibility = 'public' OR m.id IN (SELECT media_id FROM own_media))
+    AND (m.search_tsv @@ q.tsq OR %(raw)s <%% m.search_names)
+),
+page AS (
+  SELECT * FROM hits ORDER BY score DESC, id LIMIT %(limit)s OFFSET %(offset)s
+)
+SELECT p.kind, p.id::text, p.title, p.detail, p.cover_path, p.rel_path, p.duration_sec, p.score,
+       ts_headline('simple', p.title, q.tsq, '{_HL_OPTS}'),
+       ts_headline('simple', coalesce(p.detail, ''), q.tsq, '{_HL_OPTS}'),
+       CASE WHEN p.body <> '' THEN ts_headline('simple', p.body, q.tsq, '{_HL_FRAGMENT_OPTS}') END
+FROM page p, q
+ORDER BY p.score DESC, p.id
+"""
+
+def _search_tsquery(raw: str) -> str:
+    words = _SEARCH_WORD_RE.findall(raw.lower())
+    # single-letter prefixes match most of the catalog; keep them only if nothing else is left
+    words = [w for w in words if len(w) > 1] or words
+    return " & ".join(f"{w}:*" for w in words[:8])
+
+def _highlight(text):
+    """ts_headline output -> HTML-safe string with <mark> around matches."""
+    if text is None:
+        return None
+    return html.escape(text).replace(_HL_START, "<mark>").replace(_HL_STOP, "</mark>")
+
+@api_auth.get("/me/search")
+@cache_policy("private")
+def api_me_search():
+    """Ranked search over the user's albums and the media they may see: public items plus
+    tracks of their own albums (private and unlisted media stay out of other users' results).
+
+    Query args: ``q`` (2+ chars), ``type`` (all|albums|media), ``limit`` (1..SEARCH_PAGE_MAX),
+    ``cursor`` (``next_cursor`` of the previous page). ``highlight`` values are HTML with <mark>.
+    """
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"results": []}), 401
+
+    raw = " ".join((request.args.get("q") or "").split())[:200]
+    kind = request.args.get("type", "all")
+    if kind not in ("all", "albums", "media"):
+        return jsonify({"error": "bad_type"}), 400
+    if len(raw) < 2:
+        return jsonify({"error": "query_too_short"}), 400
+    limit = max(1, min(request.args.get("limit", 20, type=int), SEARCH_PAGE_MAX))
+    offset = 0
+    if request.args.get("cursor"):
+        try:
+            offset = int(base64.urlsafe_b64decode(request.args["cursor"] + "=" * (-len(request.args["cursor"]) % 4)))
+        except ValueError:
+            return jsonify({"error": "bad_cursor"}), 400
+        if not 0 <= offset <= SEARCH_MAX_OFFSET:
+            return jsonify({"error": "bad_cursor"}), 400
+
+    tsq = _search_tsquery(raw)
+    params = {
+        # no word characters (e.g. "++"): trigram matching alone
+        "tsq": tsq or "''", "raw": raw.lower(), "uid": uid, "limit": limit + 1, "offset": offset,
+        "albums": kind in ("all", "albums"), "media": kind in ("all", "media"),
+    }
+    with get_conn() as conn, conn.cursor() as cur:
+        cur.execute("SELECT set_config('pg_trgm.word_similarity_threshold', %s, true)",
+                    (str(SEARCH_TRGM_THRESHOLD),))
+        cur.execute(SEARCH_SQL, params)
+        rows = cur.fetchall() or []
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        if offset + limit <= SEARCH_MAX_OFFSET:
+            next_cursor = base64.urlsafe_b64encode(str(offset + limit).encode()).decode().rstrip("=")
+    results = []
+    for kind_, id_, title, detail, cover, rel_path, duration, score, hl_title, hl_detail, hl_body in rows:
+        item = {"kind": kind_, "id": id_, "title": title, "score": round(float(score), 4),
+                "highlight": {"title": _highlight(hl_title), "detail": _highlight(hl_detail) if detail else None}}
+        if kind_ == "album":
+            item.update(subtitle=detail or "", cover_url=cover or "")
+            item["highlight"]["description"] = _highlight(hl_body)
+        else:
+            item.update(artist=detail, path=rel_path, url="media/" + quote(rel_path), duration_sec=duration)
+        results.append(item)
+    return jsonify({"query": raw, "results": results, "next_cursor": next_cursor})
 
 @api_auth.post("/me/albums")
 def api_me_albums_create():
@@ -853,18 +3371,32 @@ def api_me_albums_create():
     if not title:
         return jsonify({"error":"title_required"}), 400
 
+    params = {"uid": uid, "base": make_slug(title), "title": title, "subtitle": subtitle, "cover": cover_url}
     with get_conn() as conn, conn.cursor() as cur:
-        base = make_slug(title)
-        slug = unique_album_slug(cur, uid, base)
-        cur.execute(
-            """
-            INSERT INTO albums (id, user_id, slug, title, subtitle, cover_path, visibility, metadata)
-            VALUES (uuid_generate_v4(), %s, %s, %s, %s, %s, 'private', '{}'::jsonb)
-            RETURNING id::text, title, COALESCE(subtitle,''), COALESCE(cover_path,''), created_at
-            """,
-            (uid, slug, title, subtitle, cover_url),
-        )
-        row = cur.fetchone()
+        slug_sql = next_album_slug_sql(cur)
+        # lock key: the user while slugs are per user, 0 (everyone) while albums_slug_key is global
+        lock_owner = 0 if _album_slugs_global else uid
+        row = None
+        for _ in range(SLUG_INSERT_ATTEMPTS):
+            cur.execute(
+                f"""
+                INSERT INTO albums (id, user_id, slug, title, subtitle, cover_path, visibility, metadata)
+                VALUES (uuid_generate_v4(), %(uid)s, {slug_sql}, %(title)s, %(subtitle)s, %(cover)s,
+                        'private', '{{}}'::jsonb)
+                ON CONFLICT DO NOTHING
+                RETURNING id::text, title, COALESCE(subtitle,''), COALESCE(cover_path,''), created_at
+                """,
+                params,
+            )
+            row = cur.fetchone()
+            if row:
+                break
+            # Lost a race for this slug: serialize the remaining creates of the same base (held
+            # until commit) so the retry sees the winners' rows.
+            cur.execute("SELECT pg_advisory_xact_lock(%s, hashtext(%s))", (lock_owner, params["base"]))
+        if not row:
+            conn.rollback()
+            return jsonify({"error": "slug_conflict"}), 409
         conn.commit()
 
     album = {
@@ -882,16 +3414,7 @@ def api_album_get(album_id):
     if not uid:
         return jsonify({"error": "unauthorized"}), 401
     with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(
-            """
-            SELECT id::text, user_id, slug, title, subtitle, description_md, cover_path,
-                   visibility::text, metadata, created_at, updated_at
-            FROM albums
-            WHERE id = %s AND user_id = %s
-            """,
-            (album_id, uid),
-        )
-        row = cur.fetchone()
+        row = run_query(cur, Q_ALBUM_GET, (album_id, uid)).fetchone()
         if not row:
             return jsonify({"error": "not_found"}), 404
         album = {
@@ -906,6 +3429,9 @@ def api_album_get(album_id):
             "created_at": (row[9].isoformat() if row[9] else None),
             "updated_at": (row[10].isoformat() if row[10] else None),
         }
+        album["metadata"]["tracks"] = load_album_tracks(cur, row[0], row[8])
+        version = run_query(cur, Q_ALBUM_HAS_RENDITIONS, (row[0],)).fetchone()[0]
+        album["cover_srcset"] = rendition_srcset("album", row[0], version) if version else ""
         return jsonify({"album": album}), 200
 
 @api_auth.post("/me/albums/<string:album_id>")
@@ -921,6 +3447,10 @@ def api_album_update(album_id):
     visibility = (payload.get("visibility") or "private").strip()
     cover_url = (payload.get("cover_url") or "").strip()
     metadata = payload.get("metadata") or {}
+    if not isinstance(metadata, dict):
+        return jsonify({"error": "invalid_metadata"}), 400
+    metadata = dict(metadata)
+    tracks = metadata.pop("tracks", None)
 
     with get_conn() as conn, conn.cursor() as cur:
         cur.execute(
@@ -941,6 +3471,8 @@ def api_album_update(album_id):
         row = cur.fetchone()
         if not row:
             return jsonify({"error": "not_found"}), 404
+        if isinstance(tracks, list):
+            sync_album_tracks(cur, album_id, tracks)
         conn.commit()
         out = {
             "id": row[0],
@@ -951,8 +3483,167 @@ def api_album_update(album_id):
             "metadata": row[5] or {},
             "updated_at": (row[6].isoformat() if row[6] else None),
         }
+        out["metadata"]["tracks"] = load_album_tracks(cur, album_id)
         return jsonify({"album": out}), 200
 
+# Album tracks live in album_tracks (joined to media_items by rel_path); albums.metadata no
+# longer carries them. Paths in the API are relative to media/archives/, like the player's.
+# (album_id, position) is UNIQUE and not deferrable, so moved rows are parked at negative
+# positions first and flipped back in a second statement.
+MEDIA_KIND_BY_EXT = {
+    "mp3": "audio", "wav": "audio", "ogg": "audio", "m4a": "audio", "flac": "audio", "aac": "audio",
+    "mp4": "video", "webm": "video", "ogv": "video", "mov": "video", "m4v": "video",
+    "jpg": "image", "jpeg": "image", "png": "image", "gif": "image", "webp": "image", "bmp": "image",
+    "m3u8": "hls", "mpd": "dash",
+}
+
+def _track_rel_path(path: str) -> str:
+    return MEDIA_ARCHIVE_PREFIX + path.strip().lstrip("/")
+
+def _track_path(rel_path: str) -> str:
+    rel_path = rel_path or ""
+    return rel_path[len(MEDIA_ARCHIVE_PREFIX):] if rel_path.startswith(MEDIA_ARCHIVE_PREFIX) else rel_path
+
+def _clean_tracks(tracks) -> list[tuple[str, str]]:
+    out = []
+    for t in tracks or []:
+        if isinstance(t, str):
+            t = {"path": t}
+        if not isinstance(t, dict):
+            continue
+        path = str(t.get("path") or "").strip()
+        if not path or path.endswith("/"):
+            continue
+        out.append((path, str(t.get("label") or "")))
+    return out
+
+class UnknownMediaPaths(ValueError):
+    def __init__(self, paths):
+        super().__init__(", ".join(paths))
+        self.paths = paths
+
+@app.errorhandler(UnknownMediaPaths)
+def _unknown_media_paths(e):
+    return jsonify({"error": "unknown_tracks", "paths": e.paths}), 400
+
+def _media_file_exists(rel_path: str) -> bool:
+    path_fs = safe_join(MEDIA_ROOT, rel_path)
+    return path_fs is not None and os.path.isfile(path_fs)
+
+def ensure_media_items(cur, paths, allow_missing=False) -> dict[str, str]:
+    """Return {track path: media_items.id}, creating bare catalog rows for files under MEDIA_ROOT.
+
+    Paths that are neither catalogued nor on disk raise UnknownMediaPaths (400), unless
+    allow_missing (migratetracks: legacy metadata is catalogued as-is).
+    """
+    rels = list(dict.fromkeys(_track_rel_path(p) for p in paths))
+    if not rels:
+        return {}
+    cur.execute("SELECT rel_path FROM media_items WHERE rel_path = ANY(%s)", (rels,))
+    known = {r[0] for r in cur.fetchall()}
+    rels = [r for r in rels if r not in known]
+    if not allow_missing:
+        bad = [_track_path(r) for r in rels if not _media_file_exists(r)]
+        if bad:
+            raise UnknownMediaPaths(bad)
+    kinds = [MEDIA_KIND_BY_EXT.get(r.rsplit(".", 1)[-1].lower(), "other") for r in rels]
+    titles = [os.path.splitext(os.path.basename(r))[0] or r for r in rels]
+    cur.execute(
+        """
+        INSERT INTO media_items (rel_path, kind, title)
+        SELECT * FROM unnest(%s::text[], %s::media_kind_enum[], %s::text[])
+        ON CONFLICT (rel_path) DO NOTHING
+        """,
+        (rels, kinds, titles),
+    )
+    rels = list(known) + rels
+    cur.execute("SELECT rel_path, id::text FROM media_items WHERE rel_path = ANY(%s)", (rels,))
+    return {_track_path(r): mid for r, mid in cur.fetchall()}
+
+def load_album_tracks(cur, album_id, metadata=None) -> list[dict]:
+    rows = run_query(cur, Q_ALBUM_TRACKS, (album_id,)).fetchall()
+    if not rows and metadata and metadata.get("tracks"):
+        # not migrated yet (see `app.py migratetracks`)
+        return [{"label": label, "path": path} for path, label in _clean_tracks(metadata["tracks"])]
+    return [{
+        "id": r[0],
+        "position": r[1],
+        "label": r[2] or os.path.splitext(os.path.basename(r[5] or ""))[0],
+        "path": _track_path(r[5]),
+        "variant": r[3],
+        "media_id": r[4],
+        "duration_sec": r[6],
+    } for r in rows]
+
+def _free_variant(taken: set, media_id: str) -> str:
+    variant, n = "", 2
+    while (media_id, variant) in taken:
+        variant, n = str(n), n + 1
+    taken.add((media_id, variant))
+    return variant
+
+def _flip_parked_positions(cur, album_id):
+    cur.execute("UPDATE album_tracks SET position = -position WHERE album_id = %s AND position < 0", (album_id,))
+
+def _insert_album_tracks(cur, album_id, items, taken: set):
+    """items: [(position, media_id, label)]"""
+    if not items:
+        return
+    variants = [_free_variant(taken, mid) for _, mid, _ in items]
+    cur.execute(
+        """
+        INSERT INTO album_tracks (album_id, position, media_id, label, variant)
+        SELECT %s::uuid, * FROM unnest(%s::int[], %s::uuid[], %s::text[], %s::text[])
+        """,
+        (album_id, [i[0] for i in items], [i[1] for i in items], [i[2] or None for i in items], variants),
+    )
+
+def sync_album_tracks(cur, album_id, tracks, allow_missing=False) -> None:
+    """Make album_tracks match `tracks` ([{path, label}]) touching only rows that differ."""
+    desired = _clean_tracks(tracks)
+    media_ids = ensure_media_items(cur, [p for p, _ in desired], allow_missing)
+    cur.execute(
+        "SELECT id::text, media_id::text, variant, position, COALESCE(label, '') "
+        "FROM album_tracks WHERE album_id = %s ORDER BY position",
+        (album_id,),
+    )
+    by_media: dict[str, list] = defaultdict(list)
+    for row in cur.fetchall():
+        by_media[row[1]].append(row)
+
+    keep, inserts = [], []
+    for pos, (path, label) in enumerate(desired, start=1):
+        mid = media_ids[path]
+        if by_media.get(mid):
+            keep.append((by_media[mid].pop(0), pos, label))
+        else:
+            inserts.append((pos, mid, label))
+
+    stale = [r[0] for rows in by_media.values() for r in rows]
+    if stale:
+        cur.execute("DELETE FROM album_tracks WHERE id = ANY(%s::uuid[])", (stale,))
+    changed = [(r[0], pos, label) for r, pos, label in keep if r[3] != pos or r[4] != label]
+    if changed:
+        cur.execute(
+            """
+            UPDATE album_tracks t
+            SET position = CASE WHEN v.pos = t.position THEN t.position ELSE -v.pos END,
+                label = NULLIF(v.label, '')
+            FROM unnest(%s::uuid[], %s::int[], %s::text[]) AS v(id, pos, label)
+            WHERE t.id = v.id
+            """,
+            ([c[0] for c in changed], [c[1] for c in changed], [c[2] for c in changed]),
+        )
+        _flip_parked_positions(cur, album_id)
+    taken = {(r[1], r[2]) for r, _, _ in keep}
+    _insert_album_tracks(cur, album_id, inserts, taken)
+    if stale or changed or inserts:
+        cur.execute("UPDATE albums SET updated_at = now() WHERE id = %s", (album_id,))
+
+def _owned_album(cur, album_id, uid) -> bool:
+    cur.execute("SELECT 1 FROM albums WHERE id=%s AND user_id=%s", (album_id, uid))
+    return cur.fetchone() is not None
+
 @api_auth.get("/me/albums/<string:album_id>/tracks")
 def api_album_tracks(album_id):
     uid = session.get("user_id")
@@ -963,9 +3654,102 @@ def api_album_tracks(album_id):
         row = cur.fetchone()
         if not row:
             return jsonify({"error": "not_found"}), 404
-        meta = row[0] or {}
-        tracks = meta.get("tracks") or []
-        return jsonify({"tracks": tracks}), 200
+        return jsonify({"tracks": load_album_tracks(cur, album_id, row[0])}), 200
+
+@api_auth.post("/me/albums/<string:album_id>/tracks")
+def api_album_tracks_insert(album_id):
+    """Insert tracks ([{path, label}]) before 1-based ``position`` (default: append)."""
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"error": "unauthorized"}), 401
+    payload = request.get_json(silent=True) or {}
+    items = _clean_tracks(payload.get("tracks"))
+    if not items:
+        return jsonify({"error": "tracks_required"}), 400
+
+    with get_conn() as conn, conn.cursor() as cur:
+        if not _owned_album(cur, album_id, uid):
+            return jsonify({"error": "not_found"}), 404
+        cur.execute(
+            "SELECT COALESCE(MAX(position), 0) FROM album_tracks WHERE album_id = %s", (album_id,)
+        )
+        count = cur.fetchone()[0]
+        position = payload.get("position")
+        position = count + 1 if not isinstance(position, int) else max(1, min(position, count + 1))
+        n = len(items)
+        if position <= count:
+            cur.execute(
+                "UPDATE album_tracks SET position = -(position + %s) WHERE album_id = %s AND position >= %s",
+                (n, album_id, position),
+            )
+            _flip_parked_positions(cur, album_id)
+        media_ids = ensure_media_items(cur, [p for p, _ in items])
+        cur.execute("SELECT media_id::text, variant FROM album_tracks WHERE album_id = %s", (album_id,))
+        taken = set(cur.fetchall())
+        _insert_album_tracks(
+            cur, album_id,
+            [(position + i, media_ids[path], label) for i, (path, label) in enumerate(items)],
+            taken,
+        )
+        cur.execute("UPDATE albums SET updated_at = now() WHERE id = %s", (album_id,))
+        conn.commit()
+        return jsonify({"tracks": load_album_tracks(cur, album_id)}), 201
+
+@api_auth.delete("/me/albums/<string:album_id>/tracks/<string:track_id>")
+def api_album_track_delete(album_id, track_id):
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"error": "unauthorized"}), 401
+    with get_conn() as conn, conn.cursor() as cur:
+        if not _owned_album(cur, album_id, uid):
+            return jsonify({"error": "not_found"}), 404
+        cur.execute(
+            "DELETE FROM album_tracks WHERE id = %s AND album_id = %s RETURNING position",
+            (track_id, album_id),
+        )
+        row = cur.fetchone()
+        if not row:
+            return jsonify({"error": "not_found"}), 404
+        cur.execute(
+            "UPDATE album_tracks SET position = -(position - 1) WHERE album_id = %s AND position > %s",
+            (album_id, row[0]),
+        )
+        _flip_parked_positions(cur, album_id)
+        cur.execute("UPDATE albums SET updated_at = now() WHERE id = %s", (album_id,))
+        conn.commit()
+    return jsonify({"ok": True}), 200
+
+@api_auth.put("/me/albums/<string:album_id>/tracks/reorder")
+def api_album_tracks_reorder(album_id):
+    """Body: {"order": [track_id, ...]} — a permutation of the album's track ids."""
+    uid = session.get("user_id")
+    if not uid:
+        return jsonify({"error": "unauthorized"}), 401
+    order = (request.get_json(silent=True) or {}).get("order")
+    if not isinstance(order, list) or not order:
+        return jsonify({"error": "order_required"}), 400
+
+    with get_conn() as conn, conn.cursor() as cur:
+        if not _owned_album(cur, album_id, uid):
+            return jsonify({"error": "not_found"}), 404
+        cur.execute("SELECT id::text, position FROM album_tracks WHERE album_id = %s", (album_id,))
+        current = dict(cur.fetchall())
+        if sorted(map(str, order)) != sorted(current):
+            return jsonify({"error": "order_mismatch"}), 409
+        moved = [(str(tid), pos) for pos, tid in enumerate(order, start=1) if current[str(tid)] != pos]
+        if moved:
+            cur.execute(
+                """
+                UPDATE album_tracks t SET position = -v.pos
+                FROM unnest(%s::uuid[], %s::int[]) AS v(id, pos)
+                WHERE t.id = v.id
+                """,
+                ([m[0] for m in moved], [m[1] for m in moved]),
+            )
+            _flip_parked_positions(cur, album_id)
+            cur.execute("UPDATE albums SET updated_at = now() WHERE id = %s", (album_id,))
+        conn.commit()
+    return jsonify({"ok": True, "moved": len(moved)}), 200
 
 @api_auth.post("/me/albums/<string:album_id>/cover")
 def api_album_upload_cover(album_id):
@@ -982,19 +3766,59 @@ def api_album_upload_cover(album_id):
         if not cur.fetchone():
             return jsonify({"error": "not_found"}), 404
 
-        name = secure_filename(file.filename)
-        root = os.path.join(app.root_path, "static", "album_covers")
-        os.makedirs(root, exist_ok=True)
-        base, ext = os.path.splitext(name or "cover")
-        fname = f"{album_id}{ext.lower() or '.jpg'}"
-        path_fs = os.path.join(root, fname)
-        file.save(path_fs)
-
-        url_rel = f"/static/album_covers/{fname}"
-        cur.execute("UPDATE albums SET cover_path=%s, updated_at=now() WHERE id=%s AND user_id=%s", (url_rel, album_id, uid))
+        try:
+            saved = save_image_upload(file, "album_covers", str(album_id))
+        except ValueError:
+            return jsonify({"error": "file_too_large", "max_bytes": IMAGE_UPLOAD_MAX_BYTES}), 413
+        if saved is None:
+            return jsonify({"error": "not_an_image"}), 400
+        url_rel, path_fs = saved
+        cover_url = owner_image_url("album", album_id)
+        replaced = record_image_upload(cur, "album", album_id, url_rel)
+        cur.execute("UPDATE albums SET cover_path=%s, updated_at=now() WHERE id=%s AND user_id=%s", (cover_url, album_id, uid))
         conn.commit()
 
-    return jsonify({"cover_url": url_rel}), 200
+    remove_image_upload(replaced)
+    queue_image_renditions("album", album_id, path_fs, url_rel)
+    return jsonify({"cover_url": cover_url, "cover_srcset": rendition_srcset("album", album_id)}), 202
+
+@app.route("/img/<string:owner_kind>/<string:owner_id>/<int:width>", methods=["GET"])
+@cache_policy("manual")
+def image_rendition(owner_kind, owner_id, width):
+    """Smallest rendition at least `width` px wide (WebP when accepted), for srcset/sizes; a
+    placeholder while an uploaded image is still being rendered."""
+    if owner_kind not in ("album", "avatar"):
+        abort(404)
+    fmt = "webp" if request.accept_mimetypes["image/webp"] else "jpeg"
+    row = query_one(
+        """
+        SELECT path, extract(epoch FROM max(created_at) OVER ())::bigint FROM image_renditions
+        WHERE owner_kind = %s AND owner_id = %s AND format = %s
+        ORDER BY (width >= %s) DESC, CASE WHEN width >= %s THEN width ELSE -width END
+        LIMIT 1
+        """,
+        (owner_kind, owner_id, fmt, width, width),
+    )
+    if not row:
+        # uploaded but not rendered yet: placeholder, revalidated until the renditions exist
+        if not query_one("SELECT 1 FROM image_uploads WHERE owner_kind = %s AND owner_id = %s",
+                         (owner_kind, owner_id)):
+            abort(404)
+        resp = send_file(os.path.join(app.static_folder, IMAGE_PLACEHOLDERS[owner_kind]), conditional=True, max_age=0)
+        resp.cache_control.no_cache = True
+        resp.vary.add("Accept")
+        return resp
+    resp = send_file(os.path.join(app.static_folder, row[0]), conditional=True, max_age=0)
+    resp.vary.add("Accept")
+    if request.args.get("v") == str(row[1]):
+        # ?v= names the current rendition set; a re-upload changes it (see rendition_srcset)
+        resp.cache_control.no_cache = None
+        resp.cache_control.public = True
+        resp.cache_control.max_age = IMMUTABLE_MAX_AGE
+        resp.cache_control.immutable = True
+    else:
+        resp.cache_control.no_cache = True
+    return resp
 
 @api_auth.delete("/me/albums/<string:album_id>")
 def api_album_delete(album_id):
@@ -1016,64 +3840,93 @@ def api_album_clone(album_id):
     if not uid:
         return jsonify({"ok": False, "error": "unauthorized"}), 401
     with get_conn() as conn, conn.cursor(row_factory=dict_row) as cur:
+        # album row + all its tracks in one statement, whatever the album size
         cur.execute(
             """
-            SELECT id, title, subtitle, description_md, cover_path, visibility, metadata
-            FROM albums
-            WHERE id = %s AND user_id = %s
+            WITH src AS (
+                SELECT id, title, subtitle, description_md, cover_path, visibility, metadata
+                FROM albums
+                WHERE id = %(src)s AND user_id = %(uid)s
+            ), new_album AS (
+                INSERT INTO albums (slug, title, subtitle, description_md, cover_path, visibility, metadata, user_id)
+                SELECT uuid_generate_v4()::text, COALESCE(title, 'Untitled') || ' (Copy)', subtitle,
+                       COALESCE(description_md, ''), cover_path, visibility, COALESCE(metadata, '{}'::jsonb), %(uid)s
+                FROM src
+                RETURNING id, slug, title, subtitle, description_md, cover_path, visibility, metadata, created_at, updated_at
+            ), copied AS (
+                INSERT INTO album_tracks (album_id, media_id, position, variant, notes, label)
+                SELECT n.id, t.media_id, t.position, t.variant, t.notes, t.label
+                FROM album_tracks t CROSS JOIN new_album n
+                WHERE t.album_id = %(src)s
+                RETURNING 1
+            )
+            SELECT n.*, (SELECT COUNT(*) FROM copied) AS track_count FROM new_album n
             """,
-            (album_id, uid)
+            {"src": album_id, "uid": uid},
         )
-        src = cur.fetchone()
-        if not src:
+        new_album = cur.fetchone()
+        if not new_album:
             return jsonify({"ok": False, "error": "not_found_or_forbidden"}), 404
+        conn.commit()
+
+    resp = dict(new_album)
+    resp["cover_url"] = resp.pop("cover_path", None)
+    track_count = resp.pop("track_count")
+    return jsonify({"ok": True, "album": resp, "track_count": track_count}), 201
+
+@app.route("/dev/albums/clone", methods=["POST"])
+@login_required
+def dev_albums_clone():
+    """Admin: duplicate a user's albums (all, or ``album_ids``) with their tracks.
 
-        new_title = (src["title"] or "Untitled") + " (Copy)"
-        new_subtitle = src.get("subtitle")
-        new_desc = src.get("description_md") or ""
-        new_cover_path = src.get("cover_path")
-        new_visibility = src.get("visibility") or "private"
-        new_metadata = src.get("metadata") or {}
+    Body: {"source_user_id": int, "target_user_id": int (default: source), "album_ids": [uuid]}
+    """
+    if not is_admin():
+        return jsonify({"error": "Forbidden"}), 403
+    data = request.get_json(silent=True) or {}
+    source = data.get("source_user_id")
+    target = data.get("target_user_id", source)
+    album_ids = data.get("album_ids")
+    if not isinstance(source, int) or not isinstance(target, int):
+        return jsonify({"error": "source_user_id and target_user_id must be integers"}), 400
+    if album_ids is not None and not (isinstance(album_ids, list) and all(isinstance(a, str) for a in album_ids)):
+        return jsonify({"error": "album_ids must be a list of ids"}), 400
+    suffix = " (Copy)" if source == target else ""
 
+    with get_conn() as conn, conn.cursor() as cur:
         cur.execute(
             """
-            INSERT INTO albums (slug, title, subtitle, description_md, cover_path, visibility, metadata, user_id)
-            VALUES (uuid_generate_v4()::text, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id, slug, title, subtitle, description_md, cover_path, visibility, metadata, created_at, updated_at
+            WITH src AS (
+                SELECT * FROM albums
+                WHERE user_id = %(source)s AND (%(ids)s::uuid[] IS NULL OR id = ANY(%(ids)s::uuid[]))
+            ), mapping AS MATERIALIZED (
+                SELECT id AS old_id, uuid_generate_v4() AS new_id FROM src
+            ), new_albums AS (
+                INSERT INTO albums (id, slug, title, subtitle, description_md, cover_path, visibility,
+                                    release_date, metadata, user_id)
+                SELECT m.new_id, m.new_id::text, s.title || %(suffix)s, s.subtitle, s.description_md, s.cover_path,
+                       s.visibility, s.release_date, s.metadata, %(target)s
+                FROM src s JOIN mapping m ON m.old_id = s.id
+                RETURNING id
+            ), copied AS (
+                INSERT INTO album_tracks (album_id, media_id, position, variant, notes, label)
+                SELECT m.new_id, t.media_id, t.position, t.variant, t.notes, t.label
+                FROM album_tracks t JOIN mapping m ON m.old_id = t.album_id
+                RETURNING 1
+            )
+            SELECT (SELECT COUNT(*) FROM new_albums), (SELECT COUNT(*) FROM copied)
             """,
-            (new_title, new_subtitle, new_desc, new_cover_path, new_visibility, PgJson(new_metadata), uid),
-        )
-        new_album = cur.fetchone()
-
-        cur.execute(
-            "SELECT media_id, position, variant, notes FROM album_tracks WHERE album_id = %s ORDER BY position ASC",
-            (album_id,)
+            {"source": source, "target": target, "ids": album_ids, "suffix": suffix},
         )
-        for t in cur.fetchall() or []:
-            cur.execute(
-                """
-                INSERT INTO album_tracks (album_id, media_id, position, variant, notes)
-                VALUES (%s, %s, %s, %s, %s)
-                """,
-                (str(new_album["id"]), str(t["media_id"]), int(t["position"]), t.get("variant") or "", t.get("notes"))
-            )
+        albums, tracks = cur.fetchone()
         conn.commit()
-
-    resp = dict(new_album)
-    resp["cover_url"] = resp.pop("cover_path", None)
-    return jsonify({"ok": True, "album": resp}), 201
+    return jsonify({"ok": True, "albums": albums, "tracks": tracks}), 201
 
 @api_auth.post("/logout")
 def api_logout():
     uid = session.get("user_id")
     session.pop("user_id", None)
-    with get_conn() as conn, conn.cursor() as cur:
-        cur.execute(
-            "INSERT INTO user_activity_log(user_id, activity_type, user_agent, ip_address) "
-            "VALUES (%s,%s,%s,%s)",
-            (uid, "logout", request.headers.get("User-Agent"), request.remote_addr)
-        )
-        conn.commit()
+    log_user_activity(uid, "logout")
     return jsonify({"ok": True}), 200
 
 # Register blueprint
@@ -1104,17 +3957,38 @@ if __name__ == '__main__':
     p_run.add_argument('--no-ssl', action='store_true', help='Disable HTTPS (use HTTP)')
     p_run.add_argument('--no-reload', action='store_true', help='Disable code auto-reload')
 
-    sub.add_parser('initdb', help='Initialize database (calls initdb/init_db)')
+    p_initdb = sub.add_parser('initdb', help='Initialize database (calls initdb/init_db)')
+    p_initdb.add_argument('--partition-activity', action='store_true',
+                          help='Create (or convert) user_activity_log as monthly range partitions')
+    p_initdb.add_argument('--per-user-slugs', action='store_true',
+                          help='Drop the global albums_slug_key (slugs stay unique per user)')
     sub.add_parser('seedadmin', help='Seed admin user (calls seedadmin/seed_admin)')
+    sub.add_parser('migratetracks', help='Move albums.metadata tracks into album_tracks')
+
+    p_scan = sub.add_parser('scanmedia', help='Index files under MEDIA_ROOT into media_items (incremental)')
+    p_scan.add_argument('--root', default=None, help='Directory to scan (default: MEDIA_ROOT)')
+    p_scan.add_argument('--jobs', type=int, default=None, help='Probe processes (default: CPU count)')
+    p_scan.add_argument('--full', action='store_true', help='Re-probe files even if size/mtime are unchanged')
+
+    p_peaks = sub.add_parser('peaks', help='Precompute waveform peaks for catalogued audio (needs ffmpeg)')
+    p_peaks.add_argument('--jobs', type=int, default=None, help='Worker processes (default: CPU count)')
+    p_peaks.add_argument('--force', action='store_true', help='Regenerate even if peaks files exist')
+
+    p_rend = sub.add_parser('renditions', help='Build low-bitrate MP3 + HLS renditions (needs ffmpeg)')
+    p_rend.add_argument('--jobs', type=int, default=None, help='Worker processes (default: CPU count)')
+    p_rend.add_argument('--force', action='store_true', help='Rebuild even if renditions exist')
+    p_rend.add_argument('--min-kbps', type=int, default=0, help='Only files whose catalogued bitrate is at least this')
+
+    p_act = sub.add_parser('activitylog', help='Create future activity partitions, expire old ones, refresh rollups')
+    p_act.add_argument('--ahead', type=int, default=ACTIVITY_PARTITIONS_AHEAD, help='Months of partitions to pre-create')
+    p_act.add_argument('--retain', type=int, default=ACTIVITY_RETAIN_MONTHS, help='Months to keep (0 = forever)')
+    p_act.add_argument('--archive-dir', default=ACTIVITY_ARCHIVE_DIR, help='Dump expired partitions here (csv.gz) before dropping')
+    p_act.add_argument('--rollup-days', type=int, default=2, help='Recompute daily rollups for this many days')
 
     args = parser.parse_args(None if len(sys.argv) > 1 else ['run'])
 
     if args.cmd == 'initdb':
-        if not _call_first_available(['initdb', 'init_db', 'cmd_initdb']):
-            print('No initdb/init_db()/cmd_initdb() found.', file=sys.stderr)
-            sys.exit(2)
-        else:
-            cmd_initdb()
+        cmd_initdb(partition_activity=args.partition_activity, per_user_slugs=args.per_user_slugs)
         sys.exit(0)
 
     if args.cmd == 'seedadmin':
@@ -1125,6 +3999,27 @@ if __name__ == '__main__':
             cmd_seedadmin()
         sys.exit(0)
 
+    if args.cmd == 'scanmedia':
+        cmd_scanmedia(root=args.root, jobs=args.jobs, full=args.full)
+        sys.exit(0)
+
+    if args.cmd == 'renditions':
+        cmd_renditions(jobs=args.jobs, force=args.force, min_kbps=args.min_kbps)
+        sys.exit(0)
+
+    if args.cmd == 'peaks':
+        cmd_peaks(jobs=args.jobs, force=args.force)
+        sys.exit(0)
+
+    if args.cmd == 'migratetracks':
+        cmd_migratetracks()
+        sys.exit(0)
+
+    if args.cmd == 'activitylog':
+        cmd_activitylog(ahead=args.ahead, retain_months=args.retain,
+                        archive_dir=args.archive_dir, rollup_days=args.rollup_days)
+        sys.exit(0)
+
     host = getattr(args, 'host', os.environ.get('FLASK_HOST', '0.0.0.0'))
     port = int(getattr(args, 'port', os.environ.get('FLASK_PORT', '5000')))
     use_ssl = not getattr(args, 'no_ssl', False)
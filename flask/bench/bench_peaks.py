@@ -0,0 +1,77 @@
+"""Peaks benchmark: NumPy reduction throughput and /media/<path>/peaks latency.
+
+Runs offline against synthetic PCM and a temporary media/peaks root:
+
+    python bench/bench_peaks.py --minutes 60 --requests 500
+"""
+import argparse, json, os, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import numpy as np
+import app as studio
+
+
+def pct(samples, p):
+    s = sorted(samples)
+    return s[min(len(s) - 1, int(len(s) * p / 100))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--minutes', type=float, default=60.0, help='Length of synthetic track')
+    ap.add_argument('--reps', type=int, default=5)
+    ap.add_argument('--requests', type=int, default=500)
+    args = ap.parse_args()
+
+    rng = np.random.default_rng(333)
+    n = int(args.minutes * 60 * studio.PEAKS_SAMPLE_RATE)
+    pcm = rng.integers(-32768, 32767, size=n, dtype=np.int16)
+
+    times = []
+    for _ in range(args.reps):
+        t0 = time.perf_counter()
+        levels = studio.compute_peaks(pcm)
+        times.append(time.perf_counter() - t0)
+    best = min(times)
+
+    tmp = tempfile.mkdtemp(prefix='peaks-bench-')
+    studio.MEDIA_ROOT = os.path.join(tmp, 'media')
+    studio.PEAKS_ROOT = os.path.join(tmp, 'peaks')
+    rel = 'archives/bench/track.mp3'
+    os.makedirs(os.path.dirname(os.path.join(studio.MEDIA_ROOT, rel)))
+    with open(os.path.join(studio.MEDIA_ROOT, rel), 'wb') as fh:
+        fh.write(b'\0' * 1024)
+    key = studio.media_file_key(rel, os.stat(os.path.join(studio.MEDIA_ROOT, rel)))
+    for spp, (mins, maxs) in levels.items():
+        studio.write_peaks_dat(studio.peaks_path(key, spp), spp, mins, maxs)
+
+    client = studio.app.test_client()
+    url = f'/media/{rel}/peaks'
+    lat, etag, size = [], None, 0
+    for _ in range(args.requests):
+        t0 = time.perf_counter()
+        r = client.get(url)
+        lat.append((time.perf_counter() - t0) * 1000)
+        etag, size = r.headers.get('ETag'), len(r.data)
+    cond = []
+    for _ in range(args.requests):
+        t0 = time.perf_counter()
+        client.get(url, headers={'If-None-Match': etag})
+        cond.append((time.perf_counter() - t0) * 1000)
+
+    print(json.dumps({
+        'compute': {
+            'audio_seconds': n / studio.PEAKS_SAMPLE_RATE,
+            'best_s': round(best, 4),
+            'mean_s': round(statistics.mean(times), 4),
+            'realtime_factor': round(n / studio.PEAKS_SAMPLE_RATE / best, 1),
+        },
+        'endpoint_200': {'bytes': size, 'p50_ms': round(pct(lat, 50), 3),
+                         'p95_ms': round(pct(lat, 95), 3), 'p99_ms': round(pct(lat, 99), 3)},
+        'endpoint_304': {'p50_ms': round(pct(cond, 50), 3),
+                         'p95_ms': round(pct(cond, 95), 3), 'p99_ms': round(pct(cond, 99), 3)},
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
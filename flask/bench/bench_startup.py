@@ -0,0 +1,76 @@
+"""Startup benchmark: `-X importtime` report for app.py and CLI time to first output.
+
+Each sample is a fresh interpreter, so this is what a gunicorn worker boot (without preload)
+or a `python app.py initdb` pays before doing any work:
+
+    python bench/bench_startup.py --runs 7 --top 15
+
+Exits 1 when the median `import app` time exceeds --budget-ms (default 450, or
+STARTUP_BUDGET_MS; 0 disables the check).
+"""
+import argparse, json, os, re, statistics, subprocess, sys, time
+
+HERE = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|(\s*)(\S+)")
+
+
+def importtime(python):
+    """One `import app` under -X importtime -> (total_us, {top-level module: cumulative_us})."""
+    proc = subprocess.run([python, "-X", "importtime", "-c", "import app"],
+                          cwd=HERE, capture_output=True, text=True, check=True)
+    total, direct = 0, {}
+    for line in proc.stderr.splitlines():
+        m = LINE.match(line)
+        if not m:
+            continue
+        self_us, cum_us, indent, name = int(m[1]), int(m[2]), len(m[3]), m[4]
+        if name == "app":
+            total = cum_us
+        elif indent == 3:          # imported directly by app.py
+            direct[name] = cum_us
+    return total, direct
+
+
+def first_output(python):
+    """Wall time until `python app.py --help` has printed its usage (import + argparse)."""
+    t0 = time.perf_counter()
+    subprocess.run([python, "app.py", "--help"], cwd=HERE, capture_output=True, check=True)
+    return time.perf_counter() - t0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--runs", type=int, default=7)
+    ap.add_argument("--top", type=int, default=15, help="Slowest direct imports to list")
+    ap.add_argument("--budget-ms", type=float, default=float(os.getenv("STARTUP_BUDGET_MS", 450)),
+                    help="Fail if median import exceeds this (0 = report only)")
+    ap.add_argument("--python", default=sys.executable)
+    args = ap.parse_args()
+
+    importtime(args.python)    # warm the filesystem cache and __pycache__
+    totals, per_module = [], {}
+    for _ in range(args.runs):
+        total, direct = importtime(args.python)
+        totals.append(total / 1000)
+        for name, us in direct.items():
+            per_module.setdefault(name, []).append(us / 1000)
+    cli = [first_output(args.python) * 1000 for _ in range(args.runs)]
+
+    median_ms = statistics.median(totals)
+    top = sorted(((statistics.median(v), k) for k, v in per_module.items()), reverse=True)[:args.top]
+    report = {
+        "import_app_ms": {"median": round(median_ms, 1), "min": round(min(totals), 1),
+                          "max": round(max(totals), 1)},
+        "cli_first_output_ms": {"median": round(statistics.median(cli), 1), "min": round(min(cli), 1)},
+        "slowest_direct_imports_ms": {k: round(v, 1) for v, k in top},
+    }
+    if args.budget_ms:
+        report["budget_ms"] = args.budget_ms
+        report["within_budget"] = median_ms <= args.budget_ms
+    print(json.dumps(report, indent=2))
+    if args.budget_ms and median_ms > args.budget_ms:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,484 @@
+"""Load test for the auth/album/media APIs against a local PostgreSQL + the real gunicorn config.
+
+Everything runs on one box, offline. Use a throwaway database: `seed` writes into it.
+
+    # schema (app.py initdb) + generated users/albums/tracks/media/activity rows
+    DB_NAME=studio333_bench python bench/loadtest.py seed --scale 100000
+
+    # start gunicorn -c gunicorn.conf.py on a spare port, drive every scenario, write JSON
+    DB_NAME=studio333_bench python bench/loadtest.py run --duration 20 --concurrency 8 --out before.json
+
+    # compare two runs (exit status 1 if p95 or req/s regressed by more than --threshold)
+    python bench/loadtest.py compare before.json after.json
+
+Scales: 1000 / 100000 / 1000000 albums (same number of media_items and activity rows,
+--tracks-per-album album_tracks rows each). Bench users are bench<N>@bench.local with
+--password (default "bench"). The `race` scenario fires concurrent POST /me/albums with the
+same title and checks every request got its own slug.
+"""
+import argparse, ast, http.client, json, os, platform, random, re, shutil, signal, subprocess, sys, tempfile
+import threading, time, uuid
+from datetime import datetime, timedelta, timezone
+
+FLASK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_MEDIA_REL = "archives/_bench/range-sample.mp3"
+BENCH_MEDIA_BYTES = 32 * 1024 * 1024
+SCENARIOS = ("login", "me", "albums", "tracks", "clone", "media_range", "search")
+
+
+def _db_env():
+    return {
+        "dbname": os.getenv("DB_NAME", "studio333_bench"),
+        "user": os.getenv("DB_USER", "studio333"),
+        "password": os.getenv("DB_PASSWORD", "studio333"),
+        "host": os.getenv("DB_HOST", "localhost"),
+        "port": int(os.getenv("DB_PORT", 5432)),
+    }
+
+
+def _connect():
+    import psycopg
+    return psycopg.connect(**_db_env())
+
+
+# ----------------------------
+# seed
+# ----------------------------
+def cmd_seed(args):
+    from werkzeug.security import generate_password_hash
+
+    env = dict(os.environ, DB_NAME=_db_env()["dbname"])
+    initdb = [sys.executable, "app.py", "initdb"] + (["--partition-activity"] if args.partition_activity else [])
+    subprocess.run(initdb, cwd=FLASK_DIR, env=env, check=True)
+
+    scale, per_album = args.scale, args.tracks_per_album
+    n_users = args.users or max(10, scale // 1000)
+    rng = random.Random(args.seed)
+    phash = generate_password_hash(args.password)
+    t0 = time.monotonic()
+    with _connect() as conn, conn.cursor() as cur:
+        # re-seeding replaces earlier bench rows (activity rows reference users without a cascade)
+        bench_users = "SELECT id FROM users WHERE email LIKE 'bench%%@bench.local'"
+        cur.execute(f"DELETE FROM user_activity_log WHERE user_id IN ({bench_users})")
+        cur.execute(f"DELETE FROM albums WHERE user_id IN ({bench_users})")
+        cur.execute("DELETE FROM users WHERE email LIKE 'bench%%@bench.local'")
+        cur.execute("DELETE FROM media_items WHERE rel_path LIKE 'archives/bench/%%'")
+        with cur.copy("COPY users (email, password_hash, role, nickname, is_verified) FROM STDIN") as cp:
+            for u in range(n_users):
+                cp.write_row((f"bench{u}@bench.local", phash, "admin" if u == 0 else "user", f"Bench {u}", True))
+        cur.execute("SELECT id FROM users WHERE email LIKE 'bench%%@bench.local' ORDER BY id")
+        user_ids = [r[0] for r in cur.fetchall()]
+
+        artists = ["2g", "Hyenaz", "Kuzniak", "Teicher", "Studio 333", "Noise Unit", "Bart", "Puzzle"]
+        media_ids = [uuid.uuid4() for _ in range(scale)]
+        with cur.copy("COPY media_items (id, kind, title, rel_path, duration_sec, size_bytes, metadata) FROM STDIN") as cp:
+            for i, mid in enumerate(media_ids):
+                artist = rng.choice(artists)
+                cp.write_row((mid, "audio", f"Track {i}", f"archives/bench/{i // 1000:04d}/{i:07d}.mp3",
+                              rng.randint(60, 3600), rng.randint(1, 200) * 1_000_000,
+                              json.dumps({"tags": {"artist": artist, "album": f"Session {i // 12}"}})))
+        print(f"media_items: {scale} rows ({time.monotonic() - t0:.1f}s)")
+
+        album_ids = [uuid.uuid4() for _ in range(scale)]
+        now = datetime.now(timezone.utc)
+        with cur.copy("COPY albums (id, user_id, slug, title, subtitle, description_md, visibility, created_at) FROM STDIN") as cp:
+            for i, aid in enumerate(album_ids):
+                cp.write_row((aid, user_ids[i % n_users], f"album-{i}", f"Album {i}", rng.choice(artists),
+                              f"Live recording {i}, {rng.choice(artists)} at Studio 333.", "private",
+                              now - timedelta(minutes=i)))
+        print(f"albums: {scale} rows ({time.monotonic() - t0:.1f}s)")
+
+        with cur.copy("COPY album_tracks (album_id, media_id, position, label) FROM STDIN") as cp:
+            for i, aid in enumerate(album_ids):
+                for j in range(per_album):
+                    cp.write_row((aid, media_ids[(i * per_album + j) % scale], j + 1, f"Track {j + 1}"))
+        print(f"album_tracks: {scale * per_album} rows ({time.monotonic() - t0:.1f}s)")
+
+        kinds = ["login", "login", "login", "login_failed_bad_password", "login_failed_no_user"]
+        with cur.copy("COPY user_activity_log (user_id, activity_type, user_agent, ip_address, context, timestamp) FROM STDIN") as cp:
+            for i in range(scale):
+                cp.write_row((rng.choice(user_ids), rng.choice(kinds), "bench", "127.0.0.1", "{}",
+                              now - timedelta(seconds=rng.randint(0, 90 * 86400))))
+        print(f"user_activity_log: {scale} rows ({time.monotonic() - t0:.1f}s)")
+        conn.commit()
+    with _connect() as conn:
+        conn.autocommit = True
+        conn.execute("ANALYZE")
+    print(f"Seeded scale={scale} users={n_users} in {time.monotonic() - t0:.1f}s.")
+
+
+# ----------------------------
+# HTTP client
+# ----------------------------
+class Client:
+    """One keep-alive connection with a cookie jar (one per load thread)."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.cookies = {}
+        self.conn = http.client.HTTPConnection(host, port, timeout=60)
+
+    def request(self, method, path, body=None, headers=None):
+        hdrs = dict(headers or {})
+        if self.cookies:
+            hdrs["Cookie"] = "; ".join(f"{k}={v}" for k, v in self.cookies.items())
+        if body is not None:
+            body = json.dumps(body).encode()
+            hdrs["Content-Type"] = "application/json"
+        for attempt in (0, 1):
+            try:
+                self.conn.request(method, path, body=body, headers=hdrs)
+                resp = self.conn.getresponse()
+                data = resp.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                self.conn.close()
+                self.conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+                if attempt:
+                    raise
+        for value in resp.headers.get_all("Set-Cookie") or []:
+            name, _, rest = value.partition("=")
+            self.cookies[name.strip()] = rest.split(";", 1)[0]
+        return resp.status, data
+
+    def login(self, email, password, attempts=20):
+        self.cookies.clear()
+        for _ in range(attempts):
+            status, data = self.request("POST", "/login", {"email": email, "password": password})
+            if status != 503:   # auth_busy: another login holds this worker's hash slot
+                break
+            time.sleep(0.05 + random.random() * 0.1)
+        if status != 200:
+            raise RuntimeError(f"login failed for {email}: {status} {data[:200]!r}")
+
+
+def _pct(sorted_ms, p):
+    if not sorted_ms:
+        return None
+    return round(sorted_ms[min(len(sorted_ms) - 1, int(len(sorted_ms) * p / 100))], 3)
+
+
+def _summarize(samples, errors, statuses, wall):
+    lat = sorted(samples)
+    return {
+        "requests": len(lat) + errors, "errors": errors,
+        "rps": round((len(lat) + errors) / wall, 1) if wall else 0.0,
+        "p50_ms": _pct(lat, 50), "p95_ms": _pct(lat, 95), "p99_ms": _pct(lat, 99),
+        "max_ms": round(lat[-1], 3) if lat else None,
+        "status": {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+# ----------------------------
+# scenarios: fn(client, state, rng) -> (status, ok)
+# ----------------------------
+def _sc_login(c, st, rng):
+    status, _ = c.request("POST", "/login", {"email": st["email"], "password": st["password"]})
+    return status, status == 200
+
+def _sc_me(c, st, rng):
+    status, _ = c.request("GET", "/me")
+    return status, status == 200
+
+def _sc_albums(c, st, rng):
+    status, _ = c.request("GET", "/me/albums?limit=50")
+    return status, status == 200
+
+def _sc_tracks(c, st, rng):
+    status, _ = c.request("GET", f"/me/albums/{rng.choice(st['albums'])}/tracks")
+    return status, status == 200
+
+def _sc_clone(c, st, rng):
+    status, data = c.request("POST", f"/me/albums/{rng.choice(st['albums'])}/clone")
+    if status == 201:
+        st["created"].append(json.loads(data)["album"]["id"])
+    return status, status == 201
+
+def _sc_media_range(c, st, rng):
+    start = rng.randrange(0, BENCH_MEDIA_BYTES - 65536)
+    status, data = c.request("GET", f"/media/{BENCH_MEDIA_REL}", headers={"Range": f"bytes={start}-{start + 65535}"})
+    return status, status == 206 and len(data) == 65536
+
+def _sc_search(c, st, rng):
+    q = rng.choice(["2g", "hyenaz", "hyen", "album 12", "live studio", "kuzniak", "noise"])
+    status, _ = c.request("GET", f"/me/search?q={q.replace(' ', '+')}&limit=20")
+    return status, status == 200
+
+SCENARIO_FNS = {
+    "login": _sc_login, "me": _sc_me, "albums": _sc_albums, "tracks": _sc_tracks,
+    "clone": _sc_clone, "media_range": _sc_media_range, "search": _sc_search,
+}
+
+
+def run_scenario(name, host, port, users, password, duration, concurrency, seed):
+    fn = SCENARIO_FNS[name]
+    samples, statuses, lock = [], {}, threading.Lock()
+    errors = [0]
+    created = []
+    start_gate = threading.Barrier(concurrency + 1)
+    stop_at = [0.0]
+
+    def worker(ix):
+        rng = random.Random(seed * 1000 + ix)
+        c = Client(host, port)
+        email = f"bench{ix % users}@bench.local"
+        try:
+            c.login(email, password)
+            _, data = c.request("GET", "/me/albums?limit=200&fields=id")
+            st = {"email": email, "password": password, "created": [],
+                  "albums": [a["id"] for a in json.loads(data)["albums"]]}
+        except Exception as e:
+            print(f"{name}: worker {ix} setup failed: {e}", file=sys.stderr)
+            start_gate.abort()
+            return
+        local, local_status, local_err = [], {}, 0
+        try:
+            start_gate.wait()
+        except threading.BrokenBarrierError:
+            return
+        while time.perf_counter() < stop_at[0]:
+            t0 = time.perf_counter()
+            try:
+                status, ok = fn(c, st, rng)
+            except Exception:
+                status, ok = "exception", False
+            ms = (time.perf_counter() - t0) * 1000
+            local_status[status] = local_status.get(status, 0) + 1
+            if ok:
+                local.append(ms)
+            else:
+                local_err += 1
+        for aid in st["created"]:
+            c.request("DELETE", f"/me/albums/{aid}")
+        with lock:
+            samples.extend(local)
+            errors[0] += local_err
+            created.extend(st["created"])
+            for k, v in local_status.items():
+                statuses[k] = statuses.get(k, 0) + v
+
+    threads = [threading.Thread(target=worker, args=(i,), daemon=True) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    stop_at[0] = time.perf_counter() + duration + 3600  # placeholder until every worker has logged in
+    try:
+        start_gate.wait()
+    except threading.BrokenBarrierError:
+        raise RuntimeError(f"{name}: load threads could not log in (is the DB seeded?)")
+    t_start = time.perf_counter()
+    stop_at[0] = t_start + duration
+    for t in threads:
+        t.join()
+    return _summarize(samples, errors[0], statuses, time.perf_counter() - t_start)
+
+
+def run_race(host, port, password, concurrency, rounds):
+    """Concurrent creates of the same title by one user must all succeed with distinct slugs."""
+    result = {"rounds": rounds, "concurrency": concurrency, "requests": 0, "created": 0,
+              "errors": 0, "duplicate_slugs": 0, "latency": None}
+    clients = []
+    for _ in range(concurrency):
+        c = Client(host, port)
+        c.login("bench0@bench.local", password)
+        clients.append(c)
+    samples = []
+    for r in range(rounds):
+        title = f"Bench Race {uuid.uuid4().hex[:8]}"
+        gate = threading.Barrier(concurrency)
+        out = []
+
+        def fire(c):
+            gate.wait()
+            t0 = time.perf_counter()
+            status, data = c.request("POST", "/me/albums", {"title": title})
+            out.append((status, data, (time.perf_counter() - t0) * 1000))
+
+        threads = [threading.Thread(target=fire, args=(c,)) for c in clients]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        ids = [json.loads(d)["album"]["id"] for s, d, _ in out if s == 201]
+        samples += [ms for s, _, ms in out if s == 201]
+        result["requests"] += len(out)
+        result["created"] += len(ids)
+        result["errors"] += len(out) - len(ids)
+        with _connect() as conn, conn.cursor() as cur:
+            cur.execute("SELECT count(*) - count(DISTINCT slug) FROM albums WHERE id = ANY(%s::uuid[])", (ids,))
+            result["duplicate_slugs"] += cur.fetchone()[0]
+            cur.execute("DELETE FROM albums WHERE id = ANY(%s::uuid[])", (ids,))
+            conn.commit()
+    result["ok"] = result["errors"] == 0 and result["duplicate_slugs"] == 0
+    result["latency"] = _summarize(samples, 0, {}, 1.0)
+    result["latency"].pop("rps")
+    return result
+
+
+# ----------------------------
+# gunicorn
+# ----------------------------
+def _start_gunicorn(port, workdir, extra_env):
+    env = dict(os.environ, **extra_env)
+    env["PROMETHEUS_MULTIPROC_DIR"] = os.path.join(workdir, "prometheus")
+    env.pop("STUDIO333_PROMETHEUS_DIR_READY", None)
+    cmd = [sys.executable, "-m", "gunicorn", "-c", "gunicorn.conf.py",
+           "--bind", f"127.0.0.1:{port}", "--pid", os.path.join(workdir, "gunicorn.pid"),
+           "--access-logfile", "/dev/null", "--error-logfile", os.path.join(workdir, "gunicorn.err"),
+           "app:app"]
+    proc = subprocess.Popen(cmd, cwd=FLASK_DIR, env=env)
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection("127.0.0.1", port, timeout=2)
+            conn.request("GET", "/me")
+            conn.getresponse().read()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                raise RuntimeError(f"gunicorn exited with {proc.returncode}; see {workdir}/gunicorn.err")
+            time.sleep(0.2)
+    proc.terminate()
+    raise RuntimeError("gunicorn did not come up within 60s")
+
+
+def _gunicorn_settings():
+    out = {}
+    with open(os.path.join(FLASK_DIR, "gunicorn.conf.py")) as fh:
+        for line in fh:
+            m = re.match(r"^(workers|threads|worker_class|preload_app|timeout)\s*=\s*(.+?)\s*$", line)
+            if m:
+                out[m.group(1)] = ast.literal_eval(m.group(2))
+    return out
+
+
+def _git_rev():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=FLASK_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def cmd_run(args):
+    scenarios = args.scenarios.split(",") if args.scenarios else list(SCENARIOS)
+    unknown = [s for s in scenarios if s not in SCENARIO_FNS and s != "race"]
+    if unknown:
+        sys.exit(f"unknown scenario(s): {', '.join(unknown)}")
+
+    media_fs = os.path.join(FLASK_DIR, "media", BENCH_MEDIA_REL)
+    made_media = not os.path.exists(media_fs)
+    if made_media:
+        os.makedirs(os.path.dirname(media_fs), exist_ok=True)
+        with open(media_fs, "wb") as fh:
+            fh.write(os.urandom(BENCH_MEDIA_BYTES))
+
+    with _connect() as conn, conn.cursor() as cur:
+        cur.execute("SELECT count(*) FROM users WHERE email LIKE 'bench%%@bench.local'")
+        users = cur.fetchone()[0]
+        cur.execute("SELECT count(*) FROM albums")
+        albums = cur.fetchone()[0]
+    if not users:
+        sys.exit("no bench users: run `loadtest.py seed` first")
+
+    workdir = tempfile.mkdtemp(prefix="studio333-bench-")
+    proc = None
+    host, port = "127.0.0.1", args.port
+    if args.url:
+        host, _, p = args.url.replace("http://", "").partition(":")
+        port = int(p or 80)
+    else:
+        # every bench client logs in from 127.0.0.1; lift the per-IP/per-email login throttle
+        proc = _start_gunicorn(port, workdir, {"DB_NAME": _db_env()["dbname"],
+                                               "LOGIN_MAX_PER_IP": "1000000",
+                                               "LOGIN_MAX_FAILS_PER_EMAIL": "1000000"})
+    report = {
+        "meta": {
+            "git": _git_rev(), "at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "python": platform.python_version(), "host": platform.node(), "cpus": os.cpu_count(),
+            "gunicorn": _gunicorn_settings() if proc else {"url": args.url},
+            "db_albums": albums, "bench_users": users,
+            "duration_s": args.duration, "concurrency": args.concurrency,
+        },
+        "scenarios": {},
+    }
+    try:
+        for name in scenarios:
+            if name == "race":
+                continue
+            print(f"... {name}", file=sys.stderr)
+            report["scenarios"][name] = run_scenario(name, host, port, users, args.password, args.duration,
+                                                     args.concurrency, args.seed)
+        if "race" in scenarios or not args.scenarios:
+            print("... race", file=sys.stderr)
+            report["race"] = run_race(host, port, args.password, args.concurrency, args.race_rounds)
+    finally:
+        if proc is not None:
+            proc.send_signal(signal.SIGTERM)
+            proc.wait(timeout=60)
+        shutil.rmtree(workdir, ignore_errors=True)
+        if made_media:
+            os.remove(media_fs)
+
+    out = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w") as fh:
+            fh.write(out + "\n")
+    print(out)
+
+
+def cmd_compare(args):
+    with open(args.base) as fh:
+        base = json.load(fh)
+    with open(args.new) as fh:
+        new = json.load(fh)
+    regressed = []
+    print(f"{'scenario':<12} {'p95 base':>10} {'p95 new':>10} {'rps base':>10} {'rps new':>10}")
+    for name, b in base["scenarios"].items():
+        n = new["scenarios"].get(name)
+        if not n or b["p95_ms"] is None or n["p95_ms"] is None:
+            continue
+        flag = ""
+        if n["p95_ms"] > b["p95_ms"] * (1 + args.threshold) or n["rps"] < b["rps"] * (1 - args.threshold):
+            flag = "  REGRESSION"
+            regressed.append(name)
+        print(f"{name:<12} {b['p95_ms']:>10.2f} {n['p95_ms']:>10.2f} {b['rps']:>10.1f} {n['rps']:>10.1f}{flag}")
+    if new.get("race") and not new["race"].get("ok"):
+        print("race: FAILED (errors or duplicate slugs)")
+        regressed.append("race")
+    sys.exit(1 if regressed else 0)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="studio333 load test")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+
+    p_seed = sub.add_parser("seed", help="initdb + generated rows")
+    p_seed.add_argument("--scale", type=int, default=1000, help="albums / media_items / activity rows (1000, 100000, 1000000)")
+    p_seed.add_argument("--tracks-per-album", type=int, default=8)
+    p_seed.add_argument("--users", type=int, default=0, help="default: max(10, scale / 1000)")
+    p_seed.add_argument("--password", default="bench")
+    p_seed.add_argument("--partition-activity", action="store_true")
+    p_seed.add_argument("--seed", type=int, default=333)
+
+    p_run = sub.add_parser("run", help="start gunicorn and drive the scenarios")
+    p_run.add_argument("--scenarios", default="", help=f"comma separated subset of {','.join(SCENARIOS)},race")
+    p_run.add_argument("--duration", type=float, default=15.0, help="seconds per scenario")
+    p_run.add_argument("--concurrency", type=int, default=8)
+    p_run.add_argument("--race-rounds", type=int, default=20)
+    p_run.add_argument("--port", type=int, default=18001)
+    p_run.add_argument("--url", default="", help="target an already running server instead (host:port)")
+    p_run.add_argument("--password", default="bench")
+    p_run.add_argument("--seed", type=int, default=333)
+    p_run.add_argument("--out", default="")
+
+    p_cmp = sub.add_parser("compare", help="diff two run reports")
+    p_cmp.add_argument("base")
+    p_cmp.add_argument("new")
+    p_cmp.add_argument("--threshold", type=float, default=0.10)
+
+    args = ap.parse_args()
+    {"seed": cmd_seed, "run": cmd_run, "compare": cmd_compare}[args.cmd](args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""Concurrency check for POST /me/albums slug allocation, in-process against a real PostgreSQL.
+
+Each thread has its own Flask test client; all of them post the same title at once through a
+barrier; every request must get a 201 and a distinct slug (base, base-2, ... base-N). Uses a
+throwaway user that is removed afterwards:
+
+    DB_NAME=studio333_bench python bench/race_album_slugs.py --threads 16 --rounds 10
+
+Exits 1 on any error or duplicate slug.
+"""
+import argparse, json, os, sys, threading, time, uuid
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as studio
+
+
+def make_user():
+    email = f"race-{uuid.uuid4().hex[:10]}@bench.local"
+    with studio.get_conn() as conn, conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO users (email, password_hash, nickname, is_verified) VALUES (%s, 'x', 'race', TRUE) RETURNING id",
+            (email,),
+        )
+        uid = cur.fetchone()[0]
+        conn.commit()
+    return uid
+
+
+def drop_user(uid):
+    with studio.get_conn() as conn, conn.cursor() as cur:
+        cur.execute("DELETE FROM albums WHERE user_id = %s", (uid,))
+        cur.execute("DELETE FROM user_activity_log WHERE user_id = %s", (uid,))
+        cur.execute("DELETE FROM users WHERE id = %s", (uid,))
+        conn.commit()
+
+
+def client_for(uid):
+    c = studio.app.test_client()
+    with c.session_transaction() as s:
+        s["user_id"] = uid
+        s["login_at"] = s["last_active"] = time.time()
+    return c
+
+
+def race_round(clients, title):
+    gate = threading.Barrier(len(clients))
+    out = []
+
+    def fire(c):
+        gate.wait()
+        r = c.post("/me/albums", json={"title": title})
+        out.append((r.status_code, r.get_json(silent=True) or {}))
+
+    threads = [threading.Thread(target=fire, args=(c,)) for c in clients]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return out
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--threads", type=int, default=16)
+    ap.add_argument("--rounds", type=int, default=10)
+    args = ap.parse_args()
+
+    studio.init_pool()
+    uid = make_user()
+    report = {"threads": args.threads, "rounds": args.rounds, "requests": 0, "errors": 0,
+              "statuses": {}, "duplicate_slugs": 0, "unexpected_slugs": 0}
+    try:
+        clients = [client_for(uid) for _ in range(args.threads)]
+        for _ in range(args.rounds):
+            title = f"Race {uuid.uuid4().hex[:8]}"
+            out = race_round(clients, title)
+            ids = [d["album"]["id"] for s, d in out if s == 201]
+            report["requests"] += len(out)
+            report["errors"] += len(out) - len(ids)
+            for s, _ in out:
+                report["statuses"][str(s)] = report["statuses"].get(str(s), 0) + 1
+            with studio.get_conn() as conn, conn.cursor() as cur:
+                cur.execute("SELECT slug::text FROM albums WHERE id = ANY(%s::uuid[])", (ids,))
+                slugs = [r[0] for r in cur.fetchall()]
+            base = studio.make_slug(title)
+            expected = {base} | {f"{base}-{n}" for n in range(2, len(ids) + 1)}
+            report["duplicate_slugs"] += len(slugs) - len(set(slugs))
+            report["unexpected_slugs"] += len(set(slugs) - expected)
+    finally:
+        drop_user(uid)
+    report["ok"] = report["errors"] == 0 and report["duplicate_slugs"] == 0
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report["ok"] else 1)
+
+
+if __name__ == "__main__":
+    main()
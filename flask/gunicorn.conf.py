@@ -1,6 +1,9 @@
+import os, shutil
+
 bind = "127.0.0.1:8001"
 workers = 2
 threads = 2
+os.environ.setdefault("WEB_THREADS", str(threads))   # sizes the app's login-hash slots (threads - 1)
 worker_class = "gthread"
 timeout = 60
 graceful_timeout = 30
@@ -9,3 +12,38 @@ pidfile = "/var/www/studio333.art/flask/gunicorn.pid"
 accesslog = "/var/www/studio333.art/flask/gunicorn.access.log"
 errorlog  = "/var/www/studio333.art/flask/gunicorn.error.log"
 loglevel = "info"
+
+# Import the app once in the master; each worker opens its own DB pool after fork.
+# With preload, HUP does not pick up new code: deploy with USR2 (or a restart).
+preload_app = True
+
+# Prometheus multiprocess store: must exist before the app is imported (preload runs before any
+# server hook), and is emptied once per master start so dead workers' samples don't linger.
+# HUP re-reads this file in the same master, hence the marker.
+os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/var/www/studio333.art/flask/.prometheus")
+if not os.environ.get("STUDIO333_PROMETHEUS_DIR_READY"):
+    shutil.rmtree(os.environ["PROMETHEUS_MULTIPROC_DIR"], ignore_errors=True)
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+    os.environ["STUDIO333_PROMETHEUS_DIR_READY"] = "1"
+
+def _studio(worker):
+    wsgi = getattr(worker, "wsgi", None)
+    import sys
+    return sys.modules.get(getattr(wsgi, "import_name", ""), None)
+
+def post_worker_init(worker):
+    # Runs before the worker's accept loop: it only takes traffic once its pool is warm.
+    studio = _studio(worker)
+    if studio is not None:
+        studio.warm_pool()
+        studio.sync_routes_once()   # cheap version check; only one worker per deploy writes
+    worker.log.info("worker %s ready", worker.pid)
+
+def worker_exit(server, worker):
+    studio = _studio(worker)
+    if studio is not None:
+        studio.shutdown_worker(timeout=graceful_timeout / 2)
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -277,6 +277,19 @@ const source = {
     /** Resolves possibly-relative URLs. */
 function resolveUrl(u){ try{ return new URL(u, location.href).href; }catch(e){ return u; } }
 
+    /** Archive audio goes through /stream: the original, or a lower-bitrate rendition on Save-Data / slow links. */
+function audioStreamUrl(u){
+  const url = resolveUrl(u);
+  try{
+    const p = new URL(url);
+    if (p.origin === location.origin && /\/media\/archives\/.+\.(mp3|wav|flac|m4a|ogg)$/i.test(p.pathname)){
+      p.pathname += '/stream';
+      return p.href;
+    }
+  }catch(e){}
+  return url;
+}
+
     /** Checks if a <video> currently has a decodable frame. */
 function videoHasFrame(v){ return v && v.readyState >= 2 && v.videoWidth > 0 && v.videoHeight > 0; }
 
@@ -683,7 +696,7 @@ async function loadPlaylistIndex(ix){
       audio.crossOrigin = "anonymous";
       audio.autoplay = true;
       audio.loop = false;
-      audio.src = resolveUrl(entry.url);
+      audio.src = audioStreamUrl(entry.url);
       audio.onended = ()=>{ if (autoAdvance) nextInPlaylist(); };
       audio.onerror =  ()=>{ if (autoAdvance) nextInPlaylist(); };
 